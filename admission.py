@@ -0,0 +1,259 @@
+"""Admission control for the start-of-sitting login storm.
+
+When a sitting opens, every student posts ``/login`` and ``/start-real-test``
+within seconds. Those are the expensive requests (password hashing, several
+reads and writes each), so :class:`AdmissionController` lets at most
+``max_inflight`` of them run at once. Everyone else gets a ticket and a
+waiting-room page that polls a status endpoint; the status check is a couple
+of indexed reads, so a long queue costs the server almost nothing and admitted
+requests see the same latency as on a quiet server.
+
+Tickets are served strictly in arrival order. When a slot frees up the head
+of the queue is *granted* the slot and has ``grant_seconds`` to claim it by
+re-sending its request with the ticket; an unclaimed grant, or a ticket whose
+page stopped polling for ``abandon_seconds``, is dropped and the slot passes
+on. When the queue already holds ``max_queue`` tickets new arrivals are shed
+(the caller answers 503 with ``Retry-After``).
+
+The queue lives in a small SQLite file of its own (``state_path``), not in
+process memory, so every worker of a multi-process server (``flask serve``,
+or gunicorn through ``wsgi.py``) sees the same queue: a poll or a claim may
+land on any worker, and ``max_inflight`` bounds the heavy requests of the
+whole server. The file holds nothing worth keeping, so it is written with
+``synchronous=OFF``. In-flight slots are counted per worker pid; the slots
+of a worker that died mid-request are reclaimed once its pid is gone.
+Polls only write when they refresh a ticket's ``last_poll``, which they do
+at most every ``abandon_seconds / 3``. The counters of :meth:`metrics` are
+per process; the queue sizes are the server's.
+"""
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Optional
+
+
+DEFAULTS = {
+    'max_inflight': 8,
+    'max_queue': 5000,
+    'grant_seconds': 20,
+    'abandon_seconds': 30,
+    'poll_seconds': 2,
+}
+REAP_SECONDS = 5   # how often dead workers' slots are looked for
+
+ADMITTED = 'admitted'
+WAITING = 'waiting'
+SHED = 'shed'
+UNKNOWN = 'unknown'
+
+
+class Admission(NamedTuple):
+    state: str
+    ticket: Optional[str] = None
+    ahead: int = 0
+
+
+class AdmissionController:
+    """Bounded in-flight heavy requests with a FIFO waiting queue shared by all workers."""
+
+    def __init__(self, state_path, max_inflight=8, max_queue=5000, grant_seconds=20, abandon_seconds=30,
+                 poll_seconds=2, clock=time.time):
+        self.state_path = state_path
+        self.max_inflight = int(max_inflight)
+        self.max_queue = int(max_queue)
+        self.grant_seconds = float(grant_seconds)
+        self.abandon_seconds = float(abandon_seconds)
+        self.poll_seconds = float(poll_seconds)
+        self.clock = clock
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._reaped_at = 0.0
+        self._counts = {'admitted_direct': 0, 'admitted_queued': 0, 'queued': 0, 'shed': 0, 'abandoned': 0}
+
+    def _connect(self):
+        # One connection per thread and per process: connections must not cross a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.state_path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        ensure_schema(conn)
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def _transaction(self, fn, *args):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, *args)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    # ---- request side ----
+
+    def enter(self, ticket=None):
+        """Try to start a heavy request. Pair every ``ADMITTED`` result with :meth:`leave`."""
+        return self._transaction(self._enter, ticket, self.clock())
+
+    def _enter(self, conn, ticket, now):
+        self._housekeep(conn, now)
+        if ticket:
+            row = conn.execute("SELECT seq, granted_until FROM admission_tickets WHERE ticket=?",
+                               (ticket,)).fetchone()
+            if row is not None and row[1] is not None:
+                conn.execute("DELETE FROM admission_tickets WHERE ticket=?", (ticket,))
+                self._take_slot(conn, now)
+                self._count('admitted_queued')
+                return Admission(ADMITTED, ticket)
+            if row is not None:
+                conn.execute("UPDATE admission_tickets SET last_poll=? WHERE ticket=?", (now, ticket))
+                return Admission(WAITING, ticket, self._ahead(conn, row[0]))
+        waiting, granted, inflight = self._sizes(conn)
+        # A new arrival (or a ticket that expired) goes straight in only if nobody is queued
+        if not waiting and inflight + granted < self.max_inflight:
+            self._take_slot(conn, now)
+            self._count('admitted_direct')
+            return Admission(ADMITTED)
+        if waiting >= self.max_queue:
+            self._count('shed')
+            return Admission(SHED)
+        conn.execute("UPDATE admission_state SET next_seq=next_seq + 1")
+        seq = conn.execute("SELECT next_seq FROM admission_state").fetchone()[0]
+        ticket = secrets.token_urlsafe(16)
+        conn.execute("INSERT INTO admission_tickets (ticket, seq, last_poll) VALUES (?, ?, ?)", (ticket, seq, now))
+        self._count('queued')
+        return Admission(WAITING, ticket, self._ahead(conn, seq))
+
+    def leave(self):
+        self._transaction(self._leave, self.clock())
+
+    def _leave(self, conn, now):
+        conn.execute("UPDATE admission_inflight SET n=MAX(0, n - 1) WHERE pid=?", (os.getpid(),))
+        self._promote(conn, now)
+
+    def status(self, ticket):
+        """Cheap poll from the waiting room; also keeps the ticket alive."""
+        now = self.clock()
+        conn = self._connect()
+        row = conn.execute("SELECT seq, last_poll, granted_until FROM admission_tickets WHERE ticket=?",
+                           (ticket,)).fetchone()
+        expired = conn.execute("SELECT 1 FROM admission_tickets WHERE granted_until < ? LIMIT 1",
+                               (now,)).fetchone()
+        if expired or (row is not None and row[2] is None and now - row[1] > self.abandon_seconds / 3):
+            row = self._transaction(self._touch, ticket, now)
+        if row is None:
+            return Admission(UNKNOWN, ticket)
+        if row[2] is not None:
+            return Admission(ADMITTED, ticket)
+        return Admission(WAITING, ticket, self._ahead(conn, row[0]))
+
+    def _touch(self, conn, ticket, now):
+        self._housekeep(conn, now)
+        conn.execute("UPDATE admission_tickets SET last_poll=? WHERE ticket=? AND granted_until IS NULL",
+                     (now, ticket))
+        return conn.execute("SELECT seq, last_poll, granted_until FROM admission_tickets WHERE ticket=?",
+                            (ticket,)).fetchone()
+
+    def metrics(self):
+        conn = self._connect()
+        waiting, granted, inflight = self._sizes(conn)
+        with self._lock:
+            return dict(self._counts, inflight=inflight, waiting=waiting, granted=granted,
+                        max_inflight=self.max_inflight)
+
+    # ---- internals (write transaction held) ----
+
+    @staticmethod
+    def _sizes(conn):
+        waiting, granted = conn.execute("""
+            SELECT COUNT(*) - COUNT(granted_until), COUNT(granted_until) FROM admission_tickets
+        """).fetchone()
+        inflight = conn.execute("SELECT COALESCE(SUM(n), 0) FROM admission_inflight").fetchone()[0]
+        return waiting, granted, inflight
+
+    @staticmethod
+    def _ahead(conn, seq):
+        # Abandoned tickets ahead are still counted until the queue reaches them
+        served = conn.execute("SELECT served_seq FROM admission_state").fetchone()[0]
+        return max(0, seq - served - 1)
+
+    def _take_slot(self, conn, now):
+        conn.execute("""
+            INSERT INTO admission_inflight (pid, n, updated_at) VALUES (?, 1, ?)
+            ON CONFLICT(pid) DO UPDATE SET n=n + 1, updated_at=excluded.updated_at
+        """, (os.getpid(), now))
+
+    def _housekeep(self, conn, now):
+        dropped = conn.execute("DELETE FROM admission_tickets WHERE granted_until < ?", (now,)).rowcount
+        if dropped:
+            self._count('abandoned', dropped)
+        if now - self._reaped_at > REAP_SECONDS:
+            self._reaped_at = now
+            for (pid,) in conn.execute("SELECT pid FROM admission_inflight WHERE n > 0").fetchall():
+                if pid != os.getpid() and not _alive(pid):
+                    conn.execute("DELETE FROM admission_inflight WHERE pid=?", (pid,))
+        self._promote(conn, now)
+
+    def _promote(self, conn, now):
+        waiting, granted, inflight = self._sizes(conn)
+        free = self.max_inflight - inflight - granted
+        while waiting and free > 0:
+            rows = conn.execute("""
+                SELECT ticket, seq, last_poll FROM admission_tickets WHERE granted_until IS NULL
+                ORDER BY seq LIMIT ?
+            """, (free,)).fetchall()
+            for ticket, seq, last_poll in rows:
+                conn.execute("UPDATE admission_state SET served_seq=?", (seq,))
+                waiting -= 1
+                if now - last_poll > self.abandon_seconds:
+                    conn.execute("DELETE FROM admission_tickets WHERE ticket=?", (ticket,))
+                    self._count('abandoned')
+                    continue
+                conn.execute("UPDATE admission_tickets SET granted_until=? WHERE ticket=?",
+                             (now + self.grant_seconds, ticket))
+                free -= 1
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS admission_tickets (
+            ticket TEXT PRIMARY KEY,
+            seq INTEGER,
+            last_poll REAL,
+            granted_until REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_admission_tickets_seq ON admission_tickets(seq) WHERE granted_until IS NULL;
+        CREATE INDEX IF NOT EXISTS idx_admission_tickets_granted ON admission_tickets(granted_until)
+            WHERE granted_until IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS admission_inflight (
+            pid INTEGER PRIMARY KEY,
+            n INTEGER DEFAULT 0,
+            updated_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS admission_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            next_seq INTEGER DEFAULT 0,
+            served_seq INTEGER DEFAULT 0
+        );
+        INSERT OR IGNORE INTO admission_state (id, next_seq, served_seq) VALUES (1, 0, 0);
+    """)
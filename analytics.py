@@ -0,0 +1,278 @@
+"""Columnar answer matrix for cohort analytics.
+
+Per test, every submission is one row of a submissions x questions matrix
+with one byte per cell:
+
+* bits 0-2: chosen option (0 = none, 1-4 = a-d),
+* bit 3:    answer was graded correct,
+* bit 7:    the question was on the submission's paper.
+
+Rows are appended raw to ``test_<id>/cells.u8`` (plus their submission ids to
+``ids.i8``) and read back through ``numpy.memmap``, so a 100k x 25 cohort is
+2.5 MB on disk and any aggregate is a vectorized reduction. ``meta.json`` is
+rewritten atomically after each append and is the commit point: it holds the
+row count, the question ids (the main set in ``ORDER BY id`` order) and a
+checksum of the scores.
+
+Appending runs on the submit path, so it never rebuilds and never waits for
+a rebuild. Submissions that commit out of id order are appended as they come
+and the store is flagged unsorted; the next read sorts it once. An append
+that finds the store busy, missing or built for other questions is skipped.
+Rebuilds from ``submissions.details_json`` happen only on the read side
+(the admin analytics pages) and after a re-grade, when the meta does not
+match the database (skipped append, re-grade, edited question set).
+"""
+import json
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import details_codec
+from lazy import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: thread lock only
+    fcntl = None
+
+
+FORMAT_VERSION = 1
+OPTION_BITS = {'a': 1, 'b': 2, 'c': 3, 'd': 4}
+OPTION_LETTERS = ('', 'a', 'b', 'c', 'd', '', '', '')   # index = option bits
+CORRECT_BIT = 0x08
+PRESENT_BIT = 0x80
+
+
+def encode_row(details, col):
+    """Encode one submission's ``details_json`` list as a row of cell bytes.
+
+    Plain bytes, so appending on submit never needs NumPy.
+    """
+    row = bytearray(len(col))
+    for d in details:
+        j = col.get(d.get('qid'))
+        if j is None:
+            continue
+        row[j] = (PRESENT_BIT | OPTION_BITS.get(d.get('given_key') or '', 0)
+                  | (CORRECT_BIT if d.get('correct') else 0))
+    return bytes(row)
+
+
+class AnswerMatrix:
+    """Read-only view of one test's matrix."""
+
+    def __init__(self, test_id, qids, submission_ids, cells):
+        self.test_id = test_id
+        self.qids = qids
+        self.submission_ids = submission_ids
+        self.cells = cells
+
+    def __len__(self):
+        return len(self.submission_ids)
+
+    @property
+    def present(self):
+        return (self.cells & PRESENT_BIT) != 0
+
+    @property
+    def correct(self):
+        return (self.cells & CORRECT_BIT) != 0
+
+    @property
+    def chosen(self):
+        """Chosen option per cell as 0 (none) to 4 (d)."""
+        return self.cells & 0x07
+
+    def scores(self):
+        return self.correct.sum(axis=1, dtype=np.int64)
+
+    def percents(self):
+        totals = self.present.sum(axis=1, dtype=np.int64)
+        return np.divide(self.scores() * 100.0, totals, out=np.zeros(len(self), dtype=np.float64),
+                         where=totals > 0)
+
+    def question_stats(self):
+        """Per question: attempts, correct count and option pick counts (none, a-d)."""
+        present = self.present
+        attempts = present.sum(axis=0, dtype=np.int64)
+        correct = (self.correct & present).sum(axis=0, dtype=np.int64)
+        chosen = np.where(present, self.chosen, 0).astype(np.intp)
+        picks = np.zeros((len(self.qids), 5), dtype=np.int64)
+        for k in range(5):
+            picks[:, k] = ((chosen == k) & present).sum(axis=0)
+        return [{'qid': qid, 'attempts': int(attempts[j]), 'correct': int(correct[j]),
+                 'correct_pct': round(100.0 * correct[j] / attempts[j], 1) if attempts[j] else 0.0,
+                 'picks': dict(zip(('none', 'a', 'b', 'c', 'd'), map(int, picks[j])))}
+                for j, qid in enumerate(self.qids)]
+
+    def wrong_on(self, qid):
+        """Submission ids that had ``qid`` on their paper and did not get it right."""
+        j = self.qids.index(qid)
+        mask = ((self.cells[:, j] & PRESENT_BIT) != 0) & ((self.cells[:, j] & CORRECT_BIT) == 0)
+        return self.submission_ids[mask].tolist()
+
+
+class AnswerMatrixStore:
+    """On-disk answer matrices, one directory per test."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+        self._skipped = 0
+
+    def _dir(self, test_id):
+        return self.directory / f'test_{int(test_id)}'
+
+    @contextmanager
+    def _locked(self, test_id, blocking=True):
+        """Hold the store of ``test_id``; yields None if ``blocking`` is off and it is busy."""
+        path = self._dir(test_id)
+        path.mkdir(parents=True, exist_ok=True)
+        if not self._lock.acquire(blocking):
+            yield None
+            return
+        try:
+            if fcntl is None:
+                yield path
+                return
+            with open(path / 'lock', 'a') as fh:
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield None
+                    return
+                try:
+                    yield path
+                finally:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def _read_meta(path):
+        try:
+            meta = json.loads((path / 'meta.json').read_text())
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get('version') == FORMAT_VERSION else None
+
+    @staticmethod
+    def _write_meta(path, meta):
+        tmp = path / 'meta.json.tmp'
+        tmp.write_text(json.dumps(meta))
+        os.replace(tmp, path / 'meta.json')
+
+    @staticmethod
+    def _probe(conn, test_id):
+        row = conn.execute("""
+            SELECT COUNT(*) AS n, COALESCE(MAX(id), 0) AS max_id, TOTAL(score) AS score_total
+            FROM submissions WHERE test_id=?
+        """, (test_id,)).fetchone()
+        return row['n'], row['max_id'], row['score_total']
+
+    # ---- writing ----
+
+    def append(self, conn, test_id, submission_id, score, details, qids):
+        """Append one submission; returns False if it was skipped.
+
+        A skipped row leaves the meta out of step with the database, so the
+        next :meth:`load` rebuilds.
+        """
+        with self._locked(test_id, blocking=False) as path:
+            meta = self._read_meta(path) if path is not None else None
+            if meta is None or meta['qids'] != list(qids):
+                self._skipped += 1
+                return False
+            n, width = meta['rows'], len(qids)
+            row = encode_row(details, {qid: j for j, qid in enumerate(qids)})
+            # Drop bytes of an append that crashed before its meta was written
+            with open(path / 'cells.u8', 'r+b' if (path / 'cells.u8').exists() else 'wb') as fh:
+                fh.truncate(n * width)
+                fh.seek(n * width)
+                fh.write(row)
+            with open(path / 'ids.i8', 'r+b' if (path / 'ids.i8').exists() else 'wb') as fh:
+                fh.truncate(n * 8)
+                fh.seek(n * 8)
+                fh.write(struct.pack('<q', submission_id))
+            if submission_id <= meta['max_id']:
+                meta['sorted'] = False
+            meta.update(rows=n + 1, max_id=max(meta['max_id'], submission_id),
+                        score_total=meta['score_total'] + float(score or 0))
+            self._write_meta(path, meta)
+            return True
+
+    def _sort(self, path, meta):
+        """Put the rows of an unsorted store in submission id order. None if it has duplicates."""
+        n, width = meta['rows'], len(meta['qids'])
+        ids = np.fromfile(path / 'ids.i8', dtype='<i8', count=n)
+        cells = np.fromfile(path / 'cells.u8', dtype=np.uint8, count=n * width).reshape(n, width)
+        order = np.argsort(ids, kind='stable')
+        ids, cells = ids[order], cells[order]
+        if n > 1 and (ids[1:] == ids[:-1]).any():
+            return None
+        cells.tofile(path / 'cells.u8.tmp')
+        ids.tofile(path / 'ids.i8.tmp')
+        os.replace(path / 'cells.u8.tmp', path / 'cells.u8')
+        os.replace(path / 'ids.i8.tmp', path / 'ids.i8')
+        meta['sorted'] = True
+        self._write_meta(path, meta)
+        return meta
+
+    def rebuild(self, conn, test_id, qids):
+        with self._locked(test_id) as path:
+            return self._rebuild(conn, test_id, qids, path)
+
+    def _rebuild(self, conn, test_id, qids, path):
+        col = {qid: j for j, qid in enumerate(qids)}
+        n, max_id, score_total = 0, 0, 0.0
+        with open(path / 'cells.u8.tmp', 'wb') as cells_fh, open(path / 'ids.i8.tmp', 'wb') as ids_fh:
+            cur = conn.execute("SELECT id, score, details_json FROM submissions WHERE test_id=? ORDER BY id",
+                               (test_id,))
+            while True:
+                batch = cur.fetchmany(1000)
+                if not batch:
+                    break
+                for r in batch:
+                    details = details_codec.decode(r['details_json'])
+                    cells_fh.write(encode_row(details, col))
+                    score_total += float(r['score'] or 0)
+                ids_fh.write(struct.pack(f'<{len(batch)}q', *(r['id'] for r in batch)))
+                n += len(batch)
+                max_id = batch[-1]['id']
+        os.replace(path / 'cells.u8.tmp', path / 'cells.u8')
+        os.replace(path / 'ids.i8.tmp', path / 'ids.i8')
+        meta = {'version': FORMAT_VERSION, 'test_id': test_id, 'qids': list(qids), 'rows': n,
+                'max_id': max_id, 'score_total': score_total, 'sorted': True}
+        self._write_meta(path, meta)
+        print(f'[ANALYTICS] rebuilt test {test_id}: {n} submissions x {len(qids)} questions')
+        return meta
+
+    # ---- reading ----
+
+    def load(self, conn, test_id, qids):
+        """Return the :class:`AnswerMatrix` of ``test_id``, rebuilding it first if stale."""
+        n_db, max_id, score_total = self._probe(conn, test_id)
+        with self._locked(test_id) as path:
+            meta = self._read_meta(path)
+            if meta is not None and meta.get('sorted') is False:
+                meta = self._sort(path, meta)
+            if (meta is None or meta['qids'] != list(qids) or meta['rows'] != n_db or meta['max_id'] != max_id
+                    or abs(meta['score_total'] - score_total) > 1e-6):
+                meta = self._rebuild(conn, test_id, qids, path)
+            n, width = meta['rows'], len(meta['qids'])
+            if n == 0 or width == 0:
+                cells = np.zeros((n, width), dtype=np.uint8)
+                ids = np.zeros(n, dtype='<i8')
+            else:
+                cells = np.memmap(path / 'cells.u8', dtype=np.uint8, mode='r', shape=(n, width))
+                ids = np.memmap(path / 'ids.i8', dtype='<i8', mode='r', shape=(n,))
+        return AnswerMatrix(test_id, meta['qids'], ids, cells)
+
+    def metrics(self):
+        return {'appends_skipped': self._skipped}
+
+
+def ensure_schema(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_submissions_test ON submissions(test_id, id)")
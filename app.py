@@ -1,71 +1,200 @@
 import os
 import json
+import functools
 import csv
 import io
 import sqlite3
 import random
 import hashlib
-import smtplib
+import mimetypes
 import string
-import pandas as pd
 import re
+import secrets
+import shutil
 from datetime import datetime, timezone, timedelta
-from email.mime.text import MIMEText
-from email.utils import formataddr
 from pathlib import Path
-import shutil
 import urllib.request
+import urllib.parse
+import click
 
-from flask import Flask, render_template, request, redirect, url_for, abort, send_file, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, abort, send_file, send_from_directory, session, jsonify
+from werkzeug.datastructures import ImmutableMultiDict
 from dotenv import load_dotenv
-from reportlab.lib.pagesizes import A4, landscape
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import mm
-from reportlab.lib.utils import ImageReader
-from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak, Image as RLImage
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
+# numpy/pandas load on first use (admin paths only); ReportLab is imported inside the PDF functions
+from lazy import numpy as np, pandas as pd
+import instrumentation
+from instrumentation import TimedConnection, timed
+from admission import AdmissionController, ADMITTED, SHED
+from bulk_mail import BulkMailer, ensure_schema as ensure_bulk_mail_schema
+from mailer import Mailer, ensure_schema as ensure_mail_schema
+import analytics
+import archive
+import backups
+import collusion
+import compression
+import details_codec
+import fragments
+import grading
+import images
+import papers
+import prefork
+import proctoring
+import reads
+import regrade
+import settings
+import writes
+from session_store import SessionStore, ServerSessionInterface, ensure_schema as ensure_session_schema
 
 load_dotenv()
 
+render_template = timed('render_template')(render_template)
+
 BASE_DIR = Path(__file__).parent
-DB_PATH = BASE_DIR / "data.sqlite3"
+DB_PATH = Path(os.getenv("DB_PATH", BASE_DIR / "data.sqlite3"))
 CONFIG_PATH = BASE_DIR / "config.json"
 UPLOADS_DIR = BASE_DIR / "uploads"
 ASSETS_DIR = BASE_DIR / "assets"
+STATIC_DIR = BASE_DIR / "static"
+QUESTION_IMAGES_DIR = STATIC_DIR / "assets" / "question_images"
+PDF_DIR = Path(os.getenv("PDF_DIR", BASE_DIR))  # generated certificates/results
+ANALYTICS_DIR = Path(os.getenv("ANALYTICS_DIR", DB_PATH.parent / "analytics"))  # memory-mapped answer matrices
+BACKUP_DIR = Path(os.getenv("BACKUP_DIR", DB_PATH.parent / "backups"))  # online snapshots of the database
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", DB_PATH.parent / "archive"))  # finished sittings, one database per term
+METRICS_DIR = Path(os.getenv("METRICS_DIR", DB_PATH.parent / "metrics"))  # per-worker histograms, merged on scrape
+
+# config.json compiled into immutable settings, reloaded when the file changes (see settings.py)
+config_store = settings.ConfigStore(CONFIG_PATH, ASSETS_DIR)
+
+
+def cfg() -> settings.Settings:
+    """The current configuration."""
+    return config_store.get()
+
+
+def test_settings(conn, test_id: int) -> settings.Settings:
+    """The configuration for one test: config.json plus the test's config_json overrides."""
+    def overrides():
+        row = conn.execute("SELECT config_json FROM tests WHERE id=?", (test_id,)).fetchone()
+        return row['config_json'] if row else None
+    return config_store.for_test(test_id, overrides)
 
-with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-    CFG = json.load(f)
 
 APP_TITLE = os.getenv("APP_TITLE", "Simple Test Platform")
 SECRET_KEY = os.getenv("SECRET_KEY", "change-this")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")  # Default admin password
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # Bearer token for /admin/metrics scrapers
+PAPER_SEED_SECRET = os.getenv("PAPER_SEED_SECRET", SECRET_KEY)  # HMAC key for per-attempt paper seeds
+
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 4 * 3600))
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
 
+# Busy timeouts, retried write units and the background checkpointer; every
+# connection below is opened through AppConnection (see writes.py).
+db_writes = writes.WriteCoordinator(DB_PATH, **cfg().get('writes', {}))
+AppConnection = db_writes.connection_class(TimedConnection)
+
+# Sessions are stored server-side; the cookie only carries an opaque id that
+# doubles as quiz_sessions.session_token.
+session_store = SessionStore(DB_PATH,
+                             ttl_seconds=SESSION_TTL_SECONDS,
+                             hot_ttl=float(os.getenv("SESSION_HOT_TTL", 0)),
+                             sweep_interval=int(os.getenv("SESSION_SWEEP_SECONDS", 300)),
+                             factory=AppConnection,
+                             run_write=db_writes.run)
+app.session_interface = ServerSessionInterface(session_store)
+
+# Per-route latency, per-query timings and named spans, summed over all
+# worker processes; see /admin/metrics.
+instrumentation.init_app(app,
+                         profile_sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", 0)),
+                         profile_dir=BASE_DIR / "profiles",
+                         shared_dir=METRICS_DIR)
+
+# Outbound mail is queued in mail_queue and sent by pooled SMTP workers.
+_email_cfg = cfg().get('email', {})
+mailer = Mailer(DB_PATH, _email_cfg.get('smtp', {}),
+                pool_size=_email_cfg.get('pool_size', 2),
+                batch_size=_email_cfg.get('batch_size', 20),
+                rate_per_second=_email_cfg.get('rate_per_second', 5),
+                max_attempts=_email_cfg.get('max_attempts', 6),
+                factory=AppConnection)
+
+# Login and paper start are admitted a few at a time; the rest wait in the waiting room.
+# The queue is kept in a file of its own so that every worker process shares it.
+ADMISSION_DB = Path(os.getenv("ADMISSION_DB", DB_PATH.parent / "admission.sqlite3"))
+admission = AdmissionController(ADMISSION_DB, **cfg().get('admission', {}))
+
+# Pages that only depend on the config and the student's level are rendered once; see cached_page().
+page_cache = fragments.FragmentCache(render_template)
+
+# Text responses are gzip/Brotli-compressed for clients that accept it; see compression.py.
+compressor = compression.CompressionMiddleware(app.wsgi_app, **cfg().get('compression', {}))
+app.wsgi_app = compressor
+
+# Scheduled online snapshots of the database (off unless backup.interval_minutes is set).
+backup_scheduler = backups.BackupScheduler(DB_PATH, BACKUP_DIR, **cfg().get('backup', {}))
+
+
+# Finished sittings are moved out of the live database into per-term archives (see archive.py).
+archiver = archive.Archiver(DB_PATH, ARCHIVE_DIR, factory=AppConnection, **cfg().get('archive', {}))
+
+# Admin pages and exports read through read-only, time-limited pooled connections
+# that include the archives, so they never hold up student writes (see reads.py).
+admin_reads = reads.ReadPool(DB_PATH, factory=AppConnection, cursor_factory=instrumentation.TimedCursor,
+                             prepare=lambda conn: archiver.attach(conn, readonly=True),
+                             generation=archiver.attached_files, **cfg().get('reads', {}))
+
+
+@app.before_request
+def start_background_jobs():
+    db_writes.start()
+    backup_scheduler.start()
+    archiver.start()
+
+# Anti-cheat beacons are buffered and group-committed by a background thread.
+proctor = proctoring.EventIngest(DB_PATH, factory=AppConnection)
+
 # ------------------------- DB helpers -------------------------
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+def get_db(archives=False):
+    """Connection to the live database. With ``archives``, ``submissions`` also
+    includes archived sittings (read-only: do not write submissions through it)."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, factory=AppConnection)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
+    if archives:
+        archiver.attach(conn)
     return conn
 
 
+def get_read_db():
+    """Read-only connection for admin pages and exports, archived sittings included.
+    Queries are time-limited (reads.ReadTimeout); ``close()`` returns it to the pool."""
+    return admin_reads.connect()
+
+
+@app.errorhandler(reads.ReadTimeout)
+def read_timeout(e):
+    print('[READS] admin read stopped:', request.path, e)
+    return 'This report took too long to build; please try again or narrow it down.', 503, {'Retry-After': '30'}
+
+
 # Helpers for image saving/normalization
+@timed('ensure_image_saved')
 def ensure_image_saved(image_url: str) -> str:
     """Ensure the provided image_url is available under `static/assets/question_images/`.
-    Returns a path relative to `static/` (e.g. `assets/question_images/xxx.png`) or the original value on failure.
+    Returns a path relative to `static/` (e.g. `assets/question_images/xxx.<fingerprint>.png`) or the
+    original value on failure. New images go through the image pipeline (fingerprinted name plus
+    resized variants, see images.py).
     """
     image_url = (str(image_url or '')).strip()
     if not image_url:
         return ''
 
-    static_img_dir = BASE_DIR / 'static' / 'assets' / 'question_images'
-    static_img_dir.mkdir(parents=True, exist_ok=True)
-
     # If already a relative static assets path, normalize
     if image_url.startswith('assets/'):
         return image_url
@@ -75,22 +204,21 @@ def ensure_image_saved(image_url: str) -> str:
     # Remote URL: try download
     if image_url.startswith('http://') or image_url.startswith('https://'):
         try:
-            ext = os.path.splitext(image_url)[1] or '.png'
-            fname = f"{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')}{ext}"
-            dest = static_img_dir / fname
-            urllib.request.urlretrieve(image_url, dest)
-            return f"assets/question_images/{fname}"
+            with urllib.request.urlopen(image_url, timeout=20) as resp:
+                data = resp.read()
+            name = os.path.basename(urllib.parse.urlparse(image_url).path) or 'image.png'
+            if not os.path.splitext(name)[1]:
+                name += '.png'
+            return f"assets/question_images/{images.store_image(data, name, QUESTION_IMAGES_DIR)}"
         except Exception:
             return image_url
 
     # Local file: check common locations (uploads, project root, static)
-    candidates = [UPLOADS_DIR / image_url, BASE_DIR / image_url, BASE_DIR / 'static' / image_url]
+    candidates = [UPLOADS_DIR / image_url, BASE_DIR / image_url, STATIC_DIR / image_url]
     for c in candidates:
         try:
             if c.exists():
-                fname = f"{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')}_{Path(c).name}"
-                dest = static_img_dir / fname
-                shutil.copy(str(c), str(dest))
+                fname = images.store_image(c.read_bytes(), c.name, QUESTION_IMAGES_DIR)
                 return f"assets/question_images/{fname}"
         except Exception:
             continue
@@ -98,6 +226,77 @@ def ensure_image_saved(image_url: str) -> str:
     return image_url
 
 
+def discard_question_image(conn, image_url: str):
+    """Delete a question image (and its variants) once no question refers to it any more."""
+    if not image_url or not image_url.startswith('assets/question_images/'):
+        return
+    in_use = conn.execute("SELECT 1 FROM questions WHERE image_url=? LIMIT 1", (image_url,)).fetchone()
+    if not in_use:
+        images.remove_image(STATIC_DIR, image_url)
+
+
+@app.template_global()
+def question_image(image_url: str, kind: str = 'display') -> str:
+    """URL of a question image, using its resized ``kind`` variant when there is one."""
+    if not image_url or image_url.startswith(('http://', 'https://')):
+        return image_url or ''
+    return url_for('static', filename=images.variant(STATIC_DIR, image_url, kind))
+
+
+@app.template_global()
+def question_image_srcset(image_url: str) -> str:
+    if not image_url or image_url.startswith(('http://', 'https://')):
+        return ''
+    return images.srcset(STATIC_DIR, image_url, lambda rel: url_for('static', filename=rel))
+
+
+@app.after_request
+def cache_fingerprinted_static(response):
+    # Fingerprinted names never change content, so browsers may keep them for a year
+    if request.endpoint == 'static' and response.status_code in (200, 304) and images.is_fingerprinted(request.path):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    return response
+
+
+def static_file(filename: str):
+    """Flask's static view, preferring a precompressed ``.br``/``.gz`` sibling (see ``flask compress-static``)."""
+    found = compression.precompressed(STATIC_DIR, filename, request.headers.get('Accept-Encoding', ''))
+    if not found:
+        return app.send_static_file(filename)
+    encoding, name = found
+    resp = send_from_directory(STATIC_DIR, name, mimetype=mimetypes.guess_type(filename)[0],
+                               max_age=app.get_send_file_max_age(filename))
+    resp.headers['Content-Encoding'] = encoding
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+app.view_functions['static'] = static_file
+
+
+def cached_page(template: str, key: tuple, inject: dict = None, private: bool = False, **context):
+    """Serve ``template`` from the page cache with a strong ETag; 304 if the browser's copy matches.
+
+    ``key`` must hold everything besides the config that the page depends on;
+    ``inject`` values change per request and are substituted into the cached page.
+    """
+    if app.debug:  # templates are edited live
+        page_cache.clear()
+    page = page_cache.get(template, (cfg().version,) + key, context, inject)
+    resp = app.make_response(page.body)
+    resp.set_etag(page.etag)
+    # Revalidate every time (the quiz status can change), but a match costs no body
+    resp.cache_control.no_cache = True
+    if private:
+        resp.cache_control.private = True
+    else:
+        resp.cache_control.public = True
+    return resp.make_conditional(request)
+
+
 def init_db():
     conn = get_db()
     conn.executescript(
@@ -198,8 +397,19 @@ def init_db():
         );
         """
     )
-    # Seed tests for all levels from CFG if not exists
-    slug = CFG['test']['slug']
+    ensure_session_schema(conn)
+    ensure_mail_schema(conn)
+    ensure_bulk_mail_schema(conn)
+    papers.ensure_schema(conn)
+    regrade.ensure_schema(conn)
+    grading.ensure_schema(conn)
+    analytics.ensure_schema(conn)
+    archive.ensure_schema(conn)
+    collusion.ensure_schema(conn)
+    proctoring.ensure_schema(conn)
+    details_codec.ensure_schema(conn)
+    # Seed tests for all levels from the config if not exists
+    slug = cfg().slug
     levels = ['NOVAS', 'VOYAGERS', 'TITANS', 'LEGENDS']
     level_names = {
         'NOVAS': 'Smart Quest - Year 3-4 (Beginner)',
@@ -212,9 +422,18 @@ def init_db():
         exists = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (slug, level)).fetchone()
         if not exists:
             name = level_names.get(level, f'{slug} - {level}')
-            attempts_limit = CFG['test'].get('attempts_limit', 1)
             conn.execute("INSERT INTO tests (slug, level, name, attempts_limit, config_json, status) VALUES (?,?,?,?,?,?)",
-                         (slug, level, name, attempts_limit, json.dumps(CFG), 'inactive'))
+                         (slug, level, name, cfg().attempts_limit, '{}', 'inactive'))
+
+    # config_json used to hold a full copy of config.json taken at seeding, which went stale;
+    # it now holds per-test overrides only (see settings.ConfigStore.for_test)
+    for row in conn.execute("SELECT id, config_json FROM tests").fetchall():
+        try:
+            stored = json.loads(row['config_json'] or '{}')
+        except ValueError:
+            stored = None
+        if not isinstance(stored, dict) or ('test' in stored and 'branding' in stored):
+            conn.execute("UPDATE tests SET config_json='{}' WHERE id=?", (row['id'],))
     
     # Create default admin if not exists
     admin_exists = conn.execute("SELECT id FROM admin_users WHERE username='admin'").fetchone()
@@ -227,29 +446,20 @@ def init_db():
 # ------------------------- Email -------------------------
 
 def send_email_code(email: str, code: str):
-    provider = CFG.get('email', {}).get('provider', 'smtp')
-    subject = f"Your login code for {CFG['test']['name']}"
+    """Queue a one-time code email; delivery happens on the mailer workers."""
+    provider = cfg().get('email', {}).get('provider', 'smtp')
+    subject = f"Your login code for {cfg().test_name}"
     body = f"Your one-time code is: {code}\nIt expires in 10 minutes."
     if provider == 'smtp':
-        smtp_cfg = CFG['email']['smtp']
+        smtp_cfg = cfg()['email']['smtp']
         if not smtp_cfg.get('host'):
             print('[EMAIL] SMTP not configured. Code for', email, 'is', code)
             return True
-        msg = MIMEText(body)
-        msg['Subject'] = subject
-        msg['From'] = formataddr(('Test Platform', smtp_cfg['from']))
-        msg['To'] = email
         try:
-            server = smtplib.SMTP(smtp_cfg['host'], smtp_cfg['port'])
-            if smtp_cfg.get('use_tls', True):
-                server.starttls()
-            if smtp_cfg.get('username'):
-                server.login(smtp_cfg['username'], smtp_cfg['password'])
-            server.sendmail(smtp_cfg['from'], [email], msg.as_string())
-            server.quit()
+            mailer.enqueue(email, subject, body)
             return True
         except Exception as e:
-            print('[EMAIL] SMTP send failed:', e)
+            print('[EMAIL] Could not queue message:', e)
             return False
     else:
         # sendgrid/ses placeholders
@@ -272,20 +482,14 @@ def generate_student_password(length: int = 12) -> str:
     return ''.join(random.choice(chars) for _ in range(length))
 
 
-def mmss_to_seconds(mmss: str) -> int:
-    mm, ss = mmss.split(':')
-    return int(mm) * 60 + int(ss)
-
-
 def hash_code(code: str) -> str:
     return hashlib.sha256(code.encode('utf-8')).hexdigest()
 
 
-def grade_from_percent(pct: float):
-    for rule in CFG['branding']['certificate']['grade_thresholds']:
-        if pct >= rule['min_percent']:
-            return rule['grade'], rule['desc']
-    return 'F', 'Needs Improvement'
+def grade_from_percent(pct: float, conn=None, test_id: int = None):
+    """Grade and description for ``pct``, using the test's grade bands when ``test_id`` is given."""
+    conf = test_settings(conn, test_id) if conn is not None and test_id else cfg()
+    return conf.grade_for(pct)
 
 # ------------------------- Routes -------------------------
 
@@ -315,6 +519,7 @@ def admin_login_post():
     if not admin or not verify_password(password, admin['password_hash']):
         return render_template('admin_login.html', app_title=APP_TITLE, error='Invalid credentials')
     
+    session.regenerate()
     session['admin_id'] = admin['id']
     session['admin_username'] = username
     return redirect(url_for('admin_dashboard'))
@@ -324,9 +529,9 @@ def admin_dashboard():
     if 'admin_id' not in session:
         return redirect(url_for('admin_login'))
     
-    conn = get_db()
+    conn = get_read_db()
     test = conn.execute("SELECT id, name, slug, status, start_time, end_time FROM tests WHERE slug=?", 
-                       (CFG['test']['slug'],)).fetchone()
+                       (cfg().slug,)).fetchone()
     
     # Get all submissions
     submissions = conn.execute("""
@@ -345,14 +550,14 @@ def admin_dashboard():
     
     return render_template('admin_dashboard.html', app_title=APP_TITLE, test=test, 
                          submissions=submissions, active_credentials=active_credentials,
-                         used_credentials=used_credentials, CFG=CFG)
+                         used_credentials=used_credentials, CFG=cfg())
 
 @app.get('/admin/credentials')
 def admin_credentials():
     if 'admin_id' not in session:
         return redirect(url_for('admin_login'))
     
-    conn = get_db()
+    conn = get_read_db()
     credentials = conn.execute("""
         SELECT id, email, name, level, status, created_at, expires_at 
         FROM student_credentials 
@@ -394,7 +599,7 @@ def admin_edit_credential():
     if not email:
         session['error_msg'] = 'Invalid email'
         return redirect(url_for('admin_credentials'))
-    conn = get_db()
+    conn = get_read_db()
     cred = conn.execute("SELECT id, email, name, level, status, expires_at FROM student_credentials WHERE email=?", (email,)).fetchone()
     conn.close()
     if not cred:
@@ -434,7 +639,7 @@ def admin_edit_question():
     if not qid:
         session['error_msg'] = 'No question id'
         return redirect(url_for('admin_questions'))
-    conn = get_db()
+    conn = get_read_db()
     row = conn.execute("SELECT id, question_id, text, image_url, option_a, option_b, option_c, option_d, correct_option FROM questions WHERE id=?", (qid,)).fetchone()
     conn.close()
     if not row:
@@ -461,52 +666,57 @@ def admin_update_question():
     f = request.files.get('image')
     img_rel = None
     if f and f.filename:
-        # save to uploads then ensure saved to static
-        temp_name = f"temp_img_{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')}_{f.filename}"
-        temp_path = UPLOADS_DIR / temp_name
-        f.save(str(temp_path))
-        img_rel = ensure_image_saved(temp_name)
+        # fingerprinted original plus resized variants under static/
+        img_rel = f"assets/question_images/{images.store_image(f.read(), f.filename, QUESTION_IMAGES_DIR)}"
 
     delete_flag = (request.form.get('delete_image') or '') in ('1', 'on', 'true')
 
     conn = get_db()
     try:
         # Fetch current image URL so we can remove file if needed
-        row = conn.execute("SELECT image_url FROM questions WHERE id=?", (qid,)).fetchone()
+        row = conn.execute("""
+            SELECT q.image_url, q.correct_option, s.test_id, s.set_type
+            FROM questions q LEFT JOIN question_sets s ON q.set_id = s.id WHERE q.id=?
+        """, (qid,)).fetchone()
         old_image = row['image_url'] if row else ''
 
         # If a new image was uploaded, set it and remove old image file
         if img_rel:
             conn.execute("UPDATE questions SET text=?, option_a=?, option_b=?, option_c=?, option_d=?, correct_option=?, image_url=? WHERE id=?",
                          (text, option_a, option_b, option_c, option_d, correct, img_rel, qid))
-            # attempt to remove old image file if it lives under assets/question_images
-            try:
-                if old_image and old_image.startswith('assets/question_images/'):
-                    old_path = BASE_DIR / 'static' / old_image
-                    if old_path.exists():
-                        old_path.unlink()
-            except Exception:
-                pass
+            # remove the old image if it lives under assets/question_images and nothing else uses it
+            if old_image != img_rel:
+                try:
+                    discard_question_image(conn, old_image)
+                except Exception:
+                    pass
         else:
             # No new upload. If delete flag provided, clear image_url and remove file.
             if delete_flag and old_image:
+                conn.execute("UPDATE questions SET text=?, option_a=?, option_b=?, option_c=?, option_d=?, correct_option=?, image_url='' WHERE id=?",
+                             (text, option_a, option_b, option_c, option_d, correct, qid))
                 try:
-                    if old_image.startswith('assets/question_images/'):
-                        old_path = BASE_DIR / 'static' / old_image
-                        if old_path.exists():
-                            old_path.unlink()
+                    discard_question_image(conn, old_image)
                 except Exception:
                     pass
-                conn.execute("UPDATE questions SET text=?, option_a=?, option_b=?, option_c=?, option_d=?, correct_option=?, image_url='' WHERE id=?",
-                             (text, option_a, option_b, option_c, option_d, correct, qid))
             else:
                 # Normal update (no image change)
                 conn.execute("UPDATE questions SET text=?, option_a=?, option_b=?, option_c=?, option_d=?, correct_option=? WHERE id=?",
                              (text, option_a, option_b, option_c, option_d, correct, qid))
 
         conn.commit()
-        conn.close()
         session['success_msg'] = '✅ Question updated'
+        # A changed answer key re-grades the test's stored submissions
+        if row and row['set_type'] == 'main' and (row['correct_option'] or '').strip().lower() != correct:
+            report = regrade_and_refresh(conn, row['test_id'], triggered_by=f'question {qid} key changed')
+            session['success_msg'] = (f"✅ Question updated; re-graded {report['total']} submissions, "
+                                      f"{report['changed']} changed"
+                                      + (f", {len(report['skipped']) + report['archived']} left as graded"
+                                         if report['skipped'] or report['archived'] else ''))
+        dupes = grading.duplicate_options({'a': option_a, 'b': option_b, 'c': option_c, 'd': option_d})
+        if dupes:
+            session['warning_msg'] = f"⚠️ Options {', '.join(k.upper() for k in dupes)} have identical text"
+        conn.close()
     except Exception as e:
         try:
             conn.close()
@@ -521,7 +731,7 @@ def admin_seed_tutorial_images():
     if 'admin_id' not in session:
         return redirect(url_for('admin_login'))
     conn = get_db()
-    test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (CFG['test']['slug'], 'NOVAS')).fetchone()
+    test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (cfg().slug, 'NOVAS')).fetchone()
     if not test:
         conn.close()
         session['error_msg'] = 'Test (NOVAS) not found'
@@ -560,7 +770,7 @@ def admin_questions():
     level_filter = (request.args.get('level') or '').upper()
     type_filter = (request.args.get('type') or '').lower()
 
-    conn = get_db()
+    conn = get_read_db()
 
     # Fetch tutorial questions (shared) and main questions separately.
     tutorial_questions = []
@@ -661,6 +871,7 @@ def admin_import_post():
 
     conn = get_db()
     inserted = 0
+    mail_recipients = []
     for line in lines:
         parts = [p.strip() for p in line.split(',')]
         
@@ -683,8 +894,12 @@ def admin_import_post():
         except sqlite3.IntegrityError:
             # already exists, update password and level
             conn.execute("UPDATE student_credentials SET password_hash=?, level=? WHERE email=?", (pwd_hash, level, email))
+        mail_recipients.append({'email': email, 'context': {'password': password, 'level': level}})
 
     conn.close()
+
+    if request.form.get('email_credentials') and mail_recipients:
+        start_credentials_mail_job(mail_recipients)
     return redirect(url_for('admin_credentials'))
 
 @app.post('/admin/generate-credentials')
@@ -717,6 +932,10 @@ def admin_generate_credentials():
             continue
     
     conn.close()
+
+    if request.form.get('email_credentials') and generated:
+        start_credentials_mail_job([{'email': g['email'], 'context': {'password': g['password'], 'level': 'NOVAS'}}
+                                    for g in generated])
     
     # Return as downloadable CSV
     output = io.StringIO()
@@ -729,16 +948,41 @@ def admin_generate_credentials():
     return send_file(io.BytesIO(output.getvalue().encode('utf-8')), 
                     as_attachment=True, download_name=filename, mimetype='text/csv')
 
+def prepare_papers(conn):
+    """Pre-generate main-test papers for every active credential. Returns papers created."""
+    papers.ensure_schema(conn)
+    created = 0
+    tests = conn.execute("SELECT id, level FROM tests WHERE slug=?", (cfg().slug,)).fetchall()
+    for test in tests:
+        set_row = conn.execute("SELECT id FROM question_sets WHERE test_id=? AND set_type='main'",
+                               (test['id'],)).fetchone()
+        if not set_row:
+            continue
+        qids = [r['question_id'] for r in conn.execute(
+            "SELECT question_id FROM questions WHERE set_id=? ORDER BY id", (set_row['id'],))]
+        if not qids:
+            continue
+        emails = [r['email'] for r in conn.execute(
+            "SELECT email FROM student_credentials WHERE status='active' AND level=?", (test['level'],))]
+        created += papers.generate_papers(conn, test['id'], set_row['id'], qids, emails, PAPER_SEED_SECRET,
+                                          randomize_questions=cfg().randomize_questions,
+                                          randomize_options=cfg().randomize_options)
+    return created
+
 @app.post('/admin/quiz-control')
 def admin_quiz_control():
     if 'admin_id' not in session:
         abort(403)
     
-    action = request.form.get('action')  # 'start' or 'end'
+    action = request.form.get('action')  # 'prepare', 'start' or 'end'
     
     conn = get_db()
-    test = conn.execute("SELECT id FROM tests WHERE slug=?", (CFG['test']['slug'],)).fetchone()
+    test = conn.execute("SELECT id FROM tests WHERE slug=?", (cfg().slug,)).fetchone()
     
+    if action in ('prepare', 'start'):
+        # Build papers before opening the test so /start-real-test is a lookup
+        created = prepare_papers(conn)
+        session['success_msg'] = f'✅ Prepared {created} new papers'
     if action == 'start':
         conn.execute("UPDATE tests SET status=?, start_time=? WHERE id=?",
                     ('active', datetime.now(timezone.utc).isoformat(), test['id']))
@@ -749,6 +993,37 @@ def admin_quiz_control():
     conn.close()
     return redirect(url_for('admin_dashboard'))
 
+@app.post('/admin/config/reload')
+def admin_reload_config():
+    if 'admin_id' not in session:
+        abort(403)
+    before = cfg().version
+    conf = config_store.reload_all()
+    if conf.version != before:
+        session['success_msg'] = f'✅ Configuration reloaded (version {conf.version})'
+    else:
+        session['success_msg'] = f'✅ Configuration unchanged (version {conf.version}); per-test overrides re-read'
+    return redirect(url_for('admin_dashboard'))
+
+@app.get('/admin/metrics')
+def admin_metrics():
+    # Admin session, or a scraper presenting ADMIN_TOKEN as a bearer token
+    auth = request.headers.get('Authorization', '')
+    token_ok = bool(ADMIN_TOKEN) and auth == f'Bearer {ADMIN_TOKEN}'
+    if 'admin_id' not in session and not token_ok:
+        abort(403)
+    body = instrumentation.registry.render_prometheus()
+    body += ''.join(f'quiz_admission_{name} {value}\n' for name, value in admission.metrics().items())
+    body += ''.join(f'quiz_page_cache_{name} {value}\n' for name, value in page_cache.metrics().items())
+    body += f'quiz_config_reloads {config_store.reloads}\n'
+    body += ''.join(f'quiz_backup_{name} {value}\n' for name, value in backup_scheduler.metrics().items())
+    body += ''.join(f'quiz_archive_{name} {value}\n' for name, value in archiver.metrics().items())
+    body += ''.join(f'quiz_writes_{name} {value}\n' for name, value in db_writes.metrics().items())
+    body += ''.join(f'quiz_reads_{name} {value}\n' for name, value in admin_reads.metrics().items())
+    body += ''.join(f'quiz_compression_{name} {value}\n' for name, value in compressor.metrics().items())
+    body += ''.join(f'quiz_analytics_{name} {value}\n' for name, value in analytics_store.metrics().items())
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.get('/admin/logout')
 def admin_logout():
     session.clear()
@@ -787,46 +1062,89 @@ def admin_delete_question():
         session['error_msg'] = f'❌ Failed to delete question: {str(e)[:80]}'
         return redirect(url_for('admin_questions'))
 
-    conn.close()
-
-    # Attempt to delete associated image file if it exists
+    # Attempt to delete associated image file if no other question uses it
     if image_url:
         try:
-            img_path = BASE_DIR / image_url
-            if img_path.exists():
-                img_path.unlink()
+            discard_question_image(conn, image_url)
         except Exception:
             pass
 
+    conn.close()
+
     session['success_msg'] = '✅ Question deleted successfully'
     return redirect(url_for('admin_questions'))
 
 # ===== STUDENT ROUTES =====
 
+def admission_controlled(view):
+    """Run ``view`` only when admitted; otherwise answer with the waiting room.
+
+    The posted form (for ``/login``, the password) is kept in the server-side
+    session under the waiting room's key; the page only posts the key back.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.form.get('admission_ticket')
+        pending = session.get('admission_form')
+        restored = bool(key and pending and pending['key'] == key and pending['path'] == request.path)
+        if restored:
+            fields = [tuple(f) for f in pending['fields']]
+        else:
+            fields = [(k, v) for k, v in request.form.items(multi=True) if k != 'admission_ticket']
+        result = admission.enter(key)
+        if result.state == ADMITTED:
+            if pending is not None:
+                session.pop('admission_form', None)
+            if restored:
+                request.form = ImmutableMultiDict(fields)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                admission.leave()
+        # A shed request has no ticket; admission treats the key as an unknown ticket on retry
+        key = result.ticket or secrets.token_urlsafe(16)
+        session['admission_form'] = {'key': key, 'path': request.path, 'fields': fields}
+        page = render_template('waiting_room.html',
+            app_title=APP_TITLE,
+            test_name=cfg().test_name,
+            ticket=result.ticket,
+            form_key=key,
+            ahead=result.ahead,
+            action=request.path,
+            poll_seconds=admission.poll_seconds)
+        headers = {'Cache-Control': 'no-store'}
+        if result.state == SHED:
+            headers['Retry-After'] = str(int(admission.poll_seconds * 3))
+            return page, 503, headers
+        return page, 202, headers
+    return wrapper
+
+@app.get('/waiting-room/status')
+def admission_status():
+    """Waiting-room poll; one read of the admission queue, nothing in the main database."""
+    result = admission.status(request.args.get('ticket', ''))
+    resp = jsonify(state=result.state, ahead=result.ahead)
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
 @app.get('/login')
 def login():
-    test_status = check_quiz_status()
-    return render_template('login.html',
-        app_title=APP_TITLE,
-        test_name=CFG['test']['name'],
-        logo_path=CFG['branding']['logo_path'],
-        test_status=test_status)
+    return login_page()
 
 @app.post('/login')
+@admission_controlled
 def login_post():
     name_from_form = request.form.get('name', '').strip()
     email = request.form.get('email', '').strip().lower()
     password = request.form.get('password', '').strip()
     
     if not (email and password):
-        return render_template('login.html', app_title=APP_TITLE, test_name=CFG['test']['name'],
-                             error='Email and password required', test_status=check_quiz_status())
+        return login_page(error='Email and password required')
     
     # Check quiz status
     test_status = check_quiz_status()
     if test_status['status'] != 'active':
-        return render_template('login.html', app_title=APP_TITLE, test_name=CFG['test']['name'],
-                             error=f'Quiz is {test_status["status"]}', test_status=test_status)
+        return login_page(error=f'Quiz is {test_status["status"]}', test_status=test_status)
     
     conn = get_db()
     
@@ -836,8 +1154,7 @@ def login_post():
     
     if not cred:
         conn.close()
-        return render_template('login.html', app_title=APP_TITLE, test_name=CFG['test']['name'],
-                             error='Invalid credentials', test_status=test_status)
+        return login_page(error='Invalid credentials', test_status=test_status)
     
     cred_id = cred['id']
     level = cred['level']
@@ -846,47 +1163,39 @@ def login_post():
     
     if not verify_password(password, cred_data['password_hash']):
         conn.close()
-        return render_template('login.html', app_title=APP_TITLE, test_name=CFG['test']['name'],
-                             error='Invalid credentials', test_status=test_status)
-    
-    # If the student provided a name in the form, save it to credentials and respondents
-    final_name = cred_data['name'] or ''
-    if name_from_form:
-        final_name = name_from_form
-        try:
-            conn.execute("UPDATE student_credentials SET name=? WHERE id=?", (final_name, cred_id))
-        except Exception:
-            pass
-
-    # Get or create respondent (sync name)
-    respondent = conn.execute("SELECT id FROM respondents WHERE email=?", (email,)).fetchone()
-    if not respondent:
-        conn.execute("INSERT INTO respondents (email, name, student_id, extra_json) VALUES (?,?,?,?)",
-                    (email, final_name or 'Student', '', json.dumps({})))
-        respondent_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()['id']
-    else:
-        respondent_id = respondent['id']
-        # update respondent name if changed
-        if final_name:
-            try:
-                conn.execute("UPDATE respondents SET name=? WHERE id=?", (final_name, respondent_id))
-            except Exception:
-                pass
+        return login_page(error='Invalid credentials', test_status=test_status)
     
     # Get test for the student's level
-    test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (CFG['test']['slug'], level)).fetchone()
+    test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (cfg().slug, level)).fetchone()
     if not test:
         conn.close()
-        return render_template('login.html', app_title=APP_TITLE, test_name=CFG['test']['name'],
-                             error=f'Quiz not available for your level', test_status=test_status)
+        return login_page(error=f'Quiz not available for your level', test_status=test_status)
     
-    session_token = hashlib.md5(f"{email}{datetime.now(timezone.utc).isoformat()}".encode()).hexdigest()
+    # Rotate the session id on login; it is also the quiz session token.
+    session_token = session.regenerate()
+    final_name = name_from_form or cred_data['name'] or ''
     
-    conn.execute("""
-        INSERT INTO quiz_sessions (quiz_id, student_id, session_token, start_time, status)
-        VALUES (?, ?, ?, ?, 'active')
-    """, (test['id'], respondent_id, session_token, datetime.now(timezone.utc).isoformat()))
+    def record_login(conn):
+        # If the student provided a name in the form, save it to credentials and respondents
+        if name_from_form:
+            conn.execute("UPDATE student_credentials SET name=? WHERE id=?", (final_name, cred_id))
+        # Get or create respondent (sync name)
+        respondent = conn.execute("SELECT id FROM respondents WHERE email=?", (email,)).fetchone()
+        if not respondent:
+            conn.execute("INSERT INTO respondents (email, name, student_id, extra_json) VALUES (?,?,?,?)",
+                        (email, final_name or 'Student', '', json.dumps({})))
+            respondent_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()['id']
+        else:
+            respondent_id = respondent['id']
+            if final_name:
+                conn.execute("UPDATE respondents SET name=? WHERE id=?", (final_name, respondent_id))
+        conn.execute("""
+            INSERT INTO quiz_sessions (quiz_id, student_id, session_token, start_time, status)
+            VALUES (?, ?, ?, ?, 'active')
+        """, (test['id'], respondent_id, session_token, datetime.now(timezone.utc).isoformat()))
+        return respondent_id
     
+    respondent_id = db_writes.run(conn, record_login)
     conn.close()
     
     session['email'] = email
@@ -899,11 +1208,21 @@ def login_post():
     # Go to instructions page
     return redirect(url_for('instructions'))
 
+def login_page(error: str = None, test_status: dict = None):
+    """The login page from the page cache, with ``error`` (if any) filled in."""
+    test_status = test_status or check_quiz_status()
+    return cached_page('login.html', (test_status['status'],),
+        inject={'error': error} if error else None,
+        app_title=APP_TITLE,
+        test_name=cfg().test_name,
+        logo_path=cfg().logo_path,
+        test_status=test_status)
+
 def check_quiz_status():
     """Check current quiz status"""
     conn = get_db()
     test = conn.execute("SELECT status, start_time, end_time FROM tests WHERE slug=?", 
-                       (CFG['test']['slug'],)).fetchone()
+                       (cfg().slug,)).fetchone()
     conn.close()
     
     if not test:
@@ -923,11 +1242,11 @@ def instructions():
     
     level = session.get('level', 'NOVAS')
     
-    return render_template('instructions.html',
+    return cached_page('instructions.html', (level,), private=True,
         app_title=APP_TITLE,
-        test_name=CFG['test']['name'],
-        logo_path=CFG['branding']['logo_path'],
-        instructions=CFG['test']['instructions_html'],
+        test_name=cfg().test_name,
+        logo_path=cfg().logo_path,
+        instructions=cfg().instructions_html,
         level=level)
 
 @app.post('/start-tutorial')
@@ -946,7 +1265,7 @@ def start_tutorial():
 
     # If no populated tutorial set exists for the student's test, fall back to the NOVAS tutorial (shared)
     if not set_row:
-        nov_test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (CFG['test']['slug'], 'NOVAS')).fetchone()
+        nov_test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (cfg().slug, 'NOVAS')).fetchone()
         if nov_test:
             set_row = conn.execute(
                 "SELECT qs.id FROM question_sets qs WHERE qs.test_id=? AND qs.set_type='tutorial' AND EXISTS (SELECT 1 FROM questions q WHERE q.set_id=qs.id) ORDER BY qs.id DESC LIMIT 1",
@@ -967,27 +1286,31 @@ def start_tutorial():
     tutorial_questions = load_questions_for_set(conn, set_row['id'])
     conn.close()
     
-    per_sec = mmss_to_seconds(CFG['test']['per_question_time_mmss'])
-    
     return render_template('tutorial.html',
         app_title=APP_TITLE,
-        test_name=CFG['test']['name'],
-        per_question_seconds=per_sec,
+        test_name=cfg().test_name,
+        per_question_seconds=cfg().per_question_seconds,
         questions=tutorial_questions)
 
 @app.post('/tutorial-completed')
 def tutorial_completed():
+    return quiz_entry()
+
+@app.get('/start-real-test')
+def quiz_entry():
+    """The page that starts the real test; the quiz page comes back here (by GET) when its paper is gone."""
     if 'respondent_id' not in session:
         return redirect(url_for('login'))
     
     level = session.get('level', 'NOVAS')
-    return render_template('quiz_start.html',
+    return cached_page('quiz_start.html', (level,), private=True,
         app_title=APP_TITLE,
-        test_name=CFG['test']['name'],
-        logo_path=CFG['branding']['logo_path'],
+        test_name=cfg().test_name,
+        logo_path=cfg().logo_path,
         level=level)
 
 @app.post('/start-real-test')
+@admission_controlled
 def start_real_test():
     if 'respondent_id' not in session:
         return redirect(url_for('login'))
@@ -1020,56 +1343,116 @@ def start_real_test():
         set_row = conn.execute("SELECT id FROM question_sets WHERE test_id=? AND set_type='main'", 
                               (test_id,)).fetchone()
     
-    questions = load_questions_for_set(conn, set_row['id'])
-    
-    # Build randomization
+    key = answer_keys.get(conn, set_row['id'])
+    questions = key.questions
     attempt_no = 1
-    q_ids = [q['id'] for q in questions]
-    q_order = q_ids[:]
-    if CFG['test']['randomize_questions']:
-        random.shuffle(q_order)
-    
-    options_order = {}
-    if CFG['test']['randomize_options']:
-        for q in questions:
-            opts = ['a', 'b', 'c', 'd']
-            random.shuffle(opts)
-            options_order[q['id']] = opts
-    else:
-        for q in questions:
-            options_order[q['id']] = ['a', 'b', 'c', 'd']
-    
-    conn.execute("""
-        INSERT INTO randomization_maps (test_id, respondent_id, attempt_no, q_order_json, options_order_json)
-        VALUES (?, ?, ?, ?, ?)
-    """, (test_id, respondent_id, attempt_no, json.dumps(q_order), json.dumps(options_order)))
+    conf = test_settings(conn, test_id)
+
+    # A re-sit (reactivated credential) reuses the attempt key; start its leave count afresh
+    attempt = (test_id, respondent_id, attempt_no)
+    if proctor.attempt_closed(conn, attempt):
+        proctor.flush()
+        db_writes.run(conn, proctor.reopen_attempt, attempt)
+
+    # Use the paper prepared when the sitting was armed; issue one if it is
+    # missing or was built for a different version of the question set.
+    paper = papers.fetch_paper(conn, test_id, email, attempt_no) if email else None
+    built = papers.materialize(paper, questions) if paper and paper['set_id'] == set_row['id'] else None
+    if not built:
+        paper = db_writes.run(conn, papers.issue_paper, test_id, set_row['id'], [q['id'] for q in questions],
+                              email or f'respondent:{respondent_id}', PAPER_SEED_SECRET,
+                              randomize_questions=conf.randomize_questions,
+                              randomize_options=conf.randomize_options,
+                              attempt_no=attempt_no)
+        built = papers.materialize(paper, questions)
+    q_order, options_order = built
     
     conn.close()
     
-    session['q_order'] = q_order
-    session['options_order'] = options_order
+    # Only the seed travels with the session; grading rebuilds the order from it
+    session['paper'] = paper
     session['attempt_no'] = attempt_no
     session['started_at'] = datetime.now(timezone.utc).isoformat()
     
-    per_sec = mmss_to_seconds(CFG['test']['per_question_time_mmss'])
-    
-    # Materialize questions
-    ordered = []
-    mapping = {q['id']: q for q in questions}
-    for qid in q_order:
-        q = mapping[qid]
-        opts_keys = options_order[qid]
-        opts_texts = [q['options'][k] for k in opts_keys]
-        ordered.append({'id': qid, 'text': q['text'], 'image_url': q.get('image_url'), 'options': opts_texts})
-    
+    # Only the first question is inlined; the page fetches the rest from quiz_questions
     return render_template('quiz.html',
         app_title=APP_TITLE,
-        test_name=CFG['test']['name'],
-        logo_path=CFG['branding']['logo_path'],
-        per_question_seconds=per_sec,
-        max_tab_leaves=3,
-        violation_action=CFG['test']['anti_cheat']['action'],
-        questions=ordered)
+        test_name=conf.test_name,
+        logo_path=conf.logo_path,
+        per_question_seconds=conf.per_question_seconds,
+        max_tab_leaves=conf.max_tab_leaves,
+        violation_action=conf.violation_action,
+        total_questions=len(q_order),
+        first_batch=question_batch(key, q_order, options_order, 0, 1))
+
+QUESTION_WINDOW = 5  # most questions one /quiz/questions call returns
+
+
+def question_batch(key, q_order, options_order, start, count):
+    """JSON-ready questions ``start``..``start+count-1`` of a paper plus the next image to prefetch."""
+    questions = []
+    for i in range(start, min(start + count, len(q_order))):
+        qid = q_order[i]
+        q = key.questions[key.index[qid]]
+        image = q.get('image_url')
+        questions.append({
+            'index': i,
+            'id': qid,
+            'text': q['text'],
+            # 1x variant as src, 1x/2x variants for the browser to pick from
+            'image_url': question_image(image, 'small') if image else None,
+            'image_srcset': question_image_srcset(image) if image else '',
+            # (token, text) pairs; the page posts the token
+            'options': [[token, text] for token, text in key.display_options(qid, options_order[qid]) if text],
+        })
+    prefetch = []
+    following = start + count
+    if following < len(q_order):
+        image = key.questions[key.index[q_order[following]]].get('image_url')
+        if image:
+            prefetch.append({'src': question_image(image, 'small'), 'srcset': question_image_srcset(image)})
+    return {'total': len(q_order), 'questions': questions, 'prefetch': prefetch}
+
+
+@app.get('/quiz/questions')
+def quiz_questions():
+    """Serve the session's paper a window at a time (``?start=i&count=n``)."""
+    paper = session.get('paper')
+    test_id = session.get('test_id')
+    if not paper or not test_id:
+        return jsonify(error='no active paper'), 401
+    try:
+        start = int(request.args.get('start', 0))
+        count = min(max(int(request.args.get('count', 1)), 1), QUESTION_WINDOW)
+    except ValueError:
+        return jsonify(error='bad range'), 400
+
+    conn = get_db()
+    quiz = conn.execute("SELECT status FROM tests WHERE id=?", (test_id,)).fetchone()
+    if not quiz or quiz['status'] != 'active':
+        conn.close()
+        return jsonify(error='Quiz has ended'), 409
+    attempt = (test_id, session.get('respondent_id'), session.get('attempt_no', 1))
+    if proctor.auto_submitted_at(conn, attempt) is not None:
+        leaves = proctor.leave_count(conn, attempt)
+        conn.close()
+        return jsonify(error='The test was submitted automatically', action='submit', leaves=leaves), 409
+    key = answer_keys.get(conn, paper['set_id'])
+    conn.close()
+
+    built = papers.materialize(paper, key.questions) if key else None
+    if not built:
+        return jsonify(error='The question set changed during the test'), 409
+    q_order, options_order = built
+    if not 0 <= start < len(q_order):
+        return jsonify(error='bad range'), 400
+
+    batch = question_batch(key, q_order, options_order, start, count)
+    resp = jsonify(batch)
+    resp.headers['Cache-Control'] = 'no-store'
+    for image in batch['prefetch']:
+        resp.headers.add('Link', f"<{image['src']}>; rel=prefetch; as=image")
+    return resp
 
 # Helpers for import & load
 
@@ -1098,6 +1481,7 @@ def import_file_to_set(conn, test_id: int, set_type: str, path: Path):
 
 
 
+@timed('load_questions_for_set')
 def load_questions_for_set(conn, set_id: int):
     rows = conn.execute("""
         SELECT question_id, text, image_url, option_a, option_b, option_c, option_d, correct_option 
@@ -1120,19 +1504,102 @@ def load_questions_for_set(conn, set_id: int):
         qlist.append(q)
     return qlist
 
+# Compiled answer keys, recompiled when a set's questions change
+answer_keys = grading.AnswerKeyCache(load_questions_for_set, salt=PAPER_SEED_SECRET)
+analytics_store = analytics.AnswerMatrixStore(ANALYTICS_DIR)
+
+
+def main_answer_key(conn, test_id: int):
+    set_row = conn.execute("SELECT id FROM question_sets WHERE test_id=? AND set_type='main'", (test_id,)).fetchone()
+    return answer_keys.get(conn, set_row['id']) if set_row else None
+
+
+def load_details(conn, value):
+    """A stored ``details_json`` as the grader's details list, texts filled in as they were graded."""
+    return details_codec.decode(value, lambda digest: details_codec.load_snapshot(conn, digest))
+
+
+def graded_with_key(value, key):
+    """Whether a stored ``details_json`` was graded against exactly ``key``.
+
+    True when it references ``key``'s text snapshot, answers every question
+    of the set with the key's correct option and keeps no text of its own,
+    so the answer matrix and ``key`` reproduce it.
+    """
+    try:
+        set_id, snap, details = details_codec.unpack(value)
+    except (ValueError, TypeError, KeyError):
+        return False
+    if set_id != key.set_id or snap != details_codec.snapshot(key)[0] or len(details) != len(key.by_qid):
+        return False
+    by_qid = key.by_qid
+    return all(d['qid'] in by_qid and d['correct_key'] == by_qid[d['qid']].correct
+               and d['text'] is None and d['given_text'] is None for d in details)
+
+
+def load_answer_matrix(conn, test_id: int):
+    """Answer matrix of a test (columns = its main set), or None if it has no main set."""
+    key = main_answer_key(conn, test_id)
+    if key is None:
+        return None, None
+    return analytics_store.load(conn, test_id, [q['id'] for q in key.questions]), key
+
 @app.get('/blocked')
 def blocked():
     reason = request.args.get('reason', 'Policy violation detected')
     return render_template('blocked.html', app_title=APP_TITLE, reason=reason)
 
-@app.post('/'+CFG['test']['slug']+'/submit')
+@app.post('/quiz/events')
+def quiz_events():
+    """Anti-cheat event beacon. Returns the server's leave count and decision."""
+    respondent_id = session.get('respondent_id')
+    test_id = session.get('test_id')
+    if not respondent_id or not test_id:
+        return jsonify(error='no active attempt'), 401
+    if (request.content_length or 0) > 8192:
+        return jsonify(error='batch too large'), 413
+
+    attempt = (test_id, respondent_id, session.get('attempt_no', 1))
+    proctor.record(attempt, proctoring.parse_batch(request.get_data()))
+
+    conn = get_db()
+    conf = test_settings(conn, test_id)
+    leaves = proctor.leave_count(conn, attempt)
+    action = 'ok'
+    if leaves > conf.max_tab_leaves and conf.violation_action == 'auto_submit':
+        proctor.mark_auto_submitted(conn, attempt)
+        action = 'submit'
+    conn.close()
+    return jsonify(leaves=leaves, max=conf.max_tab_leaves, action=action)
+
+def record_submission(conn, row, key):
+    """Insert a graded submission, mark the student's credential used and close the proctored attempt.
+
+    ``row``'s details were encoded against ``key``, whose text snapshot is
+    saved with it. A write unit for db_writes.run.
+    """
+    details_codec.save_snapshot(conn, key)
+    conn.execute("""
+        INSERT INTO submissions (test_id, respondent_id, attempt_no, score, total_points, started_at, 
+                                finished_at, violations_count, violation_reason, details_json, needs_regrade)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, row)
+    submission_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()['id']
+    conn.execute("""
+        UPDATE student_credentials SET status='used'
+        WHERE email=(SELECT email FROM respondents WHERE id=?)
+    """, (row[1],))
+    proctor.close_attempt(conn, row[:3])
+    return submission_id
+
+
+@app.post(cfg().submit_path)
 def submit_quiz():
     respondent_id = session.get('respondent_id')
     test_id = session.get('test_id')
-    q_order = session.get('q_order')
-    options_order = session.get('options_order')
+    paper = session.get('paper')
     
-    if not all([respondent_id, test_id, q_order, options_order]):
+    if not all([respondent_id, test_id, paper or session.get('q_order')]):
         return redirect(url_for('login'))
     
     conn = get_db()
@@ -1147,69 +1614,64 @@ def submit_quiz():
     # Get main questions
     set_row = conn.execute("SELECT id FROM question_sets WHERE test_id=? AND set_type='main'", 
                           (test_id,)).fetchone()
-    questions = load_questions_for_set(conn, set_row['id'])
-    mapping = {q['id']: q for q in questions}
-    
-    score = 0.0
-    total_points = float(len(q_order))
-    details = []
-    
-    for qid in q_order:
-        q = mapping[qid]
-        opts_keys = options_order[qid]
-        opts_texts = [q['options'][k] for k in opts_keys]
-        given_text = request.form.get(qid, '').strip()
-        
-        given_key = None
-        for i, t in enumerate(opts_texts):
-            if t == given_text:
-                given_key = opts_keys[i]
-                break
-        
-        correct = (given_key == q['correct'])
-        if correct:
-            score += 1
-        
-        details.append({
-            'qid': qid,
-            'text': q['text'],
-            'given_text': given_text,
-            'given_key': given_key,
-            'correct_key': q['correct'],
-            'correct': correct
-        })
-    
-    violations = int(request.form.get('violations', '0') or 0)
-    violation_reason = request.form.get('violation_reason', '')
+    key = answer_keys.get(conn, set_row['id'])
     
-    now = datetime.now(timezone.utc)
-    conn.execute("""
-        INSERT INTO submissions (test_id, respondent_id, attempt_no, score, total_points, started_at, 
-                                finished_at, violations_count, violation_reason, details_json)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (test_id, respondent_id, 1, score, total_points, session.get('started_at', now.isoformat()),
-          now.isoformat(), violations, violation_reason, json.dumps(details)))
+    needs_regrade = 0
+    if paper:
+        built = papers.materialize(paper, key.questions) if paper['set_id'] == set_row['id'] else None
+        q_order = built[0] if built else None
+    else:
+        # Sessions started before seeded papers carry the full order
+        q_order = session.get('q_order')
     
-    submission_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()['id']
+    if q_order:
+        total_points = float(len(q_order))
+        score, details = key.grade(q_order, request.form)
+    else:
+        # The set changed during the sitting: keep the posted answers and flag them for re-grading
+        total_points = float(paper['question_count'])
+        score, details = key.grade_posted(request.form, paper['set_id'], answer_keys.salt)
+        needs_regrade = 1
+    
+    # Leaves are counted server-side from the event beacons, not taken from the form
+    attempt = (test_id, respondent_id, session.get('attempt_no', 1))
+    violations = proctor.leave_count(conn, attempt)
+    conf = test_settings(conn, test_id)
+    max_leaves = conf.max_tab_leaves
+    violation_reason = (f'Auto-submitted due to tab switching violations (exceeded limit of {max_leaves})'
+                        if violations > max_leaves else '')
     
-    # Mark credential as used
-    respondent = conn.execute("SELECT email FROM respondents WHERE id=?", (respondent_id,)).fetchone()
-    conn.execute("UPDATE student_credentials SET status='used' WHERE email=?", (respondent['email'],))
+    now = datetime.now(timezone.utc)
+    # The page is told to submit at once; answers that come much later were changed after the cutoff
+    cutoff = proctor.auto_submitted_at(conn, attempt)
+    if cutoff is not None and (now - cutoff).total_seconds() > proctoring.AUTO_SUBMIT_GRACE_SECONDS:
+        late = (now - cutoff).total_seconds()
+        violation_reason = '; '.join(filter(None, [
+            violation_reason,
+            f'Answers posted {late:.0f}s after the auto-submission at {cutoff.isoformat(timespec="seconds")}']))
+    submission_id = db_writes.run(conn, record_submission, (
+        test_id, respondent_id, 1, score, total_points, session.get('started_at', now.isoformat()),
+        now.isoformat(), violations, violation_reason, details_codec.encode(details, key), needs_regrade), key)
+    try:
+        analytics_store.append(conn, test_id, submission_id, score, details, [q['id'] for q in key.questions])
+    except Exception as e:
+        # The admin pages rebuild the store from the DB on their next read
+        print('[ANALYTICS] append failed:', e)
     
     conn.close()
     
     percent = (score / total_points) * 100.0
-    grade, desc = grade_from_percent(percent)
+    grade, desc = conf.grade_for(percent)
     
     # Generate certificate
     respondent_name_val = session.get('name', 'Student')
     if not respondent_name_val:
         respondent_name_val = 'Student'
-    cert_path = BASE_DIR / f"certificate_{submission_id}_{respondent_id}.pdf"
+    cert_path = PDF_DIR / f"certificate_{submission_id}_{respondent_id}.pdf"
     generate_certificate(cert_path, respondent_id, submission_id, score, total_points, percent, grade, desc, respondent_name_val)
     
     # Generate detailed results PDF
-    results_path = BASE_DIR / f"results_{submission_id}_{respondent_id}.pdf"
+    results_path = PDF_DIR / f"results_{submission_id}_{respondent_id}.pdf"
     generate_results_pdf(results_path, submission_id, respondent_id, respondent_name_val, details, score, 
                         total_points, percent, grade, desc)
     
@@ -1218,10 +1680,9 @@ def submit_quiz():
     # Do NOT expose scores or downloadable certificates/results to students.
     # Certificates and detailed results are generated and stored on the server
     # but can only be downloaded by an admin via the admin dashboard.
-    end_msg = CFG['test']['end_message_html']
     return render_template('thankyou.html',
         app_title=APP_TITLE,
-        end_message=end_msg,
+        end_message=conf.end_message_html,
         cert_ready=False)
 
 # Certificate generation
@@ -1233,6 +1694,7 @@ def respondent_name(conn, respondent_id):
     return 'Respondent'
 
 
+@timed('generate_certificate')
 def generate_certificate(path: Path, respondent_id: int, submission_id: int, score: float, total: float, percent: float, grade: str, desc: str, name: str = 'Student'):
     """Generate a professional A4 landscape certificate PDF.
 
@@ -1295,8 +1757,7 @@ def generate_certificate(path: Path, respondent_id: int, submission_id: int, sco
     logo_h = 26*mm
     logo_w = 70*mm
     try:
-        logo_path_cfg = CFG.get('branding', {}).get('logo_path') if CFG else None
-        logo_path = ASSETS_DIR / Path(logo_path_cfg).name if logo_path_cfg else ASSETS_DIR / 'logo.png'
+        logo_path = cfg().logo_file
         if logo_path.exists():
             logo = ImageReader(str(logo_path))
             c.drawImage(logo, (width - logo_w)/2, height - outer_margin - logo_h - 6*mm, width=logo_w, height=logo_h, preserveAspectRatio=True, mask='auto')
@@ -1328,7 +1789,7 @@ def generate_certificate(path: Path, respondent_id: int, submission_id: int, sco
     c.drawCentredString(width/2, height/2 + 8*mm, recipient)
 
     # Body paragraph
-    body = CFG.get('branding', {}).get('certificate', {}).get('paragraph1') or (
+    body = cfg().get('branding', {}).get('certificate', {}).get('paragraph1') or (
         'This certificate is proudly presented in recognition of exceptional achievement and steadfast dedication to academic excellence.'
     )
     style = ParagraphStyle('certBody', fontName='Helvetica', fontSize=12, leading=16, alignment=1, textColor=colors.HexColor('#333333'))
@@ -1352,16 +1813,14 @@ def generate_certificate(path: Path, respondent_id: int, submission_id: int, sco
 
     # Optional signature images
     try:
-        left_sig_cfg = CFG.get('branding', {}).get('certificate', {}).get('signature_left_path')
-        right_sig_cfg = CFG.get('branding', {}).get('certificate', {}).get('signature_right_path')
+        left_sig = cfg().signature_left_file
+        right_sig = cfg().signature_right_file
         sig_h = 18*mm
         sig_w = 40*mm
-        if left_sig_cfg:
-            left_sig = ASSETS_DIR / Path(left_sig_cfg).name
+        if left_sig:
             if left_sig.exists():
                 c.drawImage(ImageReader(str(left_sig)), outer_margin + 8*mm, sign_y + 3*mm, width=sig_w, height=sig_h, mask='auto')
-        if right_sig_cfg:
-            right_sig = ASSETS_DIR / Path(right_sig_cfg).name
+        if right_sig:
             if right_sig.exists():
                 c.drawImage(ImageReader(str(right_sig)), width - outer_margin - 8*mm - sig_w, sign_y + 3*mm, width=sig_w, height=sig_h, mask='auto')
     except Exception:
@@ -1404,7 +1863,7 @@ def generate_certificate(path: Path, respondent_id: int, submission_id: int, sco
     # Footer small print
     c.setFillColor(colors.HexColor('#666666'))
     c.setFont('Helvetica', 8)
-    footer_text = CFG.get('branding', {}).get('certificate', {}).get('footnote') or '© Institution Name • All rights reserved'
+    footer_text = cfg().get('branding', {}).get('certificate', {}).get('footnote') or '© Institution Name • All rights reserved'
     c.drawCentredString(width/2, 6*mm, footer_text)
 
     c.showPage()
@@ -1412,9 +1871,15 @@ def generate_certificate(path: Path, respondent_id: int, submission_id: int, sco
 
 
 
+@timed('generate_results_pdf')
 def generate_results_pdf(path: Path, submission_id: int, respondent_id: int, name: str, details: list, 
                         score: float, total: float, percent: float, grade: str, desc: str):
     """Generate detailed results PDF with all questions and answers"""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+
     doc = SimpleDocTemplate(str(path), pagesize=A4)
     styles = getSampleStyleSheet()
     story = []
@@ -1481,36 +1946,50 @@ def download_certificate(submission_id, respondent_id):
     if 'admin_id' not in session:
         abort(403)
 
-    conn = get_db()
+    conn = get_read_db()
     respondent = conn.execute("SELECT name FROM respondents WHERE id=?", (respondent_id,)).fetchone()
+    # Like results PDFs, a certificate dropped by re-grading is rebuilt on demand
+    path = ensure_certificate(conn, submission_id) if respondent else None
     conn.close()
 
-    if not respondent:
-        abort(404)
-
-    path = BASE_DIR / f"certificate_{submission_id}_{respondent_id}.pdf"
-    if not path.exists():
+    if not respondent or not path or path.name != f"certificate_{submission_id}_{respondent_id}.pdf":
         abort(404)
 
     name_safe = (respondent['name'] or 'Student').replace(' ', '_')
     filename = f"{name_safe}_Certificate_{submission_id}.pdf"
     return send_file(str(path), as_attachment=True, download_name=filename)
 
+def ensure_results_pdf(conn, submission_id: int):
+    """Return the results PDF path for a submission, generating it from the stored answers if missing."""
+    sub = conn.execute("""
+        SELECT s.id, s.test_id, s.respondent_id, s.score, s.total_points, s.details_json, r.name
+        FROM submissions s JOIN respondents r ON s.respondent_id = r.id
+        WHERE s.id = ?
+    """, (submission_id,)).fetchone()
+    if not sub:
+        return None
+    path = PDF_DIR / f"results_{sub['id']}_{sub['respondent_id']}.pdf"
+    if not path.exists():
+        percent = (sub['score'] / sub['total_points'] * 100) if sub['total_points'] else 0
+        grade, desc = grade_from_percent(percent, conn, sub['test_id'])
+        generate_results_pdf(path, sub['id'], sub['respondent_id'], sub['name'] or 'Student',
+                             load_details(conn, sub['details_json']), sub['score'], sub['total_points'],
+                             percent, grade, desc)
+    return path
+
 @app.get('/download/results/<int:submission_id>/<int:respondent_id>')
 def download_results(submission_id, respondent_id):
     # Only admins can download detailed results
     if 'admin_id' not in session:
         abort(403)
 
-    conn = get_db()
+    conn = get_read_db()
     respondent = conn.execute("SELECT name FROM respondents WHERE id=?", (respondent_id,)).fetchone()
+    # Re-grading drops the cached PDF; it is rebuilt from the stored answers
+    path = ensure_results_pdf(conn, submission_id) if respondent else None
     conn.close()
 
-    if not respondent:
-        abort(404)
-
-    path = BASE_DIR / f"results_{submission_id}_{respondent_id}.pdf"
-    if not path.exists():
+    if not respondent or not path or path.name != f"results_{submission_id}_{respondent_id}.pdf":
         abort(404)
 
     name_safe = (respondent['name'] or 'Student').replace(' ', '_')
@@ -1615,9 +2094,9 @@ def admin_approve_questions():
     try:
         # Get test for selected level
         if set_type == 'tutorial':
-            test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (CFG['test']['slug'], 'NOVAS')).fetchone()
+            test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (cfg().slug, 'NOVAS')).fetchone()
         else:
-            test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (CFG['test']['slug'], level)).fetchone()
+            test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (cfg().slug, level)).fetchone()
         
         if not test:
             conn.close()
@@ -1699,7 +2178,7 @@ def admin_upload(set_type):
     conn = get_db()
     # Get test for the selected level
     test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", 
-                       (CFG['test']['slug'], level)).fetchone()
+                       (cfg().slug, level)).fetchone()
     
     if not test:
         conn.close()
@@ -1769,12 +2248,8 @@ def admin_add_question():
     image_url = ''
     try:
         if image_file and image_file.filename:
-            img_dir = ASSETS_DIR / 'question_images'
-            img_dir.mkdir(parents=True, exist_ok=True)
-            fname = f"qimg_{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')}_{image_file.filename}"
-            save_path = img_dir / fname
-            image_file.save(str(save_path))
-            image_url = str(save_path.relative_to(BASE_DIR))
+            fname = images.store_image(image_file.read(), image_file.filename, QUESTION_IMAGES_DIR)
+            image_url = f"assets/question_images/{fname}"
     except Exception as e:
         session['warning_msg'] = f'⚠️ Image upload failed: {str(e)[:50]}'
         image_url = ''
@@ -1784,9 +2259,9 @@ def admin_add_question():
     # For tutorial: use first test (shared across all levels)
     # For main: use test for selected level
     if set_type == 'tutorial':
-        test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (CFG['test']['slug'], 'NOVAS')).fetchone()
+        test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (cfg().slug, 'NOVAS')).fetchone()
     else:
-        test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (CFG['test']['slug'], level)).fetchone()
+        test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", (cfg().slug, level)).fetchone()
     
     if not test:
         conn.close()
@@ -1823,10 +2298,10 @@ def admin_submission_details(submission_id):
     if 'admin_id' not in session:
         abort(403)
     
-    conn = get_db()
+    conn = get_read_db()
     submission = conn.execute("""
-        SELECT s.id, s.respondent_id, s.score, s.total_points, s.violations_count, s.violation_reason,
-               s.started_at, s.finished_at, s.details_json, r.name, r.email
+        SELECT s.id, s.test_id, s.respondent_id, s.score, s.total_points, s.violations_count, s.violation_reason,
+               s.started_at, s.finished_at, s.details_json, s.needs_regrade, r.name, r.email
         FROM submissions s
         JOIN respondents r ON s.respondent_id = r.id
         WHERE s.id = ?
@@ -1836,16 +2311,12 @@ def admin_submission_details(submission_id):
         conn.close()
         abort(404)
     
-    try:
-        details = json.loads(submission['details_json'])
-    except:
-        details = []
+    details = load_details(conn, submission['details_json'])
+    percent = (submission['score'] / submission['total_points'] * 100) if submission['total_points'] > 0 else 0
+    grade, desc = grade_from_percent(percent, conn, submission['test_id'])
     
     conn.close()
     
-    percent = (submission['score'] / submission['total_points'] * 100) if submission['total_points'] > 0 else 0
-    grade, desc = grade_from_percent(percent)
-    
     return render_template('submission_details.html',
         app_title=APP_TITLE,
         submission=submission,
@@ -1859,7 +2330,7 @@ def export_csv():
     if 'admin_id' not in session:
         abort(403)
     
-    conn = get_db()
+    conn = get_read_db()
     rows = conn.execute("""
         SELECT s.id, r.name, r.student_id, r.email, s.score, s.total_points, s.violations_count, 
                s.violation_reason, s.finished_at
@@ -1878,7 +2349,7 @@ def export_csv():
                         r['violations_count'], r['violation_reason'] or '', r['finished_at']])
     
     output.seek(0)
-    filename = f"{CFG['test']['slug']}_submissions_{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.csv"
+    filename = f"{cfg().slug}_submissions_{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.csv"
     return send_file(io.BytesIO(output.getvalue().encode('utf-8-sig')), 
                     as_attachment=True, download_name=filename, mimetype='text/csv')
 
@@ -1887,15 +2358,14 @@ def export_excel():
     if 'admin_id' not in session:
         abort(403)
     
-    conn = get_db()
+    conn = get_read_db()
     rows = conn.execute("""
-        SELECT s.id, r.name, r.student_id, r.email, s.score, s.total_points, s.violations_count, 
+        SELECT s.id, s.test_id, r.name, r.student_id, r.email, s.score, s.total_points, s.violations_count, 
                s.violation_reason, s.finished_at, s.details_json
         FROM submissions s 
         JOIN respondents r ON s.respondent_id=r.id 
         ORDER BY s.finished_at ASC
     """).fetchall()
-    conn.close()
     
     summary = [{
         'submission_id': r['id'], 'name': r['name'], 'student_id': r['student_id'], 'email': r['email'],
@@ -1903,21 +2373,48 @@ def export_excel():
         'violation_reason': r['violation_reason'] or '', 'finished_at': r['finished_at']
     } for r in rows]
     
+    # Answers graded against their test's current key come from the answer
+    # matrix; all others (earlier or edited sets, lost papers) from the stored
+    # details, with the texts and correct options they were graded against
+    current = {}
+    for t in conn.execute("SELECT id FROM tests WHERE slug=? ORDER BY id", (cfg().slug,)).fetchall():
+        matrix, key = load_answer_matrix(conn, t['id'])
+        if matrix is not None and len(matrix):
+            current[t['id']] = (matrix, key, set())
     answers = []
     for r in rows:
-        try:
-            det = json.loads(r['details_json'])
-        except:
-            det = []
-        for a in det:
+        entry = current.get(r['test_id'])
+        if entry is not None and graded_with_key(r['details_json'], entry[1]):
+            entry[2].add(r['id'])
+            continue
+        for a in load_details(conn, r['details_json']):
             answers.append({
                 'submission_id': r['id'], 'question_id': a.get('qid'), 'question': a.get('text'),
-                'given_key': a.get('given_key'), 'given_text': a.get('given_text'), 
+                'given_key': a.get('given_key'), 'given_text': a.get('given_text'),
                 'correct_key': a.get('correct_key'), 'correct': 'Yes' if a.get('correct') else 'No'
             })
+    answer_frames = [pd.DataFrame(answers)] if answers else []
+    for matrix, key, ids in current.values():
+        rows_idx, cols_idx = np.nonzero(matrix.present & np.isin(matrix.submission_ids, list(ids))[:, None])
+        qks = [key.by_qid[qid] for qid in matrix.qids]
+        given = np.array(analytics.OPTION_LETTERS)[matrix.chosen[rows_idx, cols_idx]]
+        answer_frames.append(pd.DataFrame({
+            'submission_id': np.asarray(matrix.submission_ids)[rows_idx],
+            'question_id': [matrix.qids[j] for j in cols_idx],
+            'question': [qks[j].text for j in cols_idx],
+            'given_key': [g or None for g in given],
+            'given_text': [qks[j].texts.get(g, '') for j, g in zip(cols_idx, given)],
+            'correct_key': [qks[j].correct for j in cols_idx],
+            'correct': np.where(matrix.correct[rows_idx, cols_idx], 'Yes', 'No'),
+        }))
+    conn.close()
     
     df_summary = pd.DataFrame(summary)
-    df_answers = pd.DataFrame(answers)
+    df_answers = pd.concat(answer_frames, ignore_index=True) if answer_frames else pd.DataFrame()
+    if not df_answers.empty:
+        # Submissions in the order of the Submissions sheet, each one's answers together
+        order = {r['id']: i for i, r in enumerate(rows)}
+        df_answers = df_answers.iloc[np.argsort(df_answers['submission_id'].map(order).to_numpy(), kind='stable')]
     
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as w:
@@ -1925,11 +2422,11 @@ def export_excel():
         if not df_answers.empty:
             df_answers.to_excel(w, index=False, sheet_name='Answers')
         meta = pd.DataFrame({'key': ['test_slug', 'generated_at'], 
-                           'value': [CFG['test']['slug'], datetime.now(timezone.utc).isoformat()]})
+                           'value': [cfg().slug, datetime.now(timezone.utc).isoformat()]})
         meta.to_excel(w, index=False, sheet_name='Meta')
     
     output.seek(0)
-    filename = f"{CFG['test']['slug']}_submissions_{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.xlsx"
+    filename = f"{cfg().slug}_submissions_{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.xlsx"
     return send_file(output, as_attachment=True, download_name=filename, 
                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
@@ -1939,7 +2436,7 @@ def admin_submissions():
     if 'admin_id' not in session:
         return redirect(url_for('admin_login'))
     
-    conn = get_db()
+    conn = get_read_db()
     
     # Get all submissions with respondent and student info
     submissions = conn.execute("""
@@ -1979,13 +2476,96 @@ def admin_submissions():
         submissions=results)
 
 
+@app.get('/admin/analytics')
+def admin_analytics():
+    """Cohort analytics per level, computed from the answer matrices"""
+    if 'admin_id' not in session:
+        return redirect(url_for('admin_login'))
+    
+    conn = get_read_db()
+    tests = conn.execute("SELECT id, level FROM tests WHERE slug=? ORDER BY id", (cfg().slug,)).fetchall()
+    test_id = request.args.get('test_id', type=int) or (tests[0]['id'] if tests else None)
+    matrix, key = load_answer_matrix(conn, test_id) if test_id else (None, None)
+    flags = collusion.flags_for_test(conn, test_id) if test_id else []
+    conf = test_settings(conn, test_id) if test_id else cfg()
+    conn.close()
+    
+    summary, questions, grades, wrong = None, [], [], None
+    if matrix is not None and len(matrix):
+        percents = matrix.percents()
+        summary = {
+            'count': len(matrix),
+            'mean': round(float(percents.mean()), 1),
+            'median': round(float(np.median(percents)), 1),
+            'min': round(float(percents.min()), 1),
+            'max': round(float(percents.max()), 1),
+        }
+        # Grade bands, highest threshold first (same rules as certificates)
+        remaining = np.ones(len(percents), dtype=bool)
+        for rule in conf.grades:
+            in_band = remaining & (percents >= rule.min_percent)
+            grades.append({'grade': rule.grade, 'desc': rule.desc, 'count': int(in_band.sum())})
+            remaining &= ~in_band
+        fallback_grade, fallback_desc = settings.FALLBACK_GRADE
+        grades.append({'grade': fallback_grade, 'desc': fallback_desc, 'count': int(remaining.sum())})
+        for stat in matrix.question_stats():
+            qk = key.by_qid[stat['qid']]
+            questions.append(dict(stat, text=qk.text, correct_key=qk.correct))
+        qid = request.args.get('q')
+        if qid in matrix.qids:
+            wrong = {'qid': qid, 'submission_ids': matrix.wrong_on(qid)}
+    
+    return render_template('admin_analytics.html', app_title=APP_TITLE, tests=tests, test_id=test_id,
+                           summary=summary, grades=grades, questions=questions, wrong=wrong, flags=flags)
+
+
+def run_collusion_check(conn, test_id: int):
+    """Detect similar wrong-answer patterns in a test and store the flagged pairs."""
+    matrix, _ = load_answer_matrix(conn, test_id)
+    if matrix is None:
+        return {'submissions': 0, 'flagged': 0}
+    flags, stats = collusion.detect(matrix, **cfg().get('collusion', {}))
+    collusion.save_flags(conn, test_id, flags)
+    print(f"[COLLUSION] test {test_id}: {stats['flagged']} pairs flagged from {stats['candidates']} candidates, "
+          f"{stats['eligible']}/{stats['submissions']} submissions eligible")
+    return stats
+
+
+@app.post('/admin/collusion')
+def admin_collusion_post():
+    if 'admin_id' not in session:
+        abort(403)
+    test_id = request.form.get('test_id', type=int)
+    conn = get_db(archives=True)
+    if test_id:
+        test_ids = [test_id]
+    else:
+        test_ids = [r['id'] for r in conn.execute("SELECT id FROM tests WHERE slug=?", (cfg().slug,))]
+    flagged = sum(run_collusion_check(conn, tid)['flagged'] for tid in test_ids)
+    conn.close()
+    session['success_msg'] = f'✅ Similarity check done: {flagged} pairs flagged'
+    return redirect(url_for('admin_analytics', test_id=test_id) if test_id else url_for('admin_analytics'))
+
+
+@app.cli.command('collusion')
+@click.option('--test-id', type=int, default=None, help='Only check this test (default: all levels).')
+def collusion_command(test_id):
+    """Flag pairs of submissions with suspiciously similar wrong answers."""
+    conn = get_db(archives=True)
+    test_ids = [test_id] if test_id else [r['id'] for r in conn.execute("SELECT id FROM tests WHERE slug=?",
+                                                                        (cfg().slug,))]
+    for tid in test_ids:
+        run_collusion_check(conn, tid)
+    conn.close()
+
+
 @app.get('/admin/submission/<int:submission_id>')
 def admin_submission_detail(submission_id):
     """View detailed submission results and generate certificate"""
     if 'admin_id' not in session:
         return redirect(url_for('admin_login'))
     
-    conn = get_db()
+    conn = get_read_db()
     
     sub = conn.execute("""
         SELECT s.id, s.test_id, s.respondent_id, s.score, s.total_points, s.finished_at,
@@ -2000,14 +2580,11 @@ def admin_submission_detail(submission_id):
         conn.close()
         abort(404)
     
-    # Parse answers
-    try:
-        details = json.loads(sub['details_json'])
-    except:
-        details = []
+    details = load_details(conn, sub['details_json'])
     
     # Get test info
     test = conn.execute("SELECT name FROM tests WHERE id=?", (sub['test_id'],)).fetchone()
+    similar = collusion.flags_for_submission(conn, submission_id)
     
     conn.close()
     
@@ -2015,19 +2592,24 @@ def admin_submission_detail(submission_id):
     
     return render_template('admin_submission_detail.html',
         app_title=APP_TITLE,
-        sub=sub,
+        sub=dict(sub, total=sub['total_points'], percentage=round(pct, 1)),
         test_name=test['name'] if test else 'Quiz',
         percentage=round(pct, 1),
-        details=details)
+        details=details,
+        similar=similar)
 
 
 @app.get('/admin/certificate/<int:submission_id>')
 def admin_download_certificate(submission_id):
     """Download certificate PDF (admin only)"""
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.lib.units import mm
+    from reportlab.pdfgen import canvas
+
     if 'admin_id' not in session:
         abort(403)
     
-    conn = get_db()
+    conn = get_read_db()
     
     sub = conn.execute("""
         SELECT s.id, s.test_id, s.respondent_id, s.score, s.total_points, s.finished_at,
@@ -2100,6 +2682,348 @@ def admin_download_certificate(submission_id):
     return send_file(buffer, as_attachment=True, download_name=filename, mimetype='application/pdf')
 
 
+# ===== BULK MAIL =====
+
+def ensure_certificate(conn, submission_id: int):
+    """Return the certificate path for a submission, generating the PDF if missing."""
+    sub = conn.execute("""
+        SELECT s.id, s.test_id, s.respondent_id, s.score, s.total_points, r.name
+        FROM submissions s JOIN respondents r ON s.respondent_id = r.id
+        WHERE s.id = ?
+    """, (submission_id,)).fetchone()
+    if not sub:
+        return None
+    path = PDF_DIR / f"certificate_{sub['id']}_{sub['respondent_id']}.pdf"
+    if not path.exists():
+        percent = (sub['score'] / sub['total_points'] * 100) if sub['total_points'] else 0
+        grade, desc = grade_from_percent(percent, conn, sub['test_id'])
+        generate_certificate(path, sub['respondent_id'], sub['id'], sub['score'], sub['total_points'],
+                             percent, grade, desc, sub['name'] or 'Student')
+    return path
+
+
+def render_bulk_mail(kind: str, context: dict):
+    subjects = {
+        'credentials': f"Your login details for {cfg().test_name}",
+        'certificates': f"Your certificate for {cfg().test_name}",
+    }
+    context = dict(context, test_name=cfg().test_name)
+    body = app.jinja_env.get_template(f'email/{kind}.txt').render(**context)
+    return subjects[kind], body
+
+
+def bulk_mail_attachments(kind: str, recipient: dict):
+    if kind != 'certificates' or not recipient.get('submission_id'):
+        return []
+    conn = get_db(archives=True)
+    try:
+        path = ensure_certificate(conn, recipient['submission_id'])
+    finally:
+        conn.close()
+    if not path:
+        raise ValueError(f"submission {recipient['submission_id']} not found")
+    return [(f"Certificate_{recipient['submission_id']}.pdf", str(path))]
+
+
+bulk_mailer = BulkMailer(mailer, render_bulk_mail, attachments_for=bulk_mail_attachments,
+                         max_in_flight=_email_cfg.get('bulk_max_in_flight', 100))
+
+
+def start_credentials_mail_job(recipients: list):
+    """Email login details to freshly imported/generated students."""
+    if not cfg().get('email', {}).get('smtp', {}).get('host'):
+        session['warning_msg'] = '⚠️ SMTP is not configured; credentials were not emailed'
+        return None
+    job_id = bulk_mailer.create_job('credentials', recipients, params={'login_url': url_for('login', _external=True)})
+    bulk_mailer.start(job_id)
+    session['success_msg'] = f'✅ Emailing credentials to {len(recipients)} students (job #{job_id})'
+    return job_id
+
+
+@app.get('/admin/bulk-mail')
+def admin_bulk_mail():
+    if 'admin_id' not in session:
+        return redirect(url_for('admin_login'))
+    return render_template('admin_bulk_mail.html', app_title=APP_TITLE, jobs=bulk_mailer.list_jobs())
+
+
+@app.post('/admin/bulk-mail/certificates')
+def admin_bulk_mail_certificates():
+    if 'admin_id' not in session:
+        abort(403)
+    if not cfg().get('email', {}).get('smtp', {}).get('host'):
+        session['error_msg'] = '❌ SMTP is not configured'
+        return redirect(url_for('admin_bulk_mail'))
+
+    level = (request.form.get('level') or '').upper()
+    conn = get_db()
+    # Latest submission per respondent, optionally limited to one level
+    rows = conn.execute("""
+        SELECT s.id, s.test_id, s.respondent_id, s.score, s.total_points, r.email, r.name
+        FROM submissions s
+        JOIN respondents r ON s.respondent_id = r.id
+        JOIN tests t ON s.test_id = t.id
+        WHERE t.slug = ? AND (? = '' OR t.level = ?)
+          AND s.id = (SELECT MAX(s2.id) FROM submissions s2 WHERE s2.respondent_id = s.respondent_id AND s2.test_id = s.test_id)
+        ORDER BY s.id
+    """, (cfg().slug, level, level)).fetchall()
+    confs = {t: test_settings(conn, t) for t in {r['test_id'] for r in rows}}
+    conn.close()
+
+    if not rows:
+        session['warning_msg'] = '⚠️ No submissions to send certificates for'
+        return redirect(url_for('admin_bulk_mail'))
+
+    recipients = []
+    for r in rows:
+        percent = (r['score'] / r['total_points'] * 100) if r['total_points'] else 0
+        grade, desc = confs[r['test_id']].grade_for(percent)
+        recipients.append({
+            'email': r['email'], 'respondent_id': r['respondent_id'], 'submission_id': r['id'],
+            'context': {'name': r['name'], 'score': int(r['score']), 'total': int(r['total_points']),
+                        'percent': f"{percent:.1f}", 'grade': grade, 'grade_desc': desc},
+        })
+    job_id = bulk_mailer.create_job('certificates', recipients, params={'level': level})
+    bulk_mailer.start(job_id)
+    session['success_msg'] = f'✅ Sending certificates to {len(recipients)} students (job #{job_id})'
+    return redirect(url_for('admin_bulk_mail'))
+
+
+@app.post('/admin/bulk-mail/<int:job_id>/resume')
+def admin_bulk_mail_resume(job_id):
+    if 'admin_id' not in session:
+        abort(403)
+    bulk_mailer.start(job_id)
+    session['success_msg'] = f'✅ Resumed job #{job_id}'
+    return redirect(url_for('admin_bulk_mail'))
+
+
+@app.cli.command('bulk-mail-resume')
+def bulk_mail_resume_command():
+    """Resume unfinished bulk mail jobs and wait for them to finish."""
+    ids = bulk_mailer.resume_all()
+    print('Resuming jobs:', ids or 'none')
+    for job_id in ids:
+        bulk_mailer.start(job_id).join()
+    mailer.flush(timeout=3600)
+
+
+# ===== RE-GRADING =====
+
+def regrade_and_refresh(conn, test_id: int, triggered_by: str = '', dry_run: bool = False):
+    """Re-grade a test's live submissions and drop cached PDFs of those whose grading changed.
+
+    Archived sittings are final and not re-graded; the report counts them.
+    """
+    key = main_answer_key(conn, test_id)
+    view = get_read_db()
+    try:
+        archived = view.execute("SELECT COUNT(*) FROM submissions WHERE test_id=?", (test_id,)).fetchone()[0]
+    finally:
+        view.close()
+    archived -= conn.execute("SELECT COUNT(*) FROM submissions WHERE test_id=?", (test_id,)).fetchone()[0]
+    report = regrade.regrade_test(conn, test_id, dry_run=dry_run, triggered_by=triggered_by, answer_key=key,
+                                  archived=max(archived, 0))
+    if not dry_run and report['changed']:
+        if key is not None:
+            # The matrices cover archived sittings too, like every other reader of them
+            view = get_db(archives=True)
+            try:
+                analytics_store.rebuild(view, test_id, [q['id'] for q in key.questions])
+            finally:
+                view.close()
+        for row in report['rows']:
+            for prefix in ('certificate', 'results'):
+                path = PDF_DIR / f"{prefix}_{row['submission_id']}_{row['respondent_id']}.pdf"
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+    print(f"[REGRADE] test {test_id}: {report['changed']}/{report['total']} submissions changed"
+          + (f", {len(report['skipped'])} skipped (graded against another question set)" if report['skipped'] else '')
+          + (f", {report['archived']} archived left as they are" if report['archived'] else '')
+          + (' (dry run)' if dry_run else ''))
+    return report
+
+
+@app.get('/admin/regrade')
+def admin_regrade():
+    if 'admin_id' not in session:
+        return redirect(url_for('admin_login'))
+    conn = get_read_db()
+    tests = conn.execute("SELECT id, name, level FROM tests WHERE slug=? ORDER BY id", (cfg().slug,)).fetchall()
+    runs = regrade.list_runs(conn)
+    run_id = request.args.get('run', type=int) or (runs[0]['id'] if runs else None)
+    report = regrade.load_run(conn, run_id) if run_id else None
+    conn.close()
+    return render_template('admin_regrade.html', app_title=APP_TITLE, tests=tests, runs=runs,
+                           run_id=run_id, report=report)
+
+
+@app.post('/admin/regrade')
+def admin_regrade_post():
+    if 'admin_id' not in session:
+        abort(403)
+    test_id = request.form.get('test_id', type=int)
+    conn = get_db()
+    if test_id:
+        test_ids = [test_id]
+    else:
+        test_ids = [r['id'] for r in conn.execute("SELECT id FROM tests WHERE slug=?", (cfg().slug,))]
+    total = changed = skipped = archived = 0
+    for tid in test_ids:
+        report = regrade_and_refresh(conn, tid, triggered_by='admin')
+        total += report['total']
+        changed += report['changed']
+        skipped += len(report['skipped'])
+        archived += report['archived']
+    conn.close()
+    session['success_msg'] = f'✅ Re-graded {total} submissions, {changed} changed'
+    if skipped or archived:
+        session['warning_msg'] = (f'⚠️ Not re-graded: {skipped} graded against a replaced question set, '
+                                  f'{archived} archived')
+    return redirect(url_for('admin_regrade'))
+
+
+@app.cli.command('regrade')
+@click.option('--test-id', type=int, default=None, help='Only re-grade this test (default: all levels).')
+@click.option('--dry-run', is_flag=True, help='Report what would change without writing.')
+def regrade_command(test_id, dry_run):
+    """Re-grade stored submissions against the current answer keys."""
+    conn = get_db()
+    test_ids = [test_id] if test_id else [r['id'] for r in conn.execute("SELECT id FROM tests WHERE slug=?",
+                                                                        (cfg().slug,))]
+    for tid in test_ids:
+        report = regrade_and_refresh(conn, tid, triggered_by='cli', dry_run=dry_run)
+        for row in report['rows']:
+            print(f"  submission {row['submission_id']}: {row['old_score']:g} -> {row['new_score']:g}")
+        for row in report['skipped']:
+            print(f"  submission {row['submission_id']}: skipped, graded against question set {row['set_id']}")
+    conn.close()
+
+
+@app.cli.command('optimize-images')
+def optimize_images_command():
+    """Move existing question images to fingerprinted names and build their variants."""
+    conn = get_db()
+    urls = [r['image_url'] for r in conn.execute(
+        "SELECT DISTINCT image_url FROM questions WHERE image_url LIKE 'assets/question_images/%'")]
+    moved = before = after = 0
+    for url in urls:
+        path = STATIC_DIR / url
+        if not path.exists():
+            print(f'  missing: {url}')
+            continue
+        data = path.read_bytes()
+        new_url = f"assets/question_images/{images.store_image(data, path.name, QUESTION_IMAGES_DIR)}"
+        small = STATIC_DIR / images.variant(STATIC_DIR, new_url, 'small')
+        before += len(data)
+        after += small.stat().st_size
+        if new_url != url:
+            conn.execute("UPDATE questions SET image_url=? WHERE image_url=?", (new_url, url))
+            moved += 1
+    conn.close()
+    print(f'{len(urls)} images, {moved} renamed; quiz payload {before / 1024:.0f} KB -> {after / 1024:.0f} KB '
+          f'(1x variants)')
+
+
+@app.cli.command('backup-db')
+@click.option('--compress/--no-compress', default=None, help='gzip the snapshot (default: backup.compress).')
+@click.option('--keep', type=int, default=None, help='Snapshots to keep after this one (default: backup.keep).')
+def backup_db_command(compress, keep):
+    """Take an online snapshot of the database into BACKUP_DIR and rotate old ones."""
+    if compress is not None:
+        backup_scheduler.compress = compress
+    if keep is not None:
+        backup_scheduler.keep = keep
+    stats = backup_scheduler.run_now()
+    print(f"{stats['path']}: {stats['db_bytes'] / 1e6:.1f} MB -> {stats['file_bytes'] / 1e6:.1f} MB")
+
+
+@app.cli.command('restore-db')
+@click.argument('snapshot', required=False)
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+def restore_db_command(snapshot, yes):
+    """Replace the database with SNAPSHOT (a file or a name in BACKUP_DIR); lists snapshots without one.
+
+    Stop the server first. The current database is saved as a pre-restore snapshot.
+    Snapshots taken before an archiving run are refused; the answer matrices are
+    dropped and rebuilt from the restored database.
+    """
+    if not snapshot:
+        for path in backups.list_snapshots(BACKUP_DIR):
+            print(f'  {path.name}  {path.stat().st_size / 1e6:.1f} MB')
+        return
+    path = Path(snapshot) if Path(snapshot).exists() else BACKUP_DIR / snapshot
+    if not path.exists():
+        raise click.ClickException(f'No such snapshot: {snapshot}')
+    if not yes:
+        click.confirm(f'Replace {DB_PATH} with {path.name}?', abort=True)
+    try:
+        saved = backups.restore(path, DB_PATH, backup_dir=BACKUP_DIR, archive_files=archive.list_archives(ARCHIVE_DIR))
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    shutil.rmtree(ANALYTICS_DIR, ignore_errors=True)
+    print(f'Restored {path.name} into {DB_PATH}' + (f'; previous state saved as {Path(saved).name}' if saved else ''))
+
+
+@app.cli.command('archive-sittings')
+@click.option('--keep-days', type=int, default=None, help='Keep sittings newer than this (default: archive.keep_days).')
+@click.option('--dry-run', is_flag=True, help='Only report what would move.')
+@click.option('--vacuum', is_flag=True, help='VACUUM the live database afterwards to return the space to the disk.')
+def archive_sittings_command(keep_days, dry_run, vacuum):
+    """Move finished sittings out of the live database into per-term archives in ARCHIVE_DIR."""
+    before = DB_PATH.stat().st_size
+    stats = archiver.run_now(dry_run=dry_run, keep_days=keep_days)
+    for term, counts in sorted(stats['terms'].items()):
+        print(f"  {term}: " + ', '.join(f'{n} {table}' for table, n in sorted(counts.items())))
+    if dry_run:
+        print(f"{stats['rows']} rows would move")
+        return
+    if vacuum and stats['rows']:
+        conn = get_db()
+        conn.execute("VACUUM")
+        conn.close()
+    print(f"{stats['rows']} rows archived in {stats['seconds']}s; live database "
+          f"{before / 1e6:.1f} MB -> {DB_PATH.stat().st_size / 1e6:.1f} MB")
+
+
+@app.cli.command('migrate-details')
+@click.option('--batch', type=int, default=500, show_default=True, help='Rows rewritten per transaction.')
+@click.option('--dry-run', is_flag=True, help='Only report the bytes that would be saved.')
+@click.option('--vacuum', is_flag=True, help='VACUUM each database afterwards to return the space to the disk.')
+def migrate_details_command(batch, dry_run, vacuum):
+    """Rewrite old submissions.details_json rows (live database and archives) in the compact format."""
+    conn = get_db()
+    targets = [(DB_PATH, conn)] + [(path, sqlite3.connect(path, isolation_level=None))
+                                   for path in archive.list_archives(ARCHIVE_DIR)]
+
+    def key_for_test(test_id):
+        # Snapshots live in the main database, where the archive views resolve them too
+        key = main_answer_key(conn, test_id)
+        if key is not None and not dry_run:
+            db_writes.run(conn, details_codec.save_snapshot, key)
+        return key
+
+    for path, target in targets:
+        stats = details_codec.migrate(target, key_for_test, batch=batch, dry_run=dry_run)
+        if vacuum and stats['rows'] and not dry_run:
+            target.execute("VACUUM")
+        saved = stats['bytes_before'] - stats['bytes_after']
+        print(f"{path.name}: {stats['rows']} rows{' would be' if dry_run else ''} rewritten, "
+              f"{stats['bytes_before'] / 1e6:.1f} MB -> {stats['bytes_after'] / 1e6:.1f} MB "
+              f"({saved / 1e6:.1f} MB, {saved / max(stats['bytes_before'], 1):.0%} saved)" + (f", {stats['failed']} unreadable rows left" if stats['failed'] else ''))
+        target.close()
+
+
+@app.cli.command('compress-static')
+def compress_static_command():
+    """Write .gz (and .br, with brotli installed) copies of the CSS/JS/SVG files under static/."""
+    files, before, after = compression.precompress_tree(STATIC_DIR)
+    print(f'{files} files precompressed ({", ".join(compression.supported())}): '
+          f'{before / 1024:.0f} KB -> {after / 1024:.0f} KB')
+
+
 # ===== BULK IMPORT ROUTES =====
 
 
@@ -2128,7 +3052,7 @@ def admin_import_sample_questions():
         try:
             # Get test for this level
             test = conn.execute("SELECT id FROM tests WHERE slug=? AND level=?", 
-                              (CFG['test']['slug'], level)).fetchone()
+                              (cfg().slug, level)).fetchone()
             if not test:
                 errors.append(f"Test not found for level {level}")
                 continue
@@ -2186,6 +3110,43 @@ def legacy_submit():
     return submit_quiz()
 
 # Initialize
+def warm_caches():
+    """Load what every request needs before workers fork, so they share it copy-on-write."""
+    conn = get_db()
+    set_ids = [r['id'] for r in conn.execute("""
+        SELECT qs.id FROM question_sets qs JOIN tests t ON t.id = qs.test_id
+        WHERE qs.set_type='main' AND t.slug=?
+    """, (cfg().slug,))]
+    for set_id in set_ids:
+        answer_keys.get(conn, set_id)
+    conn.close()
+    for name in app.jinja_env.list_templates(filter_func=lambda n: n.endswith('.html')):
+        app.jinja_env.get_template(name)
+    print(f'[SERVE] warmed {len(set_ids)} answer keys and the page templates')
+
+
+@app.cli.command('serve')
+@click.option('--host', default='0.0.0.0', show_default=True)
+@click.option('--port', type=int, default=lambda: int(os.getenv('PORT', 8000)), show_default='PORT or 8000')
+@click.option('--workers', type=int, default=lambda: os.cpu_count() or 2, show_default='CPU count')
+@click.option('--threads', type=int, default=4, show_default=True, help='Request threads per worker.')
+@click.option('--max-requests', type=int, default=1000, show_default=True,
+              help='Recycle a worker after this many requests (0 = never).')
+@click.option('--max-requests-jitter', type=int, default=100, show_default=True)
+@click.option('--graceful-timeout', type=int, default=30, show_default=True,
+              help='Seconds in-flight requests get to finish on shutdown.')
+def serve_command(host, port, workers, threads, max_requests, max_requests_jitter, graceful_timeout):
+    """Run the production server: pre-forked workers with the app preloaded."""
+    def on_starting():
+        init_db()
+        warm_caches()
+        instrumentation.registry.clear_shared()
+
+    prefork.serve(app, host=host, port=port, workers=workers, threads=threads, max_requests=max_requests,
+                  max_requests_jitter=max_requests_jitter, graceful_timeout=graceful_timeout,
+                  on_starting=on_starting)
+
+
 if __name__ == '__main__':
     init_db()
     app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), debug=True)
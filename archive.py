@@ -0,0 +1,357 @@
+"""Archiving of finished sittings out of the live database.
+
+``submissions``, ``quiz_sessions``, ``randomization_maps`` and ``otp_codes``
+only ever grow, and they live in the same file that serves logins and
+submits during a sitting. :func:`archive_ended` moves the rows of sittings
+that are over into one SQLite file per term, ``archive-<YYYY>-T<n>.sqlite3``
+in the archive directory (``term_months`` months per term, so the default
+of 4 gives T1 = Jan-Apr, T2 = May-Aug, T3 = Sep-Dec). A row is archived
+once it is older than ``keep_days`` and its sitting is over: its test is
+not active, or was restarted after the row was written (tests are reused
+from one term to the next).
+
+* ``submissions`` by ``finished_at``, together with their
+  ``randomization_maps`` rows (matched by attempt, as maps carry no
+  timestamp; only once the test has ended, since attempt numbers repeat
+  when a test is reused);
+* student ``quiz_sessions`` by ``start_time``, once the session store has
+  dropped their data (anonymous sessions are swept by the session store);
+* ``otp_codes`` by ``expires_at``.
+
+Rows move in batches of ``batch`` ids: each batch is copied with
+``INSERT OR IGNORE`` and deleted from the live tables in one transaction.
+Ids are ``AUTOINCREMENT`` and never reused, so a batch interrupted after
+the copy is simply copied (ignored) and deleted again by the next run.
+
+:func:`attach` makes archived rows visible to a connection: it attaches the
+archive files and creates ``TEMP`` views named like the live tables that
+``UNION ALL`` the live rows with the archived ones. Temp objects shadow
+``main``, so the admin queries keep working unchanged. Lookups by id are
+pushed down to each file's primary key; a join over the whole view
+materializes it (in memory), so a full history listing costs a few times
+what it did with everything in one table. Such a connection
+must not write to those tables; archived sittings are final (re-grading
+only touches the live rows). SQLite attaches at most 10 databases by
+default, so once there are more terms than :data:`MAX_ATTACHED`,
+:func:`merge_old_terms` folds the oldest ones into a single file
+(:data:`MERGED_NAME`) and every archived row stays visible.
+
+:class:`Archiver` runs :func:`archive_ended` every ``interval_hours`` from
+a background thread started lazily per process.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, runs may overlap (they are idempotent)
+    fcntl = None
+
+
+DEFAULTS = {
+    'interval_hours': 0,   # 0: no scheduled runs (``flask archive-sittings`` still works)
+    'keep_days': 30,
+    'term_months': 4,
+    'batch': 500,
+}
+MAX_ATTACHED = 9   # SQLITE_MAX_ATTACHED defaults to 10; one is left for ad-hoc use
+MERGED_NAME = 'archive-0000-older.sqlite3'   # terms folded by merge_old_terms; sorts before every term
+VIEW_TABLES = ('submissions',)
+
+# table -> (time column, test column, extra condition)
+TABLES = {
+    'submissions': ('finished_at', 'test_id', ''),
+    'quiz_sessions': ('start_time', 'quiz_id', 'AND x.student_id IS NOT NULL AND x.data_json IS NULL'),
+    'otp_codes': ('expires_at', None, ''),
+}
+_CREATE_RE = re.compile(r'^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?("?\w+"?)', re.IGNORECASE)
+
+
+def _term_sql(col, term_months):
+    """SQL expression of the term label (``2025-T2``) of an ISO timestamp column."""
+    return f"substr({col}, 1, 4) || '-T' || ((CAST(substr({col}, 6, 2) AS INTEGER) - 1) / {int(term_months)} + 1)"
+
+
+def _columns(conn, schema, table):
+    return [r[1] for r in conn.execute(f'PRAGMA {schema}.table_info({table})')]
+
+
+def _eligible(table, term_months, term=None):
+    time_col, test_col, extra = TABLES[table]
+    sql = f'SELECT x.id, {_term_sql("x." + time_col, term_months)} AS term FROM main.{table} x '
+    if test_col:
+        sql += f'LEFT JOIN main.tests t ON t.id = x.{test_col} '
+    sql += f'WHERE x.{time_col} < :cutoff {extra} '
+    if test_col:
+        # Over: the test is not running, or the row predates its current start
+        sql += f"AND (t.id IS NULL OR t.status != 'active' OR x.{time_col} < COALESCE(t.start_time, '')) "
+    if term:
+        sql += f'AND {_term_sql("x." + time_col, term_months)} = :term AND x.id > :after '
+    return sql + 'ORDER BY x.id LIMIT :limit'
+
+
+def _ensure_table(conn, alias, table, source='main'):
+    """Create ``alias.table`` like ``source.table``; add columns ``source`` has gained since."""
+    row = conn.execute(f"SELECT sql FROM {source}.sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()
+    if row is None:
+        return False
+    conn.execute(_CREATE_RE.sub(f'CREATE TABLE IF NOT EXISTS {alias}.{table}', row[0], count=1))
+    have = set(_columns(conn, alias, table))
+    for r in conn.execute(f'PRAGMA {source}.table_info({table})').fetchall():
+        if r[1] not in have:
+            conn.execute(f'ALTER TABLE {alias}.{table} ADD COLUMN {r[1]} {r[2]}')
+    return True
+
+
+def _move(conn, alias, table, ids):
+    cols = ', '.join(_columns(conn, 'main', table))
+    marks = ', '.join('?' * len(ids))
+    moved = {table: len(ids)}
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if table == 'submissions':
+            maps = f"""
+                SELECT m.id FROM main.submissions s
+                JOIN main.randomization_maps m
+                  ON m.test_id = s.test_id AND m.respondent_id = s.respondent_id AND m.attempt_no = s.attempt_no
+                JOIN main.tests t ON t.id = m.test_id AND t.status != 'active'
+                WHERE s.id IN ({marks})
+            """
+            map_ids = [r[0] for r in conn.execute(maps, ids).fetchall()]
+            if map_ids:
+                map_cols = ', '.join(_columns(conn, 'main', 'randomization_maps'))
+                map_marks = ', '.join('?' * len(map_ids))
+                conn.execute(f'INSERT OR IGNORE INTO {alias}.randomization_maps ({map_cols}) '
+                             f'SELECT {map_cols} FROM main.randomization_maps WHERE id IN ({map_marks})', map_ids)
+                conn.execute(f'DELETE FROM main.randomization_maps WHERE id IN ({map_marks})', map_ids)
+            moved['randomization_maps'] = len(map_ids)
+        conn.execute(f'INSERT OR IGNORE INTO {alias}.{table} ({cols}) '
+                     f'SELECT {cols} FROM main.{table} WHERE id IN ({marks})', ids)
+        conn.execute(f'DELETE FROM main.{table} WHERE id IN ({marks})', ids)
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return moved
+
+
+def archive_path(archive_dir, term):
+    return Path(archive_dir) / f'archive-{term}.sqlite3'
+
+
+def list_archives(archive_dir):
+    """Archive files in ``archive_dir``, oldest term first."""
+    archive_dir = Path(archive_dir)
+    if not archive_dir.is_dir():
+        return []
+    return sorted(archive_dir.glob('archive-*.sqlite3'), key=lambda p: p.name)
+
+
+def archive_ended(conn, archive_dir, keep_days=30, term_months=4, batch=500, dry_run=False, now=None):
+    """Move rows of finished sittings older than ``keep_days`` into per-term archives.
+
+    ``conn`` is a connection to the live database in autocommit mode.
+    Returns ``{term: {table: rows}}`` (what would move, with ``dry_run``).
+    """
+    now = now or datetime.now(timezone.utc)
+    params = {'cutoff': (now - timedelta(days=keep_days)).isoformat(), 'limit': -1}
+    plan = {}
+    for table in TABLES:
+        for term, n in conn.execute(f'SELECT term, COUNT(*) FROM ({_eligible(table, term_months)}) GROUP BY term',
+                                    params).fetchall():
+            plan.setdefault(term, {})[table] = n
+    if dry_run or not plan:
+        return plan
+
+    Path(archive_dir).mkdir(parents=True, exist_ok=True)
+    moved = {}
+    for term in sorted(plan):
+        conn.execute('ATTACH DATABASE ? AS archive_db', (str(archive_path(archive_dir, term)),))
+        try:
+            for table in list(TABLES) + ['randomization_maps']:
+                _ensure_table(conn, 'archive_db', table)
+            counts = moved.setdefault(term, {})
+            for table in TABLES:
+                query = _eligible(table, term_months, term)
+                after = 0
+                while True:
+                    ids = [r[0] for r in conn.execute(query, dict(params, term=term, after=after, limit=batch))]
+                    if not ids:
+                        break
+                    after = ids[-1]
+                    for name, n in _move(conn, 'archive_db', table, ids).items():
+                        counts[name] = counts.get(name, 0) + n
+        finally:
+            conn.execute('DETACH DATABASE archive_db')
+    return moved
+
+
+def merge_old_terms(archive_dir, keep=MAX_ATTACHED - 1):
+    """Fold all but the newest ``keep`` term files into :data:`MERGED_NAME`. Returns the terms merged.
+
+    Keeps the archive within what :func:`attach` can attach. Each term is
+    renamed out of sight, copied in one transaction and then deleted, so a
+    reader never sees its rows twice (only misses them while they are
+    copied), and a run that was interrupted finishes on the next call.
+    """
+    archive_dir = Path(archive_dir)
+    terms = [p for p in list_archives(archive_dir) if p.name != MERGED_NAME]
+    todo = sorted(archive_dir.glob('archive-*.sqlite3.merging')) + (terms[:-keep] if len(terms) > keep else [])
+    if not todo:
+        return []
+    merged = []
+    conn = sqlite3.connect(archive_dir / MERGED_NAME, timeout=30, isolation_level=None)
+    try:
+        for path in todo:
+            if path.suffix != '.merging':
+                path = path.replace(path.with_name(path.name + '.merging'))
+            conn.execute('ATTACH DATABASE ? AS term_db', (str(path),))
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    for (table,) in conn.execute("SELECT name FROM term_db.sqlite_master "
+                                                 "WHERE type='table' AND name NOT LIKE 'sqlite_%'").fetchall():
+                        _ensure_table(conn, 'main', table, source='term_db')
+                        cols = ', '.join(_columns(conn, 'term_db', table))
+                        conn.execute(f'INSERT OR IGNORE INTO main.{table} ({cols}) SELECT {cols} FROM term_db.{table}')
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+            finally:
+                conn.execute('DETACH DATABASE term_db')
+            path.unlink()
+            merged.append(path.name[len('archive-'):-len('.sqlite3.merging')])
+    finally:
+        conn.close()
+    return merged
+
+
+def attached_files(archive_dir):
+    """The archive files :func:`attach` would attach now."""
+    return list_archives(archive_dir)[-MAX_ATTACHED:]
+
+
+def attach(conn, archive_dir, tables=VIEW_TABLES, readonly=False):
+    """Attach the archives to ``conn`` and shadow ``tables`` with live + archived views.
+
+    With ``readonly`` the files are attached as ``mode=ro`` URIs (``conn``
+    must have been opened with ``uri=True``). Returns the attached files.
+    Without archives the connection is left as is.
+    """
+    # More files only until the next archiving run merges the oldest (see Archiver.metrics: hidden_terms)
+    files = attached_files(archive_dir)
+    attached = []
+    if files:
+        # The views are materialized for joins; keep that off the disk (set before any temp object exists)
+        conn.execute('PRAGMA temp_store=MEMORY')
+    for i, path in enumerate(files):
+        target = path.resolve().as_uri() + '?mode=ro' if readonly else str(path)
+        conn.execute('ATTACH DATABASE ? AS ?', (target, f'archive_{i}'))
+        attached.append((f'archive_{i}', path))
+    for table in tables:
+        cols = _columns(conn, 'main', table)
+        parts = [f'SELECT {", ".join(cols)} FROM main.{table}']
+        for alias, _ in attached:
+            have = set(_columns(conn, alias, table))
+            if have:
+                # Archives written before a column was added read it as NULL
+                parts.append(f'SELECT {", ".join(c if c in have else "NULL AS " + c for c in cols)} '
+                             f'FROM {alias}.{table}')
+        if len(parts) > 1:
+            conn.execute(f'CREATE TEMP VIEW IF NOT EXISTS {table} AS ' + ' UNION ALL '.join(parts))
+    return [path for _, path in attached]
+
+
+def ensure_schema(conn):
+    # randomization_maps rows are matched to their submission by attempt
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_randomization_maps_attempt "
+                 "ON randomization_maps(test_id, respondent_id, attempt_no)")
+
+
+class Archiver:
+    """Moves finished sittings into the archive every ``interval_hours``."""
+
+    def __init__(self, db_path, archive_dir, interval_hours=0, keep_days=30, term_months=4, batch=500,
+                 factory=sqlite3.Connection):
+        self.db_path = Path(db_path)
+        self.archive_dir = Path(archive_dir)
+        self.interval = float(interval_hours) * 3600
+        self.keep_days = keep_days
+        self.term_months = term_months
+        self.batch = batch
+        self.factory = factory
+        self.last = None          # stats of the last run in this process
+        self.failures = 0
+        self._thread_pid = None
+
+    def start(self):
+        """Start the archiving thread once per process (no-op when disabled)."""
+        if self.interval <= 0 or self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, name='archiver', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_due()
+            except Exception as e:
+                self.failures += 1
+                print('[ARCHIVE] scheduled run failed:', e)
+
+    def run_due(self):
+        """Run unless another worker is already archiving. Returns the stats, or None."""
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.archive_dir / '.lock', 'w') as lock:
+            if fcntl:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None
+            return self.run_now()
+
+    def run_now(self, dry_run=False, keep_days=None):
+        started = time.perf_counter()
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, factory=self.factory)
+        try:
+            moved = archive_ended(conn, self.archive_dir, self.keep_days if keep_days is None else keep_days,
+                                  self.term_months, self.batch, dry_run=dry_run)
+        finally:
+            conn.close()
+        merged = [] if dry_run else merge_old_terms(self.archive_dir)
+        rows = sum(n for counts in moved.values() for n in counts.values())
+        stats = {'terms': moved, 'rows': rows, 'merged': merged, 'seconds': round(time.perf_counter() - started, 3)}
+        if not dry_run:
+            self.last = dict(stats, at=time.time())
+            if rows:
+                print(f"[ARCHIVE] moved {rows} rows into {len(moved)} terms in {stats['seconds']}s: "
+                      + '; '.join(f'{term} {counts}' for term, counts in sorted(moved.items())))
+            if merged:
+                print(f"[ARCHIVE] merged {len(merged)} old terms into {MERGED_NAME}: {', '.join(merged)}")
+        return stats
+
+    def attach(self, conn, readonly=False):
+        return attach(conn, self.archive_dir, readonly=readonly)
+
+    def attached_files(self):
+        return attached_files(self.archive_dir)
+
+    def metrics(self):
+        last = self.last or {}
+        files = list_archives(self.archive_dir)
+        return {
+            'files': len(files),
+            # Terms no admin view can see until the next run merges them (should stay 0)
+            'hidden_terms': max(0, len(files) - MAX_ATTACHED),
+            'bytes': sum(p.stat().st_size for p in files),
+            'last_rows': last.get('rows', 0),
+            'last_seconds': last.get('seconds', 0),
+            'failures': self.failures,
+        }
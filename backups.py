@@ -0,0 +1,286 @@
+"""Online backups of the SQLite database.
+
+Copying ``data.sqlite3`` with ``cp`` during a sitting can capture a torn
+file (and misses everything still in the WAL). :func:`snapshot` uses
+SQLite's online backup API instead: the copy advances ``pages`` pages per
+step and sleeps ``sleep`` seconds between steps, which spreads the disk
+reads out so writers' commits are not queued behind one long burst of I/O.
+
+The backup API restarts when another connection writes to the source
+between steps. In WAL mode the copy therefore runs inside one read
+transaction on the source, which pins a snapshot: writers keep committing
+to the WAL, the copy never restarts, and only checkpoints are held back
+until it finishes. In rollback-journal mode a read transaction would block
+writers, so steps run unpinned. After ``max_restarts`` restarts the copy is
+finished in a single step.
+
+Snapshots are written as ``<stem>-<UTC timestamp>.sqlite3`` (``.gz`` with
+``compress``) in the backup directory. They go to a ``.partial`` name
+first and are renamed once complete and ``PRAGMA quick_check`` passes, so
+a file with the final name is always usable. :func:`rotate` keeps the
+newest ``keep`` snapshots.
+
+:class:`BackupScheduler` takes a snapshot every ``interval_minutes`` from a
+background thread started lazily per process. An ``flock`` on the backup
+directory and the age of the newest snapshot keep several workers from all
+taking the same snapshot.
+
+:func:`restore` copies a snapshot back into the live database through the
+same API (after saving a ``pre-restore`` snapshot of the current state).
+Run it with the server stopped. Archive files are not part of a snapshot:
+a snapshot that still holds rows archived since it was taken is refused,
+as the archive views would show those rows twice.
+"""
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, workers may both snapshot
+    fcntl = None
+
+
+DEFAULTS = {
+    'interval_minutes': 0,   # 0: no scheduled snapshots (``flask backup-db`` still works)
+    'keep': 12,
+    'compress': True,
+    'pages': 1024,
+    'sleep_ms': 5,
+}
+SUFFIXES = ('.sqlite3', '.sqlite3.gz')
+
+
+class _Restarted(Exception):
+    pass
+
+
+def _copy(src, dst, pages, sleep, max_restarts):
+    """Back ``src`` up into ``dst``. Returns (steps, restarts)."""
+    state = {'steps': 0, 'restarts': 0, 'remaining': None}
+
+    def progress(status, remaining, total):
+        state['steps'] += 1
+        if state['remaining'] is not None and remaining > state['remaining']:
+            # The source changed under the copy and SQLite started over
+            state['restarts'] += 1
+            if state['restarts'] > max_restarts:
+                raise _Restarted()
+        state['remaining'] = remaining
+
+    pinned = src.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    if pinned:
+        src.execute('BEGIN')
+        src.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchone()   # starts the read transaction
+    try:
+        src.backup(dst, pages=pages, progress=progress, sleep=sleep)
+    except _Restarted:
+        print(f'[BACKUP] copy restarted {state["restarts"]} times; finishing in one step')
+        src.backup(dst, pages=-1)
+    finally:
+        if pinned:
+            src.execute('COMMIT')
+    return state['steps'], state['restarts']
+
+
+def snapshot(db_path, dest_dir, compress=True, pages=1024, sleep=0.005, max_restarts=3, label=''):
+    """Write a consistent snapshot of ``db_path`` into ``dest_dir``. Returns a stats dict."""
+    dest_dir = Path(dest_dir)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    name = f'{Path(db_path).stem}-{stamp}{"-" + label if label else ""}.sqlite3'
+    partial = dest_dir / (name + '.partial')
+    started = time.perf_counter()
+
+    src = sqlite3.connect(db_path, timeout=30)
+    dst = sqlite3.connect(partial)
+    try:
+        steps, restarts = _copy(src, dst, pages, sleep, max_restarts)
+        copied = time.perf_counter() - started
+        # A standalone file: no -wal/-shm needed to open it
+        dst.execute('PRAGMA journal_mode=DELETE')
+        check = dst.execute('PRAGMA quick_check').fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+    if check != 'ok':
+        partial.unlink()
+        raise RuntimeError(f'snapshot failed quick_check: {check}')
+
+    size = partial.stat().st_size
+    final = dest_dir / name
+    if compress:
+        final = dest_dir / (name + '.gz')
+        packed = dest_dir / (name + '.gz.partial')
+        with open(partial, 'rb') as f_in, gzip.open(packed, 'wb', compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        partial.unlink()
+        partial = packed
+    os.replace(partial, final)
+    return {
+        'path': str(final),
+        'db_bytes': size,
+        'file_bytes': final.stat().st_size,
+        'copy_seconds': round(copied, 3),
+        'total_seconds': round(time.perf_counter() - started, 3),
+        'steps': steps,
+        'restarts': restarts,
+    }
+
+
+def list_snapshots(dest_dir, stem=None):
+    """Finished snapshots in ``dest_dir``, oldest first."""
+    dest_dir = Path(dest_dir)
+    if not dest_dir.is_dir():
+        return []
+    found = [p for p in dest_dir.iterdir()
+             if p.name.endswith(SUFFIXES) and (stem is None or p.name.startswith(stem + '-'))]
+    return sorted(found, key=lambda p: p.name)
+
+
+def rotate(dest_dir, keep, stem=None):
+    """Delete all but the newest ``keep`` snapshots (labelled ones included). Returns the deleted paths."""
+    snapshots = list_snapshots(dest_dir, stem)
+    doomed = snapshots[:-keep] if keep > 0 else []
+    for path in doomed:
+        path.unlink(missing_ok=True)
+    return doomed
+
+
+def archived_overlap(conn, archive_files):
+    """Rows of ``conn``'s tables that are also in one of ``archive_files``, as ``{file name: rows}``."""
+    found = {}
+    for path in archive_files:
+        conn.execute('ATTACH DATABASE ? AS archive_db', (str(path),))
+        try:
+            tables = [r[0] for r in conn.execute(
+                "SELECT name FROM archive_db.sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+            n = 0
+            for table in tables:
+                if conn.execute("SELECT 1 FROM main.sqlite_master WHERE type='table' AND name=?", (table,)).fetchone():
+                    n += conn.execute(f'SELECT COUNT(*) FROM main.{table} '
+                                      f'WHERE id IN (SELECT id FROM archive_db.{table})').fetchone()[0]
+            if n:
+                found[Path(path).name] = n
+        finally:
+            conn.execute('DETACH DATABASE archive_db')
+    return found
+
+
+def restore(snapshot_path, db_path, backup_dir=None, pages=1024, archive_files=()):
+    """Replace the contents of ``db_path`` with ``snapshot_path``. Returns the pre-restore snapshot (or None).
+
+    Raises RuntimeError, before touching ``db_path``, when the snapshot holds
+    rows that were moved into ``archive_files`` after it was taken.
+    """
+    snapshot_path = Path(snapshot_path)
+    tmp = None
+    source = snapshot_path
+    if snapshot_path.name.endswith('.gz'):
+        tmp = snapshot_path.with_name(snapshot_path.name[:-3] + '.restore')
+        with gzip.open(snapshot_path, 'rb') as f_in, open(tmp, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        source = tmp
+    try:
+        src = sqlite3.connect(f'file:{source}?mode=ro', uri=True)
+        try:
+            check = src.execute('PRAGMA quick_check').fetchone()[0]
+            if check != 'ok':
+                raise RuntimeError(f'{snapshot_path.name} failed quick_check: {check}')
+            overlap = archived_overlap(src, archive_files)
+            if overlap:
+                raise RuntimeError(
+                    f'{snapshot_path.name} predates an archiving run: '
+                    + ', '.join(f'{n} of its rows are in {name}' for name, n in sorted(overlap.items()))
+                    + '. Restoring it would list them twice; pick a snapshot taken after that run')
+            saved = None
+            if backup_dir and Path(db_path).exists():
+                saved = snapshot(db_path, backup_dir, label='pre-restore')['path']
+            dst = sqlite3.connect(db_path, timeout=30)
+            try:
+                # Through the backup API the live WAL stays consistent with the new content
+                src.backup(dst, pages=pages)
+                dst.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            finally:
+                dst.close()
+        finally:
+            src.close()
+    finally:
+        if tmp:
+            tmp.unlink(missing_ok=True)
+    return saved
+
+
+class BackupScheduler:
+    """Takes a snapshot every ``interval_minutes`` and keeps the newest ``keep``."""
+
+    def __init__(self, db_path, dest_dir, interval_minutes=0, keep=12, compress=True, pages=1024, sleep_ms=5):
+        self.db_path = Path(db_path)
+        self.dest_dir = Path(dest_dir)
+        self.interval = float(interval_minutes) * 60
+        self.keep = keep
+        self.compress = compress
+        self.pages = pages
+        self.sleep = sleep_ms / 1000.0
+        self.last = None          # stats of the last snapshot this process took
+        self.failures = 0
+        self._thread_pid = None
+
+    def start(self):
+        """Start the scheduler thread once per process (no-op when disabled)."""
+        if self.interval <= 0 or self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, name='backup-scheduler', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(min(self.interval, 60))
+            try:
+                self.run_due()
+            except Exception as e:
+                self.failures += 1
+                print('[BACKUP] scheduled snapshot failed:', e)
+
+    def newest_age(self):
+        snapshots = list_snapshots(self.dest_dir, self.db_path.stem)
+        if not snapshots:
+            return None
+        return time.time() - snapshots[-1].stat().st_mtime
+
+    def run_due(self):
+        """Take a snapshot if none is younger than the interval. Returns its stats, or None."""
+        self.dest_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.dest_dir / '.lock', 'w') as lock:
+            if fcntl:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None   # another worker is taking it
+            age = self.newest_age()
+            if age is not None and age < self.interval:
+                return None
+            return self.run_now()
+
+    def run_now(self, label=''):
+        stats = snapshot(self.db_path, self.dest_dir, self.compress, self.pages, self.sleep, label=label)
+        removed = rotate(self.dest_dir, self.keep, self.db_path.stem)
+        self.last = dict(stats, at=time.time())
+        print(f"[BACKUP] {Path(stats['path']).name}: {stats['db_bytes'] / 1e6:.1f} MB in {stats['total_seconds']}s "
+              f"({stats['steps']} steps, {stats['restarts']} restarts), {len(removed)} old snapshots removed")
+        return stats
+
+    def metrics(self):
+        last = self.last or {}
+        age = self.newest_age()
+        return {
+            'last_seconds': last.get('total_seconds', 0),
+            'last_bytes': last.get('file_bytes', 0),
+            'newest_age_seconds': round(age, 1) if age is not None else -1,
+            'failures': self.failures,
+        }
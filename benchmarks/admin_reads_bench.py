@@ -0,0 +1,127 @@
+"""Benchmark: WAL growth while a slow admin export runs during a sitting.
+
+A writer thread inserts submissions through ``db_writes.run`` (as the
+submit route does) in bursts of ``--burst`` with ``--gap-ms`` pauses in
+between, which is when the background checkpointer copies the WAL back.
+Meanwhile an "export" reads the submissions table slowly, one row every
+``--row-ms`` for at most ``--seconds``, the way a big export holds its
+cursor open while it builds a spreadsheet. Writes go on for two seconds
+more. It runs twice:
+
+* ``get_db(archives=True)``, the read-write connection admin reads used
+  before: its snapshot pins the WAL until the export is done;
+* ``get_read_db()``, the read-only pool: the snapshot guard stops the
+  export after ``--max-snapshot`` seconds (the page answers 503), and the
+  checkpointer catches up.
+
+For each run it prints the rows exported, how the export ended, and the
+largest WAL size and checkpoint lag (``quiz_writes_wal_bytes`` and
+``quiz_writes_checkpoint_lag_seconds``) sampled while it ran.
+
+Usage:
+    python benchmarks/admin_reads_bench.py
+    python benchmarks/admin_reads_bench.py --seconds 20 --max-snapshot 5
+"""
+import argparse
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+from load_test import load_app, seed  # noqa: E402
+
+
+def insert_submission(conn, test_id, respondent_id, details):
+    now = datetime.now(timezone.utc).isoformat()
+    conn.execute("""
+        INSERT INTO submissions (test_id, respondent_id, attempt_no, score, total_points, started_at, finished_at,
+                                 violations_count, violation_reason, details_json)
+        VALUES (?, ?, 1, 10, 25, ?, ?, 0, '', ?)
+    """, (test_id, respondent_id, now, now, details))
+
+
+def run(quiz_app, label, connect, args, test_id):
+    writes = quiz_app.db_writes
+    stop = threading.Event()
+    peaks = {'wal': 0, 'lag': 0.0, 'writes': 0}
+
+    def write():
+        conn = quiz_app.get_db()
+        details = b'\x01' + b'x' * args.row_bytes
+        while not stop.is_set():
+            for _ in range(args.burst):
+                writes.run(conn, insert_submission, test_id, 1, details)
+                peaks['writes'] += 1
+                time.sleep(args.write_ms / 1000.0)
+            time.sleep(args.gap_ms / 1000.0)
+        conn.close()
+
+    def sample():
+        while not stop.is_set():
+            peaks['wal'] = max(peaks['wal'], writes.wal_bytes())
+            peaks['lag'] = max(peaks['lag'], writes.checkpoint_lag())
+            time.sleep(0.1)
+
+    threads = [threading.Thread(target=write), threading.Thread(target=sample)]
+    for t in threads:
+        t.start()
+    time.sleep(1.0)
+    rows, outcome, started = 0, 'finished', time.perf_counter()
+    conn = connect()
+    try:
+        for _ in conn.execute("SELECT id, details_json FROM submissions ORDER BY id"):
+            rows += 1
+            time.sleep(args.row_ms / 1000.0)
+            if time.perf_counter() - started > args.seconds:
+                break
+    except quiz_app.reads.ReadTimeout as e:
+        outcome = f'stopped ({e})'
+    finally:
+        conn.close()
+    export_seconds = time.perf_counter() - started
+    time.sleep(max(0.0, started + args.seconds + 2.0 - time.perf_counter()))
+    stop.set()
+    for t in threads:
+        t.join()
+    print(f'{label:<22} exported {rows:6d} rows in {export_seconds:5.1f}s, {outcome}; '
+          f'{peaks["writes"]} writes, largest WAL {peaks["wal"] / 1e6:6.1f} MB, '
+          f'max checkpoint lag {peaks["lag"]:5.1f}s')
+    writes.checkpoint('TRUNCATE')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=int, default=10, help='longest export')
+    parser.add_argument('--rows', type=int, default=5000, help='submissions in the database before the export')
+    parser.add_argument('--row-ms', type=float, default=2.0, help='export time per row')
+    parser.add_argument('--burst', type=int, default=50, help='submissions per burst')
+    parser.add_argument('--write-ms', type=float, default=2.0, help='pause between two submissions of a burst')
+    parser.add_argument('--gap-ms', type=float, default=500.0, help='pause between two bursts')
+    parser.add_argument('--row-bytes', type=int, default=2000, help='size of a stored details_json')
+    parser.add_argument('--max-snapshot', type=float, default=3.0, help='reads.max_snapshot_seconds')
+    args = parser.parse_args(argv)
+
+    quiz_app = load_app(tempfile.mkdtemp(prefix='quiz-reads-'))
+    seed(quiz_app, 1, 25)
+    quiz_app.admin_reads.max_snapshot = args.max_snapshot
+    quiz_app.db_writes.start()
+    conn = quiz_app.get_db()
+    test_id = conn.execute("SELECT id FROM tests ORDER BY id").fetchone()['id']
+    conn.execute("INSERT INTO respondents (email, name, student_id) VALUES ('bench@load.test', 'Bench', '')")
+    details = b'\x01' + b'x' * args.row_bytes
+    quiz_app.db_writes.run(conn, lambda c: [insert_submission(c, test_id, 1, details) for _ in range(args.rows)])
+    quiz_app.db_writes.checkpoint('TRUNCATE', conn)
+    conn.close()
+
+    run(quiz_app, 'get_db(archives=True)', lambda: quiz_app.get_db(archives=True), args, test_id)
+    run(quiz_app, 'get_read_db()', quiz_app.get_read_db, args, test_id)
+    print('reads:', quiz_app.admin_reads.metrics())
+
+
+if __name__ == '__main__':
+    main()
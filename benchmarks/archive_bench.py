@@ -0,0 +1,136 @@
+"""Benchmark: live database size and scan times before and after archiving.
+
+Fills a scratch database with ``--terms`` past terms of finished sittings
+(``--per-term`` submissions each, with a ``details_json`` like the one the
+submit route writes, a quiz session and a randomization map per
+submission) plus ``--live`` submissions of the sitting in progress. Then it
+times a few queries against the live database, runs
+``archive.archive_ended`` and ``VACUUM``, and times them again:
+
+* a full scan of ``submissions`` (what every unindexed admin filter costs),
+* the current sitting's listing (the dashboard during a sitting),
+* the full history listing through an archive-aware connection
+  (``get_db(archives=True)``), before and after the rows moved.
+
+Usage:
+    python benchmarks/archive_bench.py
+    python benchmarks/archive_bench.py --terms 6 --per-term 20000
+"""
+import argparse
+import json
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+from load_test import load_app  # noqa: E402
+
+QUESTIONS = 25
+
+
+def details(rng):
+    rows = []
+    for i in range(QUESTIONS):
+        given = rng.choice('abcd')
+        rows.append({'qid': f'Q{i}', 'text': f'Question {i}: ' + 'lorem ipsum dolor sit amet ' * 4,
+                     'given_key': given, 'given_text': f'option {given} text', 'correct_key': 'a',
+                     'correct_text': 'option a text', 'correct': given == 'a'})
+    return json.dumps(rows)
+
+
+def fill(conn, args, now):
+    rng = random.Random(args.seed)
+    tests = [r[0] for r in conn.execute("SELECT id FROM tests")]
+    conn.execute("UPDATE tests SET status='active', start_time=?", (now.isoformat(),))
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO respondents (email, name, student_id) VALUES (?, ?, ?)",
+                     [(f's{i}@example.com', f'Student {i}', f'S{i}') for i in range(args.per_term)])
+    sittings = [(now - timedelta(days=120 * (t + 1)), args.per_term) for t in range(args.terms)]
+    sittings.append((now, args.live))
+    for start, count in sittings:
+        for i in range(count):
+            at = (start + timedelta(seconds=i)).isoformat()
+            test_id, respondent = tests[i % len(tests)], i + 1
+            conn.execute("""
+                INSERT INTO submissions (test_id, respondent_id, attempt_no, score, total_points, started_at,
+                                         finished_at, violations_count, violation_reason, details_json)
+                VALUES (?, ?, 1, ?, ?, ?, ?, ?, '', ?)
+            """, (test_id, respondent, rng.randint(0, QUESTIONS), QUESTIONS, at, at, rng.randint(0, 3),
+                  details(rng)))
+            conn.execute("INSERT INTO quiz_sessions (quiz_id, student_id, session_token, start_time, status) "
+                         "VALUES (?, ?, ?, ?, 'closed')", (test_id, respondent, f'{at}-{i}', at))
+            conn.execute("INSERT INTO randomization_maps (test_id, respondent_id, attempt_no, q_order_json) "
+                         "VALUES (?, ?, 1, ?)", (test_id, respondent, json.dumps(list(range(QUESTIONS)))))
+    conn.execute("COMMIT")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def timed(conn, sql, params=(), repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = conn.execute(sql, params).fetchall()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, len(rows)
+
+
+def measure(quiz_app, label, since):
+    live = quiz_app.get_db()
+    history = quiz_app.get_db(archives=True)
+    pages = live.execute("PRAGMA page_count").fetchone()[0]
+    size = quiz_app.DB_PATH.stat().st_size
+    scan = timed(live, "SELECT COUNT(*) FROM submissions WHERE violations_count > 2")
+    sitting = timed(live, """
+        SELECT s.id, r.name, s.score FROM submissions s JOIN respondents r ON s.respondent_id = r.id
+        WHERE s.finished_at >= ? ORDER BY s.finished_at DESC
+    """, (since,))
+    full = timed(history, """
+        SELECT s.id, r.name, s.score FROM submissions s JOIN respondents r ON s.respondent_id = r.id
+        ORDER BY s.finished_at DESC
+    """)
+    live.close()
+    history.close()
+    print(f'{label:<16} {size / 1e6:8.1f} MB {pages:8d} pages  full scan {scan[0]:7.1f} ms  '
+          f'sitting listing {sitting[0]:6.1f} ms ({sitting[1]} rows)  history {full[0]:7.1f} ms ({full[1]} rows)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--terms', type=int, default=4, help='past terms of finished sittings')
+    parser.add_argument('--per-term', type=int, default=5000, help='submissions per past term')
+    parser.add_argument('--live', type=int, default=500, help='submissions of the sitting in progress')
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args(argv)
+
+    quiz_app = load_app(tempfile.mkdtemp(prefix='quiz-archive-'))
+    now = datetime.now(timezone.utc)
+    conn = quiz_app.get_db()
+    started = time.perf_counter()
+    fill(conn, args, now)
+    print(f'filled {args.terms} x {args.per_term} archived + {args.live} live submissions '
+          f'in {time.perf_counter() - started:.1f}s')
+    measure(quiz_app, 'before', now.isoformat())
+
+    started = time.perf_counter()
+    moved = quiz_app.archive.archive_ended(conn, quiz_app.ARCHIVE_DIR, keep_days=30)
+    archived = time.perf_counter() - started
+    started = time.perf_counter()
+    conn.execute("VACUUM")
+    vacuumed = time.perf_counter() - started
+    conn.close()
+    for term, counts in sorted(moved.items()):
+        print(f'  {term}: ' + ', '.join(f'{n} {table}' for table, n in sorted(counts.items())))
+    files = quiz_app.archive.list_archives(quiz_app.ARCHIVE_DIR)
+    print(f'archived in {archived:.1f}s, VACUUM {vacuumed:.1f}s; {len(files)} archive files, '
+          f'{sum(p.stat().st_size for p in files) / 1e6:.1f} MB')
+    measure(quiz_app, 'after', now.isoformat())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Benchmark: writer latency while an online backup runs.
+
+Builds a WAL database of ``--size-mb`` (random 4 KB rows, like a busy term of
+submissions), then runs ``--writers`` threads that each commit one small
+row every ``--interval-ms`` (one submission per commit) and records their
+commit latency:
+
+* with no backup running (baseline),
+* during ``backups.snapshot`` with the whole copy in one step (pages=-1),
+* during ``backups.snapshot`` in page-limited steps (``--pages``/``--sleep-ms``).
+
+For each phase it prints commit latency percentiles and the backup's
+duration, steps and restarts. Everything lives in a temporary directory.
+
+Usage:
+    python benchmarks/backup_bench.py
+    python benchmarks/backup_bench.py --size-mb 2048 --writers 8 --pages 4096
+"""
+import argparse
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import backups  # noqa: E402
+
+
+def build(path, size_mb):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('CREATE TABLE bulk (id INTEGER PRIMARY KEY, payload BLOB)')
+    conn.execute('CREATE TABLE writes (id INTEGER PRIMARY KEY, writer INTEGER, at REAL, payload TEXT)')
+    rows = size_mb * 256   # ~4 KB each
+    batch = 10000
+    for start in range(0, rows, batch):
+        n = min(batch, rows - start)
+        conn.execute('BEGIN')
+        conn.execute(f'WITH RECURSIVE c(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM c WHERE i < {n}) '
+                     'INSERT INTO bulk (payload) SELECT randomblob(4000) FROM c')
+        conn.execute('COMMIT')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+
+
+def run_writers(path, writers, interval, stop):
+    latencies = []
+    lock = threading.Lock()
+
+    def writer(n):
+        conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        mine = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT INTO writes (writer, at, payload) VALUES (?, ?, ?)', (n, time.time(), 'x' * 400))
+            conn.execute('COMMIT')
+            mine.append(time.perf_counter() - start)
+            time.sleep(interval)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    for t in threads:
+        t.start()
+    return threads, latencies
+
+
+def phase(path, args, backup=None):
+    stop = threading.Event()
+    threads, latencies = run_writers(path, args.writers, args.interval_ms / 1000, stop)
+    stats = None
+    started = time.perf_counter()
+    if backup:
+        time.sleep(0.5)   # writers warmed up
+        stats = backup()
+    else:
+        time.sleep(args.baseline_seconds)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for t in threads:
+        t.join()
+    return latencies, stats, elapsed
+
+
+def report(name, latencies, stats, elapsed):
+    ms = sorted(x * 1000 for x in latencies)
+    pct = lambda p: ms[min(len(ms) - 1, int(p / 100 * len(ms)))]
+    line = (f'{name:<22} commits {len(ms):6d} ({len(ms) / elapsed:6.0f}/s)  p50 {statistics.median(ms):6.2f} ms  '
+            f'p99 {pct(99):7.2f} ms  max {ms[-1]:8.2f} ms')
+    if stats:
+        line += (f'  | backup {stats["copy_seconds"]:.2f}s copy, {stats["total_seconds"]:.2f}s total, '
+                 f'{stats["steps"]} steps, {stats["restarts"]} restarts')
+    print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--interval-ms', type=float, default=5, help='pause between one writer\'s commits')
+    parser.add_argument('--pages', type=int, default=1024, help='pages per backup step')
+    parser.add_argument('--sleep-ms', type=float, default=5, help='pause between backup steps')
+    parser.add_argument('--baseline-seconds', type=float, default=3)
+    parser.add_argument('--compress', action='store_true', help='also gzip the snapshots')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='quiz-backup-bench-') as workdir:
+        db = Path(workdir) / 'bench.sqlite3'
+        started = time.perf_counter()
+        build(db, args.size_mb)
+        print(f'built {db.stat().st_size / 1e6:.0f} MB database in {time.perf_counter() - started:.1f}s; '
+              f'{args.writers} writers, one commit each per {args.interval_ms:g} ms')
+        dest = Path(workdir) / 'backups'
+        report('no backup', *phase(db, args))
+        report('backup, one step', *phase(db, args, lambda: backups.snapshot(
+            db, dest, compress=args.compress, pages=-1, sleep=0)))
+        report(f'backup, {args.pages}-page steps', *phase(db, args, lambda: backups.snapshot(
+            db, dest, compress=args.compress, pages=args.pages, sleep=args.sleep_ms / 1000)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Benchmark: bytes on the wire per sitting, with and without compression.
+
+Students sit the quiz end-to-end through the test client (the flow of
+load_test.py), once per ``Accept-Encoding`` offered: none (identity), gzip
+and, with brotli installed, br. Each student starts with an empty browser
+cache, so every ``/static/`` asset an HTML page references is fetched once
+per student. An admin then loads the dashboard, question and credential
+pages. Response bodies are counted as sent (compressed) and decoded for the
+flow.
+
+Run ``flask compress-static`` first to measure the precompressed static
+files; otherwise static text is compressed on the fly (same bytes, more
+CPU).
+
+Usage:
+    python benchmarks/bandwidth_bench.py
+    python benchmarks/bandwidth_bench.py --students 20 --questions 50
+"""
+import argparse
+import gzip
+import random
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+from load_test import TestClientSession, load_app, seed, sit_quiz  # noqa: E402
+
+ASSET_RE = re.compile(r'(?:href|src)="(/static/[^"]+)"')
+ADMIN_PAGES = ['/admin/dashboard', '/admin/questions', '/admin/credentials']
+
+
+def decode(data, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'br':
+        import brotli
+        return brotli.decompress(data)
+    return data
+
+
+class CountingSession(TestClientSession):
+    """Test-client session that counts body bytes and fetches each page's static assets."""
+
+    def __init__(self, flask_app, encoding, totals):
+        super().__init__(flask_app)
+        self.headers = {'Accept-Encoding': encoding} if encoding else {}
+        self.totals = totals
+        self.cached = set()
+
+    def get(self, path, data=None, method='GET'):
+        resp = self.client.open(path, method=method, data=data, headers=self.headers)
+        raw = resp.get_data()
+        kind = 'static' if path.startswith('/static/') else 'pages'
+        self.totals[kind] = self.totals.get(kind, 0) + len(raw)
+        return resp, decode(raw, resp.headers.get('Content-Encoding')).decode('utf-8', 'replace')
+
+    def request(self, method, path, data=None):
+        resp, text = self.get(path, data, method)
+        if resp.mimetype == 'text/html':
+            for asset in ASSET_RE.findall(text):
+                if asset not in self.cached:
+                    self.cached.add(asset)
+                    self.get(asset)
+        return resp.status_code, text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=10, help='students per encoding')
+    parser.add_argument('--questions', type=int, default=25, help='main questions per level')
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    quiz_app = load_app(tempfile.mkdtemp(prefix='quiz-bandwidth-'))
+    encodings = [None] + list(reversed(quiz_app.compression.supported()))
+    seed(quiz_app, args.students * len(encodings), args.questions)
+    submit_path = quiz_app.cfg().submit_path
+
+    print(f'{"encoding":<10} {"pages/student":>14} {"static/student":>15} {"total/student":>14} {"admin pages":>12}')
+    baseline = None
+    for n, encoding in enumerate(encodings):
+        totals = {}
+        for i in range(n * args.students, (n + 1) * args.students):
+            _, error = sit_quiz(lambda: CountingSession(quiz_app.app, encoding, totals), i, submit_path)
+            if error:
+                raise SystemExit(f'student {i}: {error}')
+        admin_totals = {}
+        admin = CountingSession(quiz_app.app, encoding, admin_totals)
+        admin.request('POST', '/admin/login', {'username': 'admin', 'password': 'admin321'})
+        admin_totals.clear()
+        for page in ADMIN_PAGES:
+            admin.request('GET', page)
+        pages, static = totals.get('pages', 0) / args.students, totals.get('static', 0) / args.students
+        total = pages + static
+        baseline = baseline or total
+        print(f'{encoding or "identity":<10} {pages / 1024:11.1f} KB {static / 1024:12.1f} KB {total / 1024:11.1f} KB '
+              f'{admin_totals.get("pages", 0) / 1024:9.1f} KB  ({total / baseline:.0%} of identity)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark: size and speed of the submissions.details_json formats.
+
+Builds a question set of ``--questions`` questions with texts of
+``--text-chars`` characters, grades ``--papers`` random papers against its
+compiled key (as the submit route does) and compares the stored bytes per
+submission and the encode/decode times of:
+
+* version 0: ``json.dumps`` of the grader's details list (the old format),
+* version 1: ``details_codec.encode`` (references + zlib), decoded with the
+  texts resolved from the set's snapshot (admin views, results PDF) and without
+  (answer matrices, re-grading).
+
+Usage:
+    python benchmarks/details_bench.py
+    python benchmarks/details_bench.py --questions 50 --text-chars 400
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import details_codec  # noqa: E402
+import grading  # noqa: E402
+
+
+def question_set(n, text_chars, rng):
+    words = 'the of and a to in is you that it he was for on are as with his they at be this'.split()
+
+    def text(chars):
+        out = []
+        while sum(len(w) + 1 for w in out) < chars:
+            out.append(rng.choice(words))
+        return ' '.join(out).capitalize() + '?'
+
+    return [{'id': f'Q{i}', 'text': text(text_chars), 'image_url': '', 'correct': rng.choice('abcd'),
+             'options': {k: text(text_chars // 6) for k in grading.OPTION_KEYS}} for i in range(n)]
+
+
+def timed(fn, values):
+    start = time.perf_counter()
+    for v in values:
+        fn(v)
+    return (time.perf_counter() - start) / len(values) * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--questions', type=int, default=25)
+    parser.add_argument('--text-chars', type=int, default=160, help='length of a question text')
+    parser.add_argument('--papers', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    key = grading.AnswerKey(1, 0, question_set(args.questions, args.text_chars, rng))
+    qids = [q['id'] for q in key.questions]
+    papers = []
+    for _ in range(args.papers):
+        order = rng.sample(qids, len(qids))
+        answers = {qid: key.by_qid[qid].tokens[rng.choice('abcd')] for qid in order if rng.random() > 0.05}
+        papers.append(key.grade(order, answers)[1])
+
+    old = [json.dumps(d) for d in papers]
+    new = [details_codec.encode(d, key) for d in papers]
+    texts = details_codec.snapshot(key)[1]
+    resolve = lambda digest: texts
+    assert all(details_codec.decode(v, resolve) == d for v, d in zip(new, papers))
+
+    old_size = statistics.mean(len(v.encode('utf-8')) for v in old)
+    new_size = statistics.mean(len(v) for v in new)
+    print(f'{args.papers} papers of {args.questions} questions ({args.text_chars}-char texts)')
+    print(f'{"format":<28} {"bytes/submission":>17} {"encode":>10} {"decode":>10}')
+    print(f'{"v0 json":<28} {old_size:17.0f} {timed(json.dumps, papers):7.1f} us {timed(json.loads, old):7.1f} us')
+    print(f'{"v1 refs+zlib, texts":<28} {new_size:17.0f} {timed(lambda d: details_codec.encode(d, key), papers):7.1f} us '
+          f'{timed(lambda v: details_codec.decode(v, resolve), new):7.1f} us')
+    print(f'{"v1 refs+zlib, no texts":<28} {new_size:17.0f} {"":>10} {timed(details_codec.decode, new):7.1f} us')
+    print(f'saved {1 - new_size / old_size:.0%} per submission')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Microbenchmark: grading one paper with the compiled answer key.
+
+Compares the previous submit_quiz loop (rebuild the option texts for every
+question and scan them for the posted text) with ``AnswerKey.grade`` posting
+option texts and posting option tokens, for 25, 100 and 500-question papers.
+Compilation cost is reported separately since it is paid once per set and
+process.
+
+Usage:
+    python benchmarks/grading_bench.py
+    python benchmarks/grading_bench.py --sizes 25 100 500 1000 --repeat 2000
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import grading  # noqa: E402
+import papers  # noqa: E402
+
+
+def make_questions(n, rng):
+    return [{
+        'id': f'Q{i}',
+        'text': f'Question {i}?',
+        'image_url': '',
+        'options': {k: f'Answer {k.upper()} to question {i}' for k in 'abcd'},
+        'correct': rng.choice('abcd'),
+    } for i in range(n)]
+
+
+def legacy_grade(questions, q_order, options_order, form):
+    """The submit_quiz loop before compiled keys."""
+    mapping = {q['id']: q for q in questions}
+    score = 0.0
+    details = []
+    for qid in q_order:
+        q = mapping[qid]
+        opts_keys = options_order[qid]
+        opts_texts = [q['options'][k] for k in opts_keys]
+        given_text = form.get(qid, '').strip()
+        given_key = None
+        for i, t in enumerate(opts_texts):
+            if t == given_text:
+                given_key = opts_keys[i]
+                break
+        correct = (given_key == q['correct'])
+        if correct:
+            score += 1
+        details.append({'qid': qid, 'text': q['text'], 'given_text': given_text, 'given_key': given_key,
+                        'correct_key': q['correct'], 'correct': correct})
+    return score, details
+
+
+def per_call_us(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def bench(n, repeat, rng):
+    questions = make_questions(n, rng)
+    paper = {'seed': rng.getrandbits(63), 'question_count': n, 'flags': 3, 'prng_version': papers.PRNG_VERSION}
+    q_order, options_order = papers.materialize(paper, questions)
+    key = grading.AnswerKey(1, 0, questions, salt=b'bench')
+    picks = {q['id']: rng.choice('abcd') for q in questions}
+    text_form = {q['id']: q['options'][picks[q['id']]] for q in questions}
+    token_form = {qid: key.by_qid[qid].tokens[k] for qid, k in picks.items()}
+
+    assert legacy_grade(questions, q_order, options_order, text_form)[0] == key.grade(q_order, text_form)[0] \
+        == key.grade(q_order, token_form)[0]
+
+    return {
+        'questions': n,
+        'legacy_us': round(per_call_us(lambda: legacy_grade(questions, q_order, options_order, text_form), repeat), 1),
+        'compiled_text_us': round(per_call_us(lambda: key.grade(q_order, text_form), repeat), 1),
+        'compiled_token_us': round(per_call_us(lambda: key.grade(q_order, token_form), repeat), 1),
+        'compile_us': round(per_call_us(lambda: grading.AnswerKey(1, 0, questions, salt=b'bench'),
+                                        max(1, repeat // 10)), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[25, 100, 500])
+    parser.add_argument('--repeat', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Also write the results as JSON to this file.')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = [bench(n, args.repeat, rng) for n in args.sizes]
+    print(f"{'questions':>9} {'legacy':>10} {'text':>10} {'token':>10} {'compile':>10}   (us per paper)")
+    for r in results:
+        print(f"{r['questions']:>9} {r['legacy_us']:>10} {r['compiled_text_us']:>10} "
+              f"{r['compiled_token_us']:>10} {r['compile_us']:>10}")
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
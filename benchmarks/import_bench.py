@@ -0,0 +1,141 @@
+"""Benchmark: import time and memory of a worker process.
+
+Two measurements, each in a fresh interpreter pointed at a throw-away
+database (the repository's data.sqlite3 is never touched):
+
+1. ``python -X importtime -c "import app"``: total import time of the app and
+   the cumulative share of the heavy packages (numpy, pandas, openpyxl,
+   reportlab, PIL) that it still pulls in at start-up.
+2. Resident memory (VmRSS) and ``lazy.loaded()`` of a worker after importing
+   the app, after a student sits the quiz through the test client and after
+   an admin downloads the Excel export; with ``--eager`` the heavy packages
+   are imported up front, as app.py used to, for comparison.
+
+Usage:
+    python benchmarks/import_bench.py
+    python benchmarks/import_bench.py --eager --repeat 5
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+IMPORTTIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+HEAVY = ('numpy', 'pandas', 'openpyxl', 'reportlab', 'PIL')
+
+
+def scratch_env(workdir):
+    env = dict(os.environ)
+    env['DB_PATH'] = str(Path(workdir) / 'importbench.sqlite3')
+    env['PDF_DIR'] = str(workdir)
+    env['PYTHONPATH'] = os.pathsep.join([str(ROOT), str(ROOT / 'benchmarks'), env.get('PYTHONPATH', '')])
+    return env
+
+
+def import_times(env):
+    """Cumulative import seconds of ``app`` and of each top-level heavy package."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=ROOT, env=env,
+                          capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        m = IMPORTTIME_RE.match(line)
+        if not m:
+            continue
+        name = m.group(4)
+        if name == 'app' or name in HEAVY:
+            # Only the outermost import of a package carries its full cost
+            times[name] = max(times.get(name, 0.0), int(m.group(2)) / 1e6)
+    return times
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child(eager):
+    """Runs in the measured process: prints one JSON line of stages."""
+    stages = []
+
+    def stage(name):
+        stages.append({'stage': name, 'rss_mb': round(rss_mb(), 1), 'loaded': lazy.loaded()})
+
+    start = time.perf_counter()
+    if eager:
+        import numpy, pandas, openpyxl, reportlab.platypus  # noqa: F401,E401
+        import PIL.Image  # noqa: F401
+    import app as quiz_app
+    import lazy
+    import_seconds = time.perf_counter() - start
+    stage('import app')
+
+    from load_test import TestClientSession, seed, sit_quiz
+    quiz_app.init_db()
+    seed(quiz_app, 1, 25)
+    submit_path = quiz_app.cfg().submit_path
+    _, error = sit_quiz(lambda: TestClientSession(quiz_app.app), 0, submit_path)
+    if error:
+        raise SystemExit(f'student flow failed: {error}')
+    stage('student sat the quiz')
+
+    admin = quiz_app.app.test_client()
+    admin.post('/admin/login', data={'username': 'admin', 'password': 'admin321'})
+    resp = admin.get('/admin/export.xlsx')
+    if resp.status_code != 200:
+        raise SystemExit(f'export failed: HTTP {resp.status_code}')
+    stage('admin export')
+    print(json.dumps({'import_seconds': import_seconds, 'stages': stages}))
+
+
+def measure(env, eager):
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = subprocess.run([sys.executable, __file__, '--child'] + (['--eager'] if eager else []),
+                              cwd=ROOT, env=scratch_env(workdir), capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise SystemExit(proc.stderr or proc.stdout)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3, help='import-time runs (median is reported)')
+    parser.add_argument('--eager', action='store_true', help='also measure a worker that imports everything up front')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(args.eager)
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = scratch_env(workdir)
+        runs = [import_times(env) for _ in range(args.repeat)]
+    print(f'import app (median of {args.repeat}):')
+    for name in ('app',) + HEAVY:
+        values = [r[name] for r in runs if name in r]
+        shown = f'{statistics.median(values) * 1000:8.1f} ms' if values else '    not imported'
+        print(f'  {name:<10} {shown}')
+
+    for eager in ([False, True] if args.eager else [False]):
+        result = measure(env, eager)
+        print(f'\nworker ({"eager imports" if eager else "lazy imports"}), import {result["import_seconds"] * 1000:.0f} ms:')
+        for s in result['stages']:
+            print(f'  {s["stage"]:<22} {s["rss_mb"]:7.1f} MB  loaded: {", ".join(s["loaded"]) or "-"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+"""Cohort load test: N virtual students sit the quiz end-to-end.
+
+Each student runs the real flow against the Flask app:
+
+    POST /login -> GET /instructions -> POST /start-tutorial
+    -> POST /tutorial-completed -> POST /start-real-test
+    -> GET /quiz/questions (once per question) -> POST submit
+
+Login and start-real-test go through the admission controller; a student
+who lands in the waiting room polls its status endpoint like the page does
+and re-posts once admitted. Step latencies are those of the admitted
+request, time spent queued is reported as ``waiting_room`` and load shed
+(503) responses are retried and counted.
+
+Credentials and questions are seeded into a throw-away database, so the
+repository's data.sqlite3 is never touched. Per-step latency percentiles and
+overall throughput are printed and written as JSON (tagged with the current
+git commit) so runs can be compared between commits.
+
+Usage:
+    python benchmarks/load_test.py --students 200 --concurrency 20
+    python benchmarks/load_test.py --mode wsgi --students 500 --concurrency 50
+    python benchmarks/load_test.py --mode wsgi --students 1000 --concurrency 200 --max-inflight 4
+    python benchmarks/load_test.py --compare benchmarks/results/load_<old>.json
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import re
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+STEPS = ['login', 'instructions', 'start_tutorial', 'tutorial_completed', 'start_real_test', 'questions', 'submit', 'waiting_room']
+LEVELS = ['NOVAS', 'VOYAGERS', 'TITANS', 'LEGENDS']
+FIRST_BATCH_RE = re.compile(r'remember\((\{.*?\})\);')
+TOTAL_RE = re.compile(r'const totalQuestions = (\d+);')
+TICKET_RE = re.compile(r'data-admission-ticket="([^"]*)"')
+
+
+def load_app(workdir):
+    """Import app.py pointed at a scratch database and PDF directory."""
+    os.environ['DB_PATH'] = str(Path(workdir) / 'loadtest.sqlite3')
+    os.environ['PDF_DIR'] = str(workdir)
+    sys.path.insert(0, str(ROOT))
+    import app as quiz_app
+    quiz_app.init_db()
+    return quiz_app
+
+
+def seed(quiz_app, students, questions):
+    """Create ``students`` credentials and a ``questions``-long main set per level."""
+    conn = quiz_app.get_db()
+    now = datetime.now(timezone.utc).isoformat()
+    conn.execute("BEGIN")
+    conn.execute("UPDATE tests SET status='active', start_time=?", (now,))
+    tests = {r['level']: r['id'] for r in conn.execute("SELECT id, level FROM tests")}
+    for level, test_id in tests.items():
+        for set_type, count in (('main', questions), ('tutorial', 5)):
+            conn.execute("INSERT INTO question_sets (test_id, set_type, imported_at, source_file) VALUES (?,?,?,?)",
+                         (test_id, set_type, now, 'loadtest'))
+            set_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()['id']
+            conn.executemany("""
+                INSERT INTO questions (set_id, question_id, text, image_url, option_a, option_b, option_c, option_d, correct_option)
+                VALUES (?,?,?,?,?,?,?,?,?)
+            """, [(set_id, f'{level}_{set_type}_{i}', f'{set_type} question {i} for {level}?', '',
+                   f'A{i}', f'B{i}', f'C{i}', f'D{i}', random.choice('abcd')) for i in range(1, count + 1)])
+    pwd_hash = quiz_app.hash_password('loadtest')
+    conn.executemany("""
+        INSERT OR REPLACE INTO student_credentials (email, password_hash, name, level, status, created_at)
+        VALUES (?, ?, ?, ?, 'active', ?)
+    """, [(f'student{i}@load.test', pwd_hash, f'Student {i}', LEVELS[i % len(LEVELS)], now) for i in range(students)])
+    conn.execute("COMMIT")
+    conn.close()
+
+
+# ---- clients ----
+
+class TestClientSession:
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def request(self, method, path, data=None):
+        resp = self.client.open(path, method=method, data=data)
+        return resp.status_code, resp.get_data(as_text=True)
+
+
+class HTTPSession:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data or {}).encode() if method == 'POST' else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(req, timeout=60) as resp:
+                return resp.status, resp.read().decode('utf-8', 'replace')
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode('utf-8', 'replace')
+
+
+def start_wsgi_server(flask_app):
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+# ---- the student flow ----
+
+def sit_quiz(make_session, index, submit_path, poll_seconds=0.5, max_wait=300.0):
+    """Run one student through the flow. Returns {step: seconds} and an error (or None)."""
+    s = make_session()
+    timings = {}
+
+    def step(name, method, path, data=None, expect=(200, 302)):
+        queued_at = None
+        while True:
+            start = time.perf_counter()
+            status, body = s.request(method, path, data)
+            timings[name] = time.perf_counter() - start
+            match = TICKET_RE.search(body) if status in (202, 503) else None
+            if not match:
+                break
+            # Waiting room (202) or shed (503): poll like the page does, then re-post
+            queued_at = queued_at or start
+            if time.perf_counter() - queued_at > max_wait:
+                raise RuntimeError(f'{name}: still queued after {max_wait}s')
+            timings['shed'] = timings.get('shed', 0) + (status == 503)
+            ticket = match.group(1)
+            while ticket:
+                time.sleep(poll_seconds)
+                _, poll = s.request('GET', '/waiting-room/status?ticket=' + urllib.parse.quote(ticket))
+                state = json.loads(poll)['state']
+                if state != 'waiting':
+                    ticket = ticket if state == 'admitted' else ''
+                    break
+            if not ticket:
+                time.sleep(poll_seconds)
+            data = dict(data or {}, admission_ticket=ticket)
+        if queued_at is not None:
+            timings['waiting_room'] = timings.get('waiting_room', 0.0) + (start - queued_at)
+        if status not in expect:
+            raise RuntimeError(f'{name}: HTTP {status}')
+        return body
+
+    try:
+        step('login', 'POST', '/login', {'name': f'Student {index}', 'email': f'student{index}@load.test', 'password': 'loadtest'})
+        step('instructions', 'GET', '/instructions')
+        step('start_tutorial', 'POST', '/start-tutorial')
+        step('tutorial_completed', 'POST', '/tutorial-completed')
+        html = step('start_real_test', 'POST', '/start-real-test')
+        first, total = FIRST_BATCH_RE.search(html), TOTAL_RE.search(html)
+        if not first or not total:
+            raise RuntimeError('start_real_test: no questions in page')
+        questions = json.loads(first.group(1))['questions']
+        fetch_time = 0.0
+        for i in range(len(questions), int(total.group(1))):
+            questions += json.loads(step('questions', 'GET', f'/quiz/questions?start={i}', expect=(200,)))['questions']
+            fetch_time += timings['questions']
+        if 'questions' in timings:
+            timings['questions'] = fetch_time / (int(total.group(1)) - 1)
+        form = {q['id']: random.choice(q['options'])[0] for q in questions}
+        step('submit', 'POST', submit_path, form)
+        return timings, None
+    except Exception as e:
+        return timings, str(e)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(results, wall):
+    steps = {}
+    for name in STEPS:
+        values = sorted(t[name] for t, _ in results if name in t)
+        if not values:
+            continue
+        steps[name] = {
+            'count': len(values),
+            'mean_ms': round(statistics.fmean(values) * 1000, 2),
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+            'max_ms': round(values[-1] * 1000, 2),
+            'throughput_rps': round(len(values) / wall, 2),
+        }
+    errors = [e for _, e in results if e]
+    requests = sum(1 for t, _ in results for name in STEPS if name in t and name != 'waiting_room')
+    queued = sum(1 for t, _ in results if 'waiting_room' in t)
+    shed = sum(int(t.get('shed', 0)) for t, _ in results)
+    return {
+        'students': len(results),
+        'completed': len(results) - len(errors),
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:10],
+        'wall_seconds': round(wall, 3),
+        'students_per_second': round((len(results) - len(errors)) / wall, 2),
+        'requests_per_second': round(requests / wall, 2),
+        'queued': queued,
+        'shed_responses': shed,
+        'steps': steps,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(current, baseline_path):
+    baseline = json.loads(Path(baseline_path).read_text())
+    print(f"\nCompared with {baseline_path} (commit {baseline.get('commit')}):")
+    for name, now in current['steps'].items():
+        old = baseline.get('summary', {}).get('steps', {}).get(name)
+        if not old:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            delta = (now[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            flag = '  <-- regression' if delta > 10 else ''
+            print(f"  {name:20s} {key:7s} {old[key]:9.2f} -> {now[key]:9.2f} ({delta:+.1f}%){flag}")
+
+
+def print_summary(summary):
+    print(f"\n{summary['completed']}/{summary['students']} students completed in {summary['wall_seconds']}s "
+          f"({summary['students_per_second']} students/s, {summary['requests_per_second']} req/s, "
+          f"{summary['errors']} errors)")
+    print(f"{summary.get('queued', 0)} students waited in the waiting room, "
+          f"{summary.get('shed_responses', 0)} shed responses")
+    print(f"{'step':20s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'max ms':>9s} {'req/s':>8s}")
+    for name, s in summary['steps'].items():
+        print(f"{name:20s} {s['p50_ms']:9.2f} {s['p95_ms']:9.2f} {s['p99_ms']:9.2f} {s['max_ms']:9.2f} {s['throughput_rps']:8.2f}")
+    for e in summary['error_samples']:
+        print('  error:', e)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--questions', type=int, default=25, help='main questions per level')
+    parser.add_argument('--mode', choices=['testclient', 'wsgi'], default='testclient')
+    parser.add_argument('--output', help='JSON results path (default benchmarks/results/load_<commit>.json)')
+    parser.add_argument('--compare', help='previous JSON results to compare against')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--max-inflight', type=int, help='admission limit for login/start-real-test')
+    parser.add_argument('--max-queue', type=int, help='waiting-room capacity before requests are shed')
+    parser.add_argument('--poll', type=float, default=0.5, help='waiting-room poll interval (seconds)')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix='quiz-loadtest-')
+    quiz_app = load_app(workdir)
+    seed(quiz_app, args.students, args.questions)
+    submit_path = quiz_app.cfg().submit_path
+    if args.max_inflight:
+        quiz_app.admission.max_inflight = args.max_inflight
+    if args.max_queue:
+        quiz_app.admission.max_queue = args.max_queue
+
+    server = None
+    if args.mode == 'wsgi':
+        server, base_url = start_wsgi_server(quiz_app.app)
+        make_session = lambda: HTTPSession(base_url)
+    else:
+        make_session = lambda: TestClientSession(quiz_app.app)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda i: sit_quiz(make_session, i, submit_path, args.poll), range(args.students)))
+    wall = time.perf_counter() - started
+    if server:
+        server.shutdown()
+
+    summary = summarize(results, wall)
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'params': vars(args),
+        'python': sys.version.split()[0],
+        'sqlite': sqlite3.sqlite_version,
+        'summary': summary,
+    }
+    out = Path(args.output) if args.output else ROOT / 'benchmarks' / 'results' / f'load_{commit}.json'
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2))
+
+    print_summary(summary)
+    print(f"\nResults written to {out}")
+    if args.compare:
+        compare(summary, args.compare)
+    return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
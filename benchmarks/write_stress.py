@@ -0,0 +1,157 @@
+"""Stress test: N students submit at the same instant; no submission may be lost.
+
+Every student is first walked through the real flow up to the quiz page
+(login, instructions, tutorial, paper, question batches) through the test
+client. Then ``--writers`` threads, spread over ``--processes`` forked
+worker processes, each hold one student's session and all post the submit
+form at the same wall-clock instant. Afterwards the number of submission
+rows is compared with the number of students, and the run reports failed
+responses, write-unit retries, checkpoints and the largest WAL seen.
+
+``--retries 0 --busy-timeout-ms 50`` approximates the old behaviour
+(autocommit statements with a short wait) for comparison.
+
+Usage:
+    python benchmarks/write_stress.py
+    python benchmarks/write_stress.py --writers 1000 --processes 4
+    python benchmarks/write_stress.py --retries 0 --busy-timeout-ms 50
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+from load_test import FIRST_BATCH_RE, TOTAL_RE, TestClientSession, load_app, seed  # noqa: E402
+
+
+def prepare(quiz_app, index):
+    """Walk student ``index`` up to the quiz page. Returns ``(session, form)``."""
+    s = TestClientSession(quiz_app.app)
+    steps = [('POST', '/login', {'name': f'Student {index}', 'email': f'student{index}@load.test',
+                                 'password': 'loadtest'}),
+             ('GET', '/instructions', None), ('POST', '/start-tutorial', None),
+             ('POST', '/tutorial-completed', None)]
+    for method, path, data in steps:
+        status, _ = s.request(method, path, data)
+        if status not in (200, 302):
+            raise RuntimeError(f'student {index}: {path} HTTP {status}')
+    status, html = s.request('POST', '/start-real-test')
+    first, total = FIRST_BATCH_RE.search(html), TOTAL_RE.search(html)
+    if status != 200 or not first or not total:
+        raise RuntimeError(f'student {index}: no quiz page (HTTP {status})')
+    questions = json.loads(first.group(1))['questions']
+    for i in range(len(questions), int(total.group(1))):
+        questions += json.loads(s.request('GET', f'/quiz/questions?start={i}')[1])['questions']
+    return s, {q['id']: random.choice(q['options'])[0] for q in questions}
+
+
+def submit_all(students, submit_path, start_at):
+    """Post every student's form from its own thread at ``start_at``. Returns failures."""
+    failures = []
+    lock = threading.Lock()
+
+    def one(student):
+        session, form = student
+        time.sleep(max(0.0, start_at - time.time()))
+        try:
+            status, _ = session.request('POST', submit_path, form)
+            error = None if status == 200 else f'HTTP {status}'
+        except Exception as e:
+            error = repr(e)
+        if error:
+            with lock:
+                failures.append(error)
+
+    threads = [threading.Thread(target=one, args=(s,)) for s in students]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return failures
+
+
+def worker(quiz_app, students, submit_path, start_at, results):
+    failures = submit_all(students, submit_path, start_at)
+    results.put({'failures': failures, 'writes': quiz_app.db_writes.metrics()})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=1000, help='students submitting at once')
+    parser.add_argument('--processes', type=int, default=4, help='worker processes sharing the writers')
+    parser.add_argument('--questions', type=int, default=25)
+    parser.add_argument('--busy-timeout-ms', type=int, default=None, help='default: writes.busy_timeout_ms')
+    parser.add_argument('--retries', type=int, default=None, help='default: writes.retries')
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    quiz_app = load_app(tempfile.mkdtemp(prefix='quiz-write-stress-'))
+    writes = quiz_app.db_writes
+    if args.busy_timeout_ms is not None:
+        writes.busy_timeout_ms = args.busy_timeout_ms
+    if args.retries is not None:
+        writes.retries = args.retries
+    seed(quiz_app, args.writers, args.questions)
+    submit_path = quiz_app.cfg().submit_path
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(4) as pool:   # below the admission limit, so nobody waits in the waiting room
+        students = list(pool.map(lambda i: prepare(quiz_app, i), range(args.writers)))
+    print(f'{args.writers} students at the submit button in {time.perf_counter() - started:.0f}s; '
+          f'busy_timeout {writes.busy_timeout_ms} ms, {writes.retries} retries, '
+          f'checkpointer {"on" if writes.checkpointer else "off"}')
+
+    wal_max = [0]
+    sampling = threading.Event()
+
+    def sample_wal():
+        while not sampling.is_set():
+            wal_max[0] = max(wal_max[0], writes.wal_bytes())
+            time.sleep(0.05)
+
+    threading.Thread(target=sample_wal, daemon=True).start()
+    before = writes.metrics()   # every forked worker starts from these counts
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    start_at = time.time() + 2.0 + args.writers / 500
+    shares = [students[p::args.processes] for p in range(args.processes)]
+    procs = [ctx.Process(target=worker, args=(quiz_app, share, submit_path, start_at, results)) for share in shares]
+    for p in procs:
+        p.start()
+    reports = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    wall = time.time() - start_at
+    sampling.set()
+
+    conn = sqlite3.connect(quiz_app.DB_PATH)
+    stored = conn.execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+    conn.close()
+    failures = [f for r in reports for f in r['failures']]
+    totals = {}
+    for r in reports:
+        for name, value in r['writes'].items():
+            if isinstance(value, int) and not name.startswith(('wal_', 'last_')):
+                totals[name] = totals.get(name, 0) + value - before[name]
+    print(f'submit burst drained in {wall:.1f}s')
+    print(f'submissions stored {stored}/{args.writers}, lost {args.writers - stored}, failed responses {len(failures)}'
+          + (f' (e.g. {sorted(set(failures))[:3]})' if failures else ''))
+    print(f"write units {totals.get('units', 0)}, retries {totals.get('retries', 0)}, "
+          f"gave up {totals.get('gave_up', 0)}; largest WAL {wal_max[0] / 1e6:.1f} MB")
+    print('no submissions lost' if stored == args.writers and not failures else 'SUBMISSIONS LOST')
+    return 0 if stored == args.writers else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""Bulk mail jobs (credentials and certificates for a whole cohort).
+
+A job is a row in ``bulk_mail_jobs`` plus one ``bulk_mail_recipients`` row per
+address. Recipients move ``pending -> queued -> sent/failed``. The move to
+``queued`` happens in the same transaction that inserts the message into the
+mailer's ``mail_queue``, and only if the row is still ``pending``. A crashed
+or concurrently resumed run therefore never queues the same recipient twice.
+
+Runners keep at most ``max_in_flight`` of their messages waiting in the mail
+queue, so a 5000-student run is fed to the SMTP pool gradually and login code
+emails (higher priority) are never stuck behind it.
+"""
+import json
+import threading
+import time
+from datetime import datetime, timezone
+
+
+JOB_KINDS = ('credentials', 'certificates')
+BULK_PRIORITY = 5
+
+
+class BulkMailer:
+    """Creates, runs and reports on bulk mail jobs."""
+
+    def __init__(self, mailer, render, attachments_for=None, max_in_flight=100, chunk_size=25, poll_interval=1.0):
+        """``render(kind, context)`` returns ``(subject, body)`` for one recipient.
+
+        ``attachments_for(kind, recipient)`` returns ``(filename, path)`` pairs
+        and is called only when that recipient is about to be queued, so
+        certificate PDFs are generated lazily.
+        """
+        self.mailer = mailer
+        self.render = render
+        self.attachments_for = attachments_for or (lambda kind, recipient: [])
+        self.max_in_flight = int(max_in_flight)
+        self.chunk_size = int(chunk_size)
+        self.poll_interval = float(poll_interval)
+        self._runners = {}
+        self._lock = threading.Lock()
+        self._schema_ready = False
+
+    def connect(self):
+        conn = self.mailer.connect()
+        if not self._schema_ready:
+            ensure_schema(conn)
+            self._schema_ready = True
+        return conn
+
+    # ---- job creation ----
+
+    def create_job(self, kind, recipients, params=None):
+        """Create a job for ``recipients`` (dicts with ``email`` and optional
+        ``respondent_id``, ``submission_id`` and ``context``). Duplicate
+        addresses are collapsed. Returns the job id."""
+        if kind not in JOB_KINDS:
+            raise ValueError(f'unknown bulk mail kind: {kind}')
+        now = datetime.now(timezone.utc).isoformat()
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN")
+            cur = conn.execute("INSERT INTO bulk_mail_jobs (kind, status, params_json, created_at) VALUES (?, 'running', ?, ?)",
+                               (kind, json.dumps(params or {}), now))
+            job_id = cur.lastrowid
+            conn.executemany("""
+                INSERT OR IGNORE INTO bulk_mail_recipients
+                    (job_id, email, respondent_id, submission_id, context_json, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, 'pending', ?)
+            """, [(job_id, r['email'], r.get('respondent_id'), r.get('submission_id'),
+                   json.dumps(r.get('context') or {}), now) for r in recipients])
+            total = conn.execute("SELECT COUNT(*) AS c FROM bulk_mail_recipients WHERE job_id=?", (job_id,)).fetchone()['c']
+            conn.execute("UPDATE bulk_mail_jobs SET total=? WHERE id=?", (total, job_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return job_id
+
+    # ---- running ----
+
+    def start(self, job_id):
+        """Run ``job_id`` on a background thread unless already running here."""
+        with self._lock:
+            runner = self._runners.get(job_id)
+            if runner and runner.is_alive():
+                return runner
+            runner = threading.Thread(target=self._run_safely, args=(job_id,), name=f'bulk-mail-{job_id}', daemon=True)
+            self._runners[job_id] = runner
+        runner.start()
+        return runner
+
+    def is_running(self, job_id):
+        runner = self._runners.get(job_id)
+        return bool(runner and runner.is_alive())
+
+    def resume_all(self):
+        """Restart every job left in 'running' state (e.g. after a crash)."""
+        conn = self.connect()
+        try:
+            ids = [r['id'] for r in conn.execute("SELECT id FROM bulk_mail_jobs WHERE status='running'")]
+        finally:
+            conn.close()
+        for job_id in ids:
+            self.start(job_id)
+        return ids
+
+    def _run_safely(self, job_id):
+        try:
+            self.run(job_id)
+        except Exception as e:
+            print('[BULK MAIL] job', job_id, 'stopped:', e)
+
+    def run(self, job_id):
+        """Feed the job's pending recipients to the mail queue until done."""
+        conn = self.connect()
+        try:
+            job = conn.execute("SELECT kind, params_json, status FROM bulk_mail_jobs WHERE id=?", (job_id,)).fetchone()
+            if not job or job['status'] != 'running':
+                return
+            params = json.loads(job['params_json'] or '{}')
+            while True:
+                self._sync(conn, job_id)
+                in_flight = self._in_flight(conn, job_id)
+                room = self.max_in_flight - in_flight
+                if room <= 0:
+                    time.sleep(self.poll_interval)
+                    continue
+                rows = conn.execute("""
+                    SELECT id, email, respondent_id, submission_id, context_json FROM bulk_mail_recipients
+                    WHERE job_id=? AND status='pending' ORDER BY id LIMIT ?
+                """, (job_id, min(room, self.chunk_size))).fetchall()
+                if rows:
+                    self._queue_chunk(conn, job['kind'], params, rows)
+                    continue
+                if in_flight:
+                    time.sleep(self.poll_interval)
+                    continue
+                self._finish_job(conn, job_id)
+                return
+        finally:
+            conn.close()
+
+    def _queue_chunk(self, conn, kind, params, rows):
+        # Render and build attachments outside the write transaction.
+        prepared = []
+        for row in rows:
+            recipient = dict(row)
+            context = dict(params)
+            context.update(json.loads(row['context_json'] or '{}'))
+            context.setdefault('email', row['email'])
+            try:
+                subject, body = self.render(kind, context)
+                attachments = self.attachments_for(kind, recipient)
+            except Exception as e:
+                prepared.append((row, None, None, None, e))
+                continue
+            prepared.append((row, subject, body, attachments, None))
+
+        now = datetime.now(timezone.utc).isoformat()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row, subject, body, attachments, error in prepared:
+                if error is not None:
+                    conn.execute("""
+                        UPDATE bulk_mail_recipients SET status='failed', last_error=?, updated_at=?
+                        WHERE id=? AND status='pending'
+                    """, (str(error)[:500], now, row['id']))
+                    continue
+                claimed = conn.execute("""
+                    UPDATE bulk_mail_recipients SET status='queued', updated_at=?
+                    WHERE id=? AND status='pending'
+                """, (now, row['id'])).rowcount
+                if not claimed:
+                    continue
+                mail_id = self.mailer.enqueue(row['email'], subject, body, attachments=attachments, conn=conn,
+                                              priority=BULK_PRIORITY, sensitive=(kind == 'credentials'))
+                # The rendered message is in the mail queue now; drop any secrets.
+                conn.execute("UPDATE bulk_mail_recipients SET mail_id=?, context_json=NULL WHERE id=?",
+                             (mail_id, row['id']))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _in_flight(self, conn, job_id):
+        return conn.execute("""
+            SELECT COUNT(*) AS c FROM bulk_mail_recipients r JOIN mail_queue m ON m.id = r.mail_id
+            WHERE r.job_id=? AND r.status='queued' AND m.status IN ('queued', 'sending')
+        """, (job_id,)).fetchone()['c']
+
+    def _sync(self, conn, job_id):
+        """Copy final delivery states from mail_queue onto the recipients."""
+        conn.execute("""
+            UPDATE bulk_mail_recipients
+            SET status=(SELECT m.status FROM mail_queue m WHERE m.id=bulk_mail_recipients.mail_id),
+                last_error=(SELECT m.last_error FROM mail_queue m WHERE m.id=bulk_mail_recipients.mail_id),
+                updated_at=?
+            WHERE job_id=? AND status='queued'
+              AND (SELECT m.status FROM mail_queue m WHERE m.id=bulk_mail_recipients.mail_id) IN ('sent', 'failed')
+        """, (datetime.now(timezone.utc).isoformat(), job_id))
+
+    def _finish_job(self, conn, job_id):
+        counts = self._counts(conn, job_id)
+        conn.execute("UPDATE bulk_mail_jobs SET status='done', sent=?, failed=?, finished_at=? WHERE id=?",
+                     (counts.get('sent', 0), counts.get('failed', 0), datetime.now(timezone.utc).isoformat(), job_id))
+
+    # ---- reporting ----
+
+    def _counts(self, conn, job_id):
+        return {r['status']: r['c'] for r in conn.execute(
+            "SELECT status, COUNT(*) AS c FROM bulk_mail_recipients WHERE job_id=? GROUP BY status", (job_id,))}
+
+    def list_jobs(self, limit=50):
+        """Recent jobs with per-status recipient counts."""
+        conn = self.connect()
+        try:
+            self._sync_running(conn)
+            jobs = []
+            for job in conn.execute("""
+                SELECT id, kind, status, total, created_at, finished_at FROM bulk_mail_jobs
+                ORDER BY id DESC LIMIT ?
+            """, (limit,)).fetchall():
+                item = dict(job)
+                item['counts'] = self._counts(conn, job['id'])
+                item['runner_alive'] = self.is_running(job['id'])
+                jobs.append(item)
+            return jobs
+        finally:
+            conn.close()
+
+    def _sync_running(self, conn):
+        for r in conn.execute("SELECT id FROM bulk_mail_jobs WHERE status='running'").fetchall():
+            self._sync(conn, r['id'])
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS bulk_mail_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            status TEXT DEFAULT 'running',
+            params_json TEXT,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created_at TEXT,
+            finished_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS bulk_mail_recipients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER,
+            email TEXT,
+            respondent_id INTEGER,
+            submission_id INTEGER,
+            context_json TEXT,
+            status TEXT DEFAULT 'pending',
+            mail_id INTEGER,
+            last_error TEXT,
+            updated_at TEXT,
+            UNIQUE(job_id, email)
+        );
+        CREATE INDEX IF NOT EXISTS idx_bulk_mail_recipients_status ON bulk_mail_recipients(job_id, status);
+    """)
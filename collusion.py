@@ -0,0 +1,199 @@
+"""Answer-similarity (collusion) detection.
+
+Each submission of a test is encoded as a bit vector with one bit per
+(question, wrong option): bit ``4*j + k`` is set when the student picked
+option ``k`` on question ``j`` and it was wrong. Sharing the same *wrong*
+answers is what distinguishes copying from two students simply both being
+good.
+
+Comparing every pair is O(n^2), so candidates are found with MinHash LSH:
+``bands`` x ``rows`` MinHash values per submission, and two submissions become
+a candidate pair when all values of any band match. Candidate pairs are then
+scored exactly, vectorized over packed bits: shared wrong answers, the
+Jaccard similarity of the two wrong-answer sets, and how far the sharing
+exceeds what two independent students of the same ability would show given
+the cohort's popular distractors. Pairs passing all thresholds replace the
+test's rows in ``collusion_flags``.
+"""
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from lazy import numpy as np
+
+
+DEFAULTS = {
+    'min_wrong': 3,        # ignore submissions with fewer wrong answers
+    'min_shared': 5,       # flagged pairs share at least this many identical wrong answers
+    'min_jaccard': 0.5,    # ... with at least this Jaccard similarity of their wrong-answer sets
+    'min_z': 4.5,          # ... and this many standard deviations above the chance agreement
+    'bands': 25,
+    'rows': 4,
+    'max_bucket': 500,     # skip LSH buckets bigger than this (a wrong answer nearly everyone gives)
+    'seed': 0x5EED,
+}
+
+
+@lru_cache(maxsize=None)
+def _popcount_table():
+    return np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def wrong_answer_bits(matrix):
+    """``(n, 4 * questions)`` bool matrix of wrong picks from an :class:`analytics.AnswerMatrix`."""
+    chosen = matrix.chosen.astype(np.intp)      # 0 = none, 1-4 = a-d
+    wrong = matrix.present & ~matrix.correct & (chosen > 0)
+    n, q = chosen.shape
+    bits = np.zeros((n, q, 4), dtype=bool)
+    rows, cols = np.nonzero(wrong)
+    bits[rows, cols, chosen[rows, cols] - 1] = True
+    return bits.reshape(n, q * 4)
+
+
+def minhash_signatures(bits, num_hashes, seed):
+    """MinHash signature per row (``n x num_hashes``, uint16); empty rows get all ``F``."""
+    n, features = bits.shape
+    rng = np.random.default_rng(seed)
+    sig = np.empty((n, num_hashes), dtype=np.uint16)
+    for h in range(num_hashes):
+        ranks = rng.permutation(features).astype(np.uint16)
+        sig[:, h] = np.where(bits, ranks[np.newaxis, :], features).min(axis=1)
+    return sig
+
+
+def candidate_pairs(sig, bands, rows, max_bucket):
+    """Unique ``(i, j)`` index pairs (``i < j``) that share at least one LSH band."""
+    found = []
+    skipped = 0
+    for b in range(bands):
+        band = np.ascontiguousarray(sig[:, b * rows:(b + 1) * rows])
+        _, bucket = np.unique(band.view(np.dtype((np.void, band.dtype.itemsize * rows))).ravel(),
+                              return_inverse=True)
+        order = np.argsort(bucket, kind='stable')
+        sorted_buckets = bucket[order]
+        starts = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+        sizes = np.diff(np.r_[starts, len(order)])
+        skipped += int((sizes > max_bucket).sum())
+        for s, size in zip(starts[(sizes >= 2) & (sizes <= max_bucket)], sizes[(sizes >= 2) & (sizes <= max_bucket)]):
+            members = order[s:s + size]
+            i, j = np.triu_indices(size, k=1)
+            found.append(np.stack([members[i], members[j]], axis=1))
+    if not found:
+        return np.empty((0, 2), dtype=np.intp), skipped
+    pairs = np.concatenate(found)
+    pairs.sort(axis=1)
+    return np.unique(pairs, axis=0), skipped
+
+
+def score_pairs(packed, pairs):
+    """Shared wrong answers and Jaccard similarity for each pair (vectorized popcounts)."""
+    a, b = packed[pairs[:, 0]], packed[pairs[:, 1]]
+    popcount = _popcount_table()
+    shared = popcount[a & b].sum(axis=1, dtype=np.int64)
+    union = popcount[a | b].sum(axis=1, dtype=np.int64)
+    jaccard = np.divide(shared, union, out=np.zeros(len(pairs)), where=union > 0)
+    return shared, jaccard
+
+
+def chance_agreement(bits, questions):
+    """Per-submission wrong rates and the cohort's same-wrong-option concentration.
+
+    Two independent students, wrong on question ``j`` with probabilities
+    ``w_a`` and ``w_b``, pick the same wrong option with probability
+    ``w_a * w_b * sum_k q_jk^2``, where ``q_jk`` is the share of option ``k``
+    among the cohort's wrong answers to ``j``. Summed over questions the
+    expected number of shared wrong answers is ``w_a * w_b * S``.
+    """
+    counts = bits.reshape(len(bits), questions, 4).sum(axis=0, dtype=np.float64)   # questions x 4
+    totals = counts.sum(axis=1, keepdims=True)
+    shares = np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+    concentration = float((shares ** 2).sum())
+    wrong_rate = bits.sum(axis=1) / float(questions)
+    return wrong_rate, concentration
+
+
+def detect(matrix, **options):
+    """Return ``(flags, stats)`` for an answer matrix.
+
+    ``flags`` is a list of ``(submission_a, submission_b, shared_wrong, jaccard)``.
+    """
+    opts = dict(DEFAULTS, **options)
+    bits = wrong_answer_bits(matrix)
+    wrong_counts = bits.sum(axis=1)
+    eligible = np.flatnonzero(wrong_counts >= opts['min_wrong'])
+    stats = {'submissions': len(matrix), 'eligible': int(eligible.size), 'candidates': 0, 'flagged': 0,
+             'skipped_buckets': 0}
+    if eligible.size < 2:
+        return [], stats
+
+    bits = bits[eligible]
+    sig = minhash_signatures(bits, opts['bands'] * opts['rows'], opts['seed'])
+    pairs, stats['skipped_buckets'] = candidate_pairs(sig, opts['bands'], opts['rows'], opts['max_bucket'])
+    stats['candidates'] = int(len(pairs))
+    if not len(pairs):
+        return [], stats
+
+    shared, jaccard = score_pairs(np.packbits(bits, axis=1), pairs)
+    wrong_rate, concentration = chance_agreement(bits, len(matrix.qids))
+    expected = wrong_rate[pairs[:, 0]] * wrong_rate[pairs[:, 1]] * concentration
+    z = (shared - expected) / np.sqrt(np.maximum(expected, 1.0))
+    keep = (shared >= opts['min_shared']) & (jaccard >= opts['min_jaccard']) & (z >= opts['min_z'])
+    ids = np.asarray(matrix.submission_ids)[eligible]
+    flags = [(int(ids[i]), int(ids[j]), int(s), round(float(jc), 3))
+             for (i, j), s, jc in zip(pairs[keep], shared[keep], jaccard[keep])]
+    flags.sort(key=lambda f: (-f[3], -f[2]))
+    stats['flagged'] = len(flags)
+    return flags, stats
+
+
+def save_flags(conn, test_id, flags):
+    """Replace the stored flags of ``test_id`` in one transaction."""
+    now = datetime.now(timezone.utc).isoformat()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM collusion_flags WHERE test_id=?", (test_id,))
+        conn.executemany("""
+            INSERT INTO collusion_flags (test_id, submission_a, submission_b, shared_wrong, jaccard, detected_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(test_id, a, b, shared, jac, now) for a, b, shared, jac in flags])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def flags_for_submission(conn, submission_id):
+    """Flagged pairs involving ``submission_id``, most similar first."""
+    return [dict(r) for r in conn.execute("""
+        SELECT f.shared_wrong, f.jaccard, f.detected_at,
+               CASE WHEN f.submission_a = ? THEN f.submission_b ELSE f.submission_a END AS other_id,
+               r.name AS other_name, r.email AS other_email
+        FROM collusion_flags f
+        JOIN submissions s ON s.id = CASE WHEN f.submission_a = ? THEN f.submission_b ELSE f.submission_a END
+        JOIN respondents r ON r.id = s.respondent_id
+        WHERE f.submission_a = ? OR f.submission_b = ?
+        ORDER BY f.jaccard DESC
+    """, (submission_id, submission_id, submission_id, submission_id))]
+
+
+def flags_for_test(conn, test_id, limit=200):
+    return [dict(r) for r in conn.execute("""
+        SELECT submission_a, submission_b, shared_wrong, jaccard, detected_at FROM collusion_flags
+        WHERE test_id=? ORDER BY jaccard DESC, shared_wrong DESC LIMIT ?
+    """, (test_id, limit))]
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS collusion_flags (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            test_id INTEGER,
+            submission_a INTEGER,
+            submission_b INTEGER,
+            shared_wrong INTEGER,
+            jaccard REAL,
+            detected_at TEXT,
+            UNIQUE(test_id, submission_a, submission_b)
+        );
+        CREATE INDEX IF NOT EXISTS idx_collusion_flags_a ON collusion_flags(submission_a);
+        CREATE INDEX IF NOT EXISTS idx_collusion_flags_b ON collusion_flags(submission_b);
+    """)
@@ -0,0 +1,258 @@
+"""Response compression: negotiated gzip/Brotli and precompressed static files.
+
+:class:`CompressionMiddleware` wraps the WSGI app. When the client's
+``Accept-Encoding`` allows it, text responses (HTML, CSS, JS, JSON, SVG, CSV)
+larger than ``min_size`` are compressed:
+
+* buffered responses (known ``Content-Length``) in one go, with the new
+  length set;
+* streamed responses (no length, e.g. ``stream_template``) chunk by chunk,
+  flushing after every chunk so the browser can render as rows arrive.
+
+Responses that already carry ``Content-Encoding`` (precompressed static files,
+downloads) or ``Cache-Control: no-transform`` are passed through. A strong
+ETag gets the encoding appended (``"<etag>-gzip"``) because the bytes differ;
+the suffix is stripped from ``If-None-Match`` before the app sees it, so
+conditional requests still match.
+
+For static files, :func:`precompress_tree` writes ``.gz`` (and ``.br``)
+siblings at build time (``flask compress-static``) and
+:func:`precompressed` picks the best one the client accepts, so CSS and SVGs
+cost no CPU per request.
+
+Brotli is optional (``pip install brotli``); without it only gzip is offered.
+"""
+import gzip
+import os
+import re
+import zlib
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+
+DEFAULTS = {
+    'enabled': True,
+    'min_size': 1024,
+    'gzip_level': 6,
+    'brotli_quality': 5,
+}
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+STATIC_EXTS = {'.css', '.js', '.svg', '.html', '.json', '.txt', '.csv', '.xml'}
+_ETAG_SUFFIX_RE = re.compile(r'-(?:gzip|br)"')
+_SUFFIX = {'gzip': '.gz', 'br': '.br'}
+
+
+def supported():
+    return ('br', 'gzip') if brotli else ('gzip',)
+
+
+def negotiate(accept_encoding, available=None):
+    """The preferred encoding in ``available`` that ``accept_encoding`` allows, or ``None``."""
+    available = available or supported()
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    best, best_q = None, 0.0
+    for name in available:   # in server preference order, so ties go to the first
+        q = accepted.get(name, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+class _Encoder:
+    def __init__(self, encoding, gzip_level, brotli_quality):
+        if encoding == 'br':
+            self._c = brotli.Compressor(quality=brotli_quality)
+            self._process, self._flush, self._finish = self._c.process, self._c.flush, self._c.finish
+        else:
+            self._c = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+            self._process = self._c.compress
+            self._flush = lambda: self._c.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = self._c.flush
+
+    def chunk(self, data):
+        return self._process(data) + self._flush()
+
+    def finish(self, data=b''):
+        return self._process(data) + self._finish()
+
+
+class CompressionMiddleware:
+    """WSGI middleware compressing text responses for clients that accept it."""
+
+    def __init__(self, app, enabled=True, min_size=1024, gzip_level=6, brotli_quality=5):
+        self.app = app
+        self.enabled = enabled
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __call__(self, environ, start_response):
+        inm = environ.get('HTTP_IF_NONE_MATCH')
+        if inm:
+            environ['HTTP_IF_NONE_MATCH'] = _ETAG_SUFFIX_RE.sub('"', inm)
+        encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING')) if self.enabled else None
+        if not encoding or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+
+        started = {}
+
+        def capture(status, headers, exc_info=None):
+            started.update(status=status, headers=headers, exc_info=exc_info)
+            return self._no_write
+
+        body = self.app(environ, capture)
+        if not started:   # Flask starts the response before returning; anything else is passed through
+            return body
+        status, headers = started['status'], started['headers']
+        length = _header(headers, 'Content-Length')
+        if status.startswith('304') and inm and f'-{encoding}"' in inm:
+            # Not modified: repeat the ETag of the compressed copy the client holds
+            headers = [(k, v[:-1] + f'-{encoding}"' if k.lower() == 'etag' and v.endswith('"') else v)
+                       for k, v in headers]
+        if not self._should_compress(status, headers, length):
+            start_response(status, headers, started['exc_info'])
+            return body
+
+        headers = [(k, v) for k, v in headers if k.lower() not in ('content-length', 'etag')] + [
+            ('Content-Encoding', encoding)]
+        etag = _header(started['headers'], 'ETag')
+        if etag:
+            headers.append(('ETag', etag[:-1] + f'-{encoding}"' if etag.endswith('"') else etag))
+        vary = _header(headers, 'Vary')
+        if not vary:
+            headers.append(('Vary', 'Accept-Encoding'))
+        elif 'accept-encoding' not in vary.lower():
+            headers = [(k, f'{v}, Accept-Encoding' if k.lower() == 'vary' else v) for k, v in headers]
+        encoder = _Encoder(encoding, self.gzip_level, self.brotli_quality)
+
+        if length is not None:
+            try:
+                data = b''.join(body)
+            finally:
+                _close(body)
+            compressed = encoder.finish(data)
+            self.bytes_in += len(data)
+            self.bytes_out += len(compressed)
+            start_response(status, headers + [('Content-Length', str(len(compressed)))], started['exc_info'])
+            return [compressed]
+
+        start_response(status, headers, started['exc_info'])
+        return self._stream(body, encoder)
+
+    def _stream(self, body, encoder):
+        try:
+            for data in body:
+                if data:
+                    self.bytes_in += len(data)
+                    out = encoder.chunk(data)
+                    self.bytes_out += len(out)
+                    yield out
+            out = encoder.finish()
+            self.bytes_out += len(out)
+            yield out
+        finally:
+            _close(body)
+
+    def _should_compress(self, status, headers, length):
+        code = int(status.split(None, 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+        if _header(headers, 'Content-Encoding') or 'no-transform' in (_header(headers, 'Cache-Control') or ''):
+            return False
+        if not (_header(headers, 'Content-Type') or '').startswith(COMPRESSIBLE_TYPES):
+            return False
+        return length is None or int(length) >= self.min_size
+
+    @staticmethod
+    def _no_write(data):
+        raise RuntimeError('CompressionMiddleware does not support the WSGI write() callable')
+
+    def metrics(self):
+        return {'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _close(body):
+    close = getattr(body, 'close', None)
+    if close:
+        close()
+
+
+# ---- precompressed static files ----
+
+def precompressed(static_dir, filename, accept_encoding):
+    """``(encoding, filename)`` of the best precompressed sibling of ``filename`` the client accepts, or ``None``."""
+    if os.path.splitext(filename)[1].lower() not in STATIC_EXTS:
+        return None
+    source = Path(static_dir) / filename
+    try:
+        mtime = source.stat().st_mtime
+    except OSError:
+        return None
+    available = []
+    for enc in ('br', 'gzip'):
+        try:
+            # A sibling older than its source is stale (edited since the last compress-static)
+            if (Path(static_dir) / (filename + _SUFFIX[enc])).stat().st_mtime >= mtime:
+                available.append(enc)
+        except OSError:
+            pass
+    encoding = negotiate(accept_encoding, available) if available else None
+    return (encoding, filename + _SUFFIX[encoding]) if encoding else None
+
+
+def precompress_tree(static_dir, min_size=256):
+    """Write ``.gz``/``.br`` siblings for the text files under ``static_dir``. Returns (files, bytes before, bytes after)."""
+    files, before, after = 0, 0, 0
+    for path in sorted(Path(static_dir).rglob('*')):
+        if not path.is_file() or path.suffix.lower() not in STATIC_EXTS:
+            continue
+        data = path.read_bytes()
+        if len(data) < min_size:
+            continue
+        files += 1
+        before += len(data)
+        best = len(data)
+        variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli:
+            variants['.br'] = brotli.compress(data, quality=11)
+        for suffix, encoded in variants.items():
+            target = path.with_name(path.name + suffix)
+            if len(encoded) >= len(data):
+                if target.exists():
+                    target.unlink()
+                continue
+            if not target.exists() or target.read_bytes() != encoded:
+                tmp = target.with_name(target.name + '.tmp')
+                tmp.write_bytes(encoded)
+                os.replace(tmp, target)
+            best = min(best, len(encoded))
+        after += best
+    return files, before, after
@@ -0,0 +1,236 @@
+"""Storage format of ``submissions.details_json``.
+
+The grader's details list repeats, for every answer, the question text and
+the text of the chosen option, so most of a submission's bytes were copies
+of the question set. :func:`encode` stores answers by reference instead:
+one version byte followed by a zlib-compressed compact JSON document
+
+    {"set": <question set id>, "snap": <snapshot digest>, "a": [[qid, given_key, correct_key, correct], ...]}
+
+References point at an immutable snapshot of the set's texts, not at the
+live set: ``question_snapshots`` holds each version of a set once, keyed by
+a digest of its texts, and :func:`save_snapshot` writes it in the same
+transaction as the rows that reference it. Editing a question later makes
+a new snapshot and leaves stored submissions as they were graded.
+
+A text is kept inline (a fifth element ``{"t": ..., "g": ...}``) only when
+it differs from the snapshot, e.g. a posted answer that matched no option,
+so encoding loses nothing. :func:`decode` rebuilds the full list, filling
+the texts in through ``resolve(digest)`` (see :func:`load_snapshot`).
+Without ``resolve`` referenced texts decode as None, which is all grading
+and the answer matrices need; :func:`unpack` then also returns the digest,
+so re-encoding keeps the row pointing at its own snapshot.
+
+Rows written before this format are JSON text (version 0) and decode as
+they are. :func:`migrate` rewrites them in batches.
+"""
+import functools
+import hashlib
+import json
+import threading
+import zlib
+from datetime import datetime, timezone
+
+
+FORMAT_VERSION = 1
+LEVEL = 6
+OPTION_KEYS = ('a', 'b', 'c', 'd')
+
+_snapshots = {}       # digest -> texts; snapshots never change, so they are cached for good
+_snapshots_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=256)
+def snapshot(key):
+    """``(digest, texts)`` of an :class:`~grading.AnswerKey`, texts as ``{qid: [text, {option: text}]}``.
+
+    Keys are immutable, so this is computed once per compiled key.
+    """
+    texts = {qid: [qk.text, {k: qk.texts.get(k, '') for k in OPTION_KEYS}] for qid, qk in key.by_qid.items()}
+    raw = json.dumps(texts, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return hashlib.blake2s(raw, digest_size=8).hexdigest(), texts
+
+
+def save_snapshot(conn, key):
+    """Store the snapshot of ``key`` unless it exists. Returns its digest.
+
+    Call it inside the transaction that writes rows encoded against ``key``.
+    """
+    digest, texts = snapshot(key)
+    conn.execute("""
+        INSERT OR IGNORE INTO question_snapshots (digest, set_id, created_at, texts_json)
+        VALUES (?, ?, ?, ?)
+    """, (digest, key.set_id, datetime.now(timezone.utc).isoformat(),
+          json.dumps(texts, separators=(',', ':'), ensure_ascii=False)))
+    return digest
+
+
+def load_snapshot(conn, digest):
+    """Texts of snapshot ``digest`` (see :func:`snapshot`), or None if it is unknown."""
+    with _snapshots_lock:
+        texts = _snapshots.get(digest)
+    if texts is not None or digest is None:
+        return texts
+    row = conn.execute("SELECT texts_json FROM question_snapshots WHERE digest=?", (digest,)).fetchone()
+    if row is None:
+        return None
+    texts = json.loads(row[0])
+    with _snapshots_lock:
+        _snapshots[digest] = texts
+    return texts
+
+
+def encode(details, key=None, set_id=None, snap=None):
+    """Encode a details list.
+
+    ``key`` is the :class:`~grading.AnswerKey` it was graded against; texts
+    equal to the key's are stored as references to its snapshot (save it
+    with :func:`save_snapshot`). Without a key, non-None texts are kept
+    inline and ``set_id`` and ``snap`` are recorded as they are.
+    """
+    by_qid = key.by_qid if key is not None else {}
+    rows = []
+    for d in details:
+        qid = d.get('qid')
+        given_key = d.get('given_key') or ''
+        row = [qid, given_key, d.get('correct_key') or '', 1 if d.get('correct') else 0]
+        qk = by_qid.get(qid)
+        inline = {}
+        text, given_text = d.get('text'), d.get('given_text')
+        if text is not None and (qk is None or text != qk.text):
+            inline['t'] = text
+        if given_text is not None and (qk is None or given_text != (qk.texts.get(given_key, '') if given_key else '')):
+            inline['g'] = given_text
+        if inline:
+            row.append(inline)
+        rows.append(row)
+    if key is not None:
+        set_id, snap = key.set_id, snapshot(key)[0]
+    doc = {'set': set_id, 'snap': snap, 'a': rows}
+    raw = json.dumps(doc, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return bytes([FORMAT_VERSION]) + zlib.compress(raw, LEVEL)
+
+
+def version(value):
+    """Format version of a stored value (0: plain JSON text)."""
+    if isinstance(value, (bytes, bytearray, memoryview)) and len(value):
+        return value[0]
+    return 0
+
+
+def unpack(value, resolve=None):
+    """``(set_id, snap, details)`` of a stored value; ``set_id`` and ``snap`` are None for version 0 rows.
+
+    Raises ValueError for a value that cannot be decoded.
+    """
+    if value is None or value == '':
+        return None, None, []
+    v = version(value)
+    if v == 0:
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value).decode('utf-8')
+        return None, None, json.loads(value)
+    if v != FORMAT_VERSION:
+        raise ValueError(f'unknown details format version {v}')
+    try:
+        doc = json.loads(zlib.decompress(bytes(value)[1:]).decode('utf-8'))
+    except zlib.error as e:
+        raise ValueError(f'corrupt details: {e}') from None
+    set_id, snap = doc.get('set'), doc.get('snap')
+    texts = None
+    if resolve is not None:
+        # A lost snapshot leaves referenced texts empty rather than showing another version's
+        texts = resolve(snap) or {}
+    details = []
+    for row in doc['a']:
+        qid, given_key, correct_key, correct = row[:4]
+        inline = row[4] if len(row) > 4 else {}
+        if texts is None:
+            text, given_text = inline.get('t'), inline.get('g')
+        else:
+            question, options = texts.get(qid) or ['', {}]
+            text = inline.get('t', question)
+            given_text = inline.get('g', options.get(given_key, '') if given_key else '')
+        details.append({
+            'qid': qid,
+            'text': text,
+            'given_text': given_text,
+            'given_key': given_key or None,
+            'correct_key': correct_key,
+            'correct': bool(correct),
+        })
+    return set_id, snap, details
+
+
+def decode(value, resolve=None):
+    """The details list of a stored ``details_json`` value, whatever its version.
+
+    ``resolve(digest)`` returns the snapshot's texts, e.g.
+    ``lambda digest: load_snapshot(conn, digest)``. Unreadable values decode
+    as an empty list.
+    """
+    try:
+        return unpack(value, resolve)[2]
+    except (ValueError, TypeError, KeyError):
+        return []
+
+
+def migrate(conn, key_for_test, batch=500, dry_run=False):
+    """Rewrite version 0 rows of ``conn``'s submissions in the current format.
+
+    ``key_for_test(test_id)`` returns the test's main :class:`~grading.AnswerKey`
+    (or None), whose snapshot the caller has saved. Each batch commits on its own, so the migration can be
+    interrupted and resumed. Returns ``{'rows', 'bytes_before', 'bytes_after',
+    'failed'}``.
+    """
+    stats = {'rows': 0, 'bytes_before': 0, 'bytes_after': 0, 'failed': 0}
+    keys = {}
+    after = 0
+    while True:
+        rows = conn.execute("""
+            SELECT id, test_id, details_json FROM submissions
+            WHERE id > ? AND typeof(details_json) = 'text' ORDER BY id LIMIT ?
+        """, (after, batch)).fetchall()
+        if not rows:
+            break
+        after = rows[-1][0]
+        updates = []
+        for sub_id, test_id, value in rows:
+            try:
+                details = json.loads(value)
+            except ValueError:
+                stats['failed'] += 1
+                continue
+            if test_id not in keys:
+                keys[test_id] = key_for_test(test_id)
+            encoded = encode(details, keys[test_id])
+            stats['rows'] += 1
+            stats['bytes_before'] += len(value.encode('utf-8'))
+            stats['bytes_after'] += len(encoded)
+            updates.append((encoded, sub_id, value))
+        if dry_run or not updates:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Skips rows re-graded since they were read
+            conn.executemany("UPDATE submissions SET details_json=? WHERE id=? AND details_json=?", updates)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return stats
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS question_snapshots (
+            digest TEXT PRIMARY KEY,
+            set_id INTEGER,
+            created_at TEXT,
+            texts_json TEXT
+        );
+        CREATE TRIGGER IF NOT EXISTS trg_question_snapshots_immutable BEFORE UPDATE ON question_snapshots
+        BEGIN
+            SELECT RAISE(ABORT, 'question_snapshots is immutable');
+        END;
+    """)
@@ -0,0 +1,80 @@
+"""Rendered-page cache for pages that only depend on configuration.
+
+The login, instructions and quiz-start pages are rendered thousands of times
+within a minute when a sitting opens, yet their HTML depends only on the
+template, the configuration and a few coarse values (the quiz status, the
+student's level). :class:`FragmentCache` renders each combination once and
+keeps the text together with a strong ETag (SHA-256 of the body), so a
+repeat load is a dict lookup, and a browser that already has the page gets
+a 304 without a body.
+
+Per-request values (e.g. a login error message) do not fragment the cache:
+they are rendered as a placeholder slot once and substituted, HTML-escaped,
+with ``str.replace`` on every hit. Injected values must appear in the
+template as a plain ``{{ name }}`` (no filters), since the filter would see
+the placeholder rather than the value.
+
+Callers put everything the page depends on into the key, including a
+configuration version, so changing the configuration starts new entries
+instead of serving stale pages.
+"""
+import hashlib
+import threading
+from typing import NamedTuple
+
+from markupsafe import escape
+
+
+class Fragment(NamedTuple):
+    body: str
+    etag: str
+
+
+def _slot(name):
+    return f'[[fragment:{name}]]'
+
+
+def _etag(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+class FragmentCache:
+    """Rendered templates keyed by ``(template, key, injected names)``."""
+
+    def __init__(self, render, max_entries=256):
+        self._render = render  # render(template_name, **context) -> str
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, template, key, context, inject=None):
+        """The page for ``key``, rendering it with ``context`` on a miss; ``inject`` values are filled in per call."""
+        inject = inject or {}
+        cache_key = (template, key, tuple(sorted(inject)))
+        entry = self._entries.get(cache_key)
+        if entry is None:
+            self.misses += 1
+            body = self._render(template, **dict(context, **{name: _slot(name) for name in inject}))
+            entry = Fragment(body, _etag(body))
+            with self._lock:
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()   # keys are few; overflowing means the key is too fine
+                self._entries[cache_key] = entry
+        else:
+            self.hits += 1
+        if not inject:
+            return entry
+        body = entry.body
+        for name, value in inject.items():
+            body = body.replace(_slot(name), str(escape(value)))
+        values = '\0'.join(f'{name}={value}' for name, value in sorted(inject.items()))
+        return Fragment(body, _etag(f'{entry.etag}\0{values}'))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,206 @@
+"""Compiled answer keys for grading submissions.
+
+A question set is compiled once into an immutable :class:`AnswerKey`: per
+question, hash maps from option text and from option token to the option
+key, so grading a paper is one dictionary lookup per question instead of a
+rebuild-and-scan of the option texts.
+
+Option tokens are short opaque ids the quiz page posts instead of the option
+text. They stay unambiguous when two options share the same text. Posted
+texts are still accepted. A text shared by several options grades as the
+correct key if any of them is correct, since the student could not tell
+them apart.
+
+Compiled keys are cached per set. Triggers bump ``question_sets.revision`` on
+any change to the set's questions, so each worker process notices edits with
+one indexed lookup and recompiles.
+"""
+import hashlib
+import threading
+from types import MappingProxyType
+from typing import NamedTuple
+
+
+OPTION_KEYS = ('a', 'b', 'c', 'd')
+
+
+class QuestionKey(NamedTuple):
+    qid: str
+    text: str
+    correct: str
+    texts: MappingProxyType      # option key -> text
+    tokens: MappingProxyType     # option key -> token
+    by_text: MappingProxyType    # text -> option key
+    by_token: MappingProxyType   # token -> option key
+    duplicates: frozenset        # texts shared by more than one option
+
+
+def option_token(salt, set_id, qid, key):
+    """Opaque, stable token for one option of one question of a set."""
+    raw = f'{set_id}\x1f{qid}\x1f{key}'.encode('utf-8')
+    return hashlib.blake2s(raw, digest_size=6, key=salt).hexdigest()
+
+
+def duplicate_options(options):
+    """Return sorted option keys whose (stripped, non-empty) text is shared with another option."""
+    seen = {}
+    for k in OPTION_KEYS:
+        text = (options.get(k) or '').strip()
+        if text:
+            seen.setdefault(text, []).append(k)
+    return sorted(k for keys in seen.values() if len(keys) > 1 for k in keys)
+
+
+def compile_question(q, set_id, salt):
+    correct = (q['correct'] or '').strip().lower()
+    texts, tokens, shared = {}, {}, {}
+    for k in OPTION_KEYS:
+        text = (q['options'].get(k) or '').strip()
+        texts[k] = text
+        tokens[k] = option_token(salt, set_id, q['id'], k)
+        if text:
+            shared.setdefault(text, []).append(k)
+    by_text = {text: (correct if correct in keys else keys[0]) for text, keys in shared.items()}
+    return QuestionKey(
+        qid=q['id'],
+        text=q['text'],
+        correct=correct,
+        texts=MappingProxyType(texts),
+        tokens=MappingProxyType(tokens),
+        by_text=MappingProxyType(by_text),
+        by_token=MappingProxyType({t: k for k, t in tokens.items()}),
+        duplicates=frozenset(text for text, keys in shared.items() if len(keys) > 1),
+    )
+
+
+class AnswerKey:
+    """Immutable compiled form of one question set."""
+
+    __slots__ = ('set_id', 'revision', 'questions', 'index', 'by_qid', 'duplicates')
+
+    def __init__(self, set_id, revision, questions, salt=b''):
+        """``questions`` is the set in ``ORDER BY id`` order, as returned by ``load_questions_for_set``."""
+        self.set_id = set_id
+        self.revision = revision
+        self.questions = tuple(MappingProxyType(dict(q, options=MappingProxyType(dict(q['options']))))
+                               for q in questions)
+        self.index = MappingProxyType({q['id']: i for i, q in enumerate(questions)})
+        compiled = {q['id']: compile_question(q, set_id, salt) for q in questions}
+        self.by_qid = MappingProxyType(compiled)
+        self.duplicates = tuple(qid for qid, qk in compiled.items() if qk.duplicates)
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError('AnswerKey is immutable')
+        object.__setattr__(self, name, value)
+
+    def display_options(self, qid, opts_keys):
+        """``(token, text)`` pairs of a question's options in paper order."""
+        qk = self.by_qid[qid]
+        return [(qk.tokens[k], qk.texts[k]) for k in opts_keys]
+
+    def grade(self, q_order, answers):
+        """Grade one paper in a single pass.
+
+        ``answers`` maps question id to the posted token or option text.
+        Returns ``(score, details)`` with ``details`` in the ``details_json``
+        format.
+        """
+        by_qid = self.by_qid
+        score = 0
+        details = []
+        for qid in q_order:
+            qk = by_qid[qid]
+            posted = (answers.get(qid) or '').strip()
+            given_key = qk.by_token.get(posted) or qk.by_text.get(posted)
+            correct = given_key is not None and given_key == qk.correct
+            score += correct
+            details.append({
+                'qid': qid,
+                'text': qk.text,
+                'given_text': qk.texts[given_key] if given_key else posted,
+                'given_key': given_key,
+                'correct_key': qk.correct,
+                'correct': correct,
+            })
+        return float(score), details
+
+    def grade_posted(self, answers, issued_set_id=None, salt=b''):
+        """Grade every posted answer when the paper's question order is lost.
+
+        For a paper issued from a version of the set that no longer matches
+        (see ``papers.materialize``). Tokens issued for ``issued_set_id`` are
+        recognised too. Answers to questions no longer in the set are kept
+        as posted and graded wrong. Returns ``(score, details)`` like
+        :meth:`grade`; unanswered questions of the paper are not in it.
+        """
+        score = 0
+        details = []
+        for qid, value in answers.items():
+            posted = (value or '').strip()
+            qk = self.by_qid.get(qid)
+            given_key = (qk.by_token.get(posted) or qk.by_text.get(posted)) if qk is not None else None
+            if given_key is None and issued_set_id is not None:
+                given_key = next((k for k in OPTION_KEYS if option_token(salt, issued_set_id, qid, k) == posted), None)
+            correct = qk is not None and given_key is not None and given_key == qk.correct
+            score += correct
+            details.append({
+                'qid': qid,
+                'text': qk.text if qk is not None else '',
+                'given_text': qk.texts[given_key] if qk is not None and given_key else posted,
+                'given_key': given_key,
+                'correct_key': qk.correct if qk is not None else '',
+                'correct': correct,
+            })
+        return float(score), details
+
+
+class AnswerKeyCache:
+    """Per-process cache of compiled keys, revalidated against ``question_sets.revision``."""
+
+    def __init__(self, loader, salt=b''):
+        """``loader(conn, set_id)`` returns the set's questions in ``ORDER BY id`` order."""
+        self.loader = loader
+        # blake2s keys are limited to 32 bytes
+        self.salt = hashlib.sha256(salt.encode('utf-8') if isinstance(salt, str) else salt).digest()
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def get(self, conn, set_id):
+        row = conn.execute("SELECT revision FROM question_sets WHERE id=?", (set_id,)).fetchone()
+        revision = row[0] if row else None
+        with self._lock:
+            key = self._keys.get(set_id)
+        if key is not None and key.revision == revision:
+            return key
+        key = AnswerKey(set_id, revision, self.loader(conn, set_id), salt=self.salt)
+        if key.duplicates:
+            print(f'[GRADING] set {set_id}: identical option texts in', ', '.join(key.duplicates))
+        with self._lock:
+            self._keys[set_id] = key
+        return key
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+def ensure_schema(conn):
+    """Add ``question_sets.revision`` and the triggers that bump it."""
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(question_sets)")}
+    if 'revision' not in cols:
+        conn.execute("ALTER TABLE question_sets ADD COLUMN revision INTEGER DEFAULT 0")
+    conn.executescript("""
+        CREATE TRIGGER IF NOT EXISTS trg_questions_revision_insert AFTER INSERT ON questions
+        BEGIN
+            UPDATE question_sets SET revision=COALESCE(revision, 0) + 1 WHERE id=NEW.set_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_questions_revision_update AFTER UPDATE ON questions
+        BEGIN
+            UPDATE question_sets SET revision=COALESCE(revision, 0) + 1 WHERE id IN (OLD.set_id, NEW.set_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_questions_revision_delete AFTER DELETE ON questions
+        BEGIN
+            UPDATE question_sets SET revision=COALESCE(revision, 0) + 1 WHERE id=OLD.set_id;
+        END;
+    """)
@@ -0,0 +1,167 @@
+"""Question image pipeline.
+
+Imported images are stored content-addressed under
+``static/assets/question_images`` as ``<stem>.<fingerprint><ext>``, where the
+fingerprint is the first 12 hex digits of the SHA-256 of the uploaded bytes.
+Next to the original, bounded-size variants are written:
+
+* ``<stem>.<fp>.display<ext>``: at most 1360 x 760, the quiz image box at 2x,
+* ``<stem>.<fp>.small<ext>``:   at most 680 x 380, the quiz image box at 1x,
+* ``<stem>.<fp>.thumb<ext>``:   at most 240 x 240 for admin listings.
+
+Variants are re-encoded without EXIF (orientation applied first), so phone
+photos shrink from megabytes to tens of kilobytes. A fingerprinted name
+never changes content, which lets static responses carry far-future
+``immutable`` cache headers (see :func:`is_fingerprinted`).
+
+Pillow is optional. Without it, or for formats it cannot read (SVG), only
+the fingerprinted original is stored and :func:`variant` falls back to it.
+"""
+import hashlib
+import io
+import os
+import re
+from pathlib import Path
+
+
+VARIANTS = {
+    'display': (1360, 760),
+    'small': (680, 380),
+    'thumb': (240, 240),
+}
+JPEG_QUALITY = 82
+RASTER_EXTS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff'}
+_FINGERPRINT_RE = re.compile(r'\.[0-9a-f]{12}(?:\.(?:display|small|thumb))?\.[A-Za-z0-9]+$')
+_STEM_RE = re.compile(r'[^A-Za-z0-9_-]+')
+
+_variant_cache = {}   # (static_dir, rel, kind) -> rel of an existing variant
+
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def is_fingerprinted(path):
+    """True for names produced by :func:`store_image` (safe to cache forever)."""
+    return bool(_FINGERPRINT_RE.search(str(path)))
+
+
+def variant_ext(ext):
+    """Extension of the resized variants of an original with extension ``ext``."""
+    ext = ext.lower()
+    if ext == '.jpeg':
+        return '.jpg'
+    return ext if ext in ('.jpg', '.png', '.webp') else '.png'
+
+
+def variant_name(filename, kind):
+    stem, ext = os.path.splitext(filename)
+    return f'{stem}.{kind}{variant_ext(ext)}'
+
+
+def _pil():
+    """Pillow's ``(Image, ImageOps)``, imported on first use, or ``(None, None)`` without Pillow."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:  # originals are still fingerprinted, just not resized
+        return None, None
+    return Image, ImageOps
+
+
+def _encode(img, ext):
+    buf = io.BytesIO()
+    if ext == '.jpg':
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(buf, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    elif ext == '.webp':
+        img.save(buf, 'WEBP', quality=JPEG_QUALITY, method=4)
+    else:
+        if img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            img = img.convert('RGBA')
+        img.save(buf, 'PNG', optimize=True)
+    return buf.getvalue()
+
+
+def _write(path, data):
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def make_variants(data, dest_dir, filename):
+    """Write the resized variants of ``filename`` (whose bytes are ``data``). Returns bytes written."""
+    ext = os.path.splitext(filename)[1].lower()
+    Image, ImageOps = _pil() if ext in RASTER_EXTS else (None, None)
+    if Image is None:
+        return 0
+    try:
+        src = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    except Exception as e:
+        print(f'[IMAGES] cannot read {filename}: {e}')
+        return 0
+    out_ext = variant_ext(ext)
+    same_format = ('.jpg' if ext == '.jpeg' else ext) == out_ext
+    written = 0
+    for kind, box in VARIANTS.items():
+        path = Path(dest_dir) / variant_name(filename, kind)
+        if path.exists():
+            continue
+        img = src.copy()
+        img.thumbnail(box, Image.LANCZOS)
+        encoded = _encode(img, out_ext)
+        # An already small original can beat the re-encode; keep whichever is smaller
+        if same_format and img.size == src.size and len(data) < len(encoded):
+            encoded = data
+        _write(path, encoded)
+        written += len(encoded)
+    return written
+
+
+def store_image(data, original_name, dest_dir):
+    """Store ``data`` content-addressed in ``dest_dir`` plus its variants. Returns the file name."""
+    dest_dir = Path(dest_dir)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    stem, ext = os.path.splitext(os.path.basename(original_name or 'image'))
+    stem = _STEM_RE.sub('_', stem).strip('_')[:40] or 'image'
+    filename = f'{stem}.{fingerprint(data)}{ext.lower() or ".png"}'
+    path = dest_dir / filename
+    if not path.exists():
+        _write(path, data)
+    make_variants(data, dest_dir, filename)
+    return filename
+
+
+def variant(static_dir, rel, kind):
+    """``rel`` (a path under ``static/``) rewritten to its ``kind`` variant if that exists."""
+    if not rel or kind not in VARIANTS or not is_fingerprinted(rel):
+        return rel
+    cache_key = (str(static_dir), rel, kind)
+    hit = _variant_cache.get(cache_key)
+    if hit:
+        return hit
+    candidate = variant_name(rel, kind)
+    if (Path(static_dir) / candidate).exists():
+        _variant_cache[cache_key] = candidate
+        return candidate
+    return rel
+
+
+def srcset(static_dir, rel, url_for_rel):
+    """``srcset`` value offering the 1x and 2x quiz variants, or ``''`` if they do not exist."""
+    small, display = variant(static_dir, rel, 'small'), variant(static_dir, rel, 'display')
+    if small == rel or display == rel:
+        return ''
+    return f'{url_for_rel(small)} 1x, {url_for_rel(display)} 2x'
+
+
+def remove_image(static_dir, rel):
+    """Delete an image and its variants (callers check that no question still uses it)."""
+    paths = [Path(static_dir) / rel] + [Path(static_dir) / variant_name(rel, kind) for kind in VARIANTS]
+    for path in paths:
+        try:
+            path.unlink()
+        except OSError:
+            pass
+    for key in [k for k in _variant_cache if k[0] == str(static_dir) and k[1] == rel]:
+        _variant_cache.pop(key, None)
@@ -0,0 +1,429 @@
+"""Lightweight timing instrumentation.
+
+Collects three kinds of latency histograms and exposes them in Prometheus
+text format:
+
+* ``http_request_duration_seconds`` per Flask endpoint and method,
+* ``db_query_duration_seconds`` per (normalized) SQL statement, recorded by
+  :class:`TimedConnection` / :class:`TimedCursor`,
+* ``span_duration_seconds`` for named code spans (:func:`span` / :func:`timed`).
+
+Query and span time is also accumulated per request, so the per-endpoint
+``http_request_db_seconds`` and ``http_request_span_seconds`` histograms show
+where a slow route spends its time. Optionally a sample of requests runs
+under cProfile and the slowest ones are kept as ``.prof`` dumps.
+
+Histograms are recorded per process. With several worker processes,
+:meth:`Registry.share` gives them a directory: each worker writes its
+histograms to ``<pid>.json`` there every ``flush_seconds``, and a scrape
+renders the sum over all files, so it shows the whole server whichever
+worker serves it. The files of workers that exited are folded into
+``retired.json``, so totals never go down when a worker is recycled.
+"""
+import cProfile
+import functools
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:   # Windows: one process, nothing to merge
+    fcntl = None
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAX_QUERY_LABELS = 500
+
+
+class Histogram:
+    """Cumulative-bucket histogram (Prometheus semantics)."""
+
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Registry:
+    """Thread-safe set of labelled histograms, optionally merged across processes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}  # name -> {labels tuple: Histogram}
+        self._help = {}
+        self.directory = None
+        self.flush_seconds = 5.0
+        self._dirty = False
+        self._flusher_pid = None
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def share(self, directory, flush_seconds=5.0):
+        """Merge the histograms of every process that shares ``directory``."""
+        self.directory = Path(directory)
+        self.flush_seconds = float(flush_seconds)
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            series = self._metrics.setdefault(name, {})
+            hist = series.get(labels)
+            if hist is None:
+                hist = series[labels] = Histogram()
+            hist.observe(value)
+            self._dirty = True
+
+    def series_count(self, name):
+        return len(self._metrics.get(name, ()))
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def _after_fork(self):
+        # A worker starts empty: what the master observed before the fork is not the worker's
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._dirty = False
+        self._flusher_pid = None
+
+    # ---- sharing between processes ----
+
+    def start(self):
+        """Start this process's flusher thread (idempotent, restarted after a fork)."""
+        if self.directory is None or fcntl is None or self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        threading.Thread(target=self._flush_loop, name='metrics-flusher', daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f'[METRICS] cannot write {self.directory}: {e!r}')
+
+    def _snapshot(self):
+        with self._lock:
+            self._dirty = False
+            return {name: {labels: (list(h.counts), h.total, h.count) for labels, h in series.items()}
+                    for name, series in self._metrics.items()}
+
+    def flush(self):
+        """Write this process's histograms to its file if they changed."""
+        if not self._dirty:
+            return
+        _write_json(self.directory / f'{os.getpid()}.json', _to_json(self._snapshot()))
+
+    def clear_shared(self):
+        """Drop the files of processes that are gone, and the retired totals (call at server start)."""
+        if self.directory is None or fcntl is None or not self.directory.is_dir():
+            return
+        with _dir_lock(self.directory):
+            for path in self.directory.glob('*.json'):
+                if path.stem == 'retired' or (path.stem.isdigit() and not _alive(int(path.stem))):
+                    path.unlink()
+
+    def _merged(self):
+        """Sum of the histograms of every process sharing the directory."""
+        self._dirty = True
+        self.flush()
+        merged = {}
+        with _dir_lock(self.directory):
+            retired_path = self.directory / 'retired.json'
+            retired = _from_json(_read_json(retired_path))
+            gone = []
+            for path in self.directory.glob('*.json'):
+                if not path.stem.isdigit():
+                    continue
+                data = _from_json(_read_json(path))
+                if int(path.stem) != os.getpid() and not _alive(int(path.stem)):
+                    _add(retired, data)
+                    gone.append(path)
+                else:
+                    _add(merged, data)
+            if gone:
+                _write_json(retired_path, _to_json(retired))
+                for path in gone:
+                    path.unlink()
+        _add(merged, retired)
+        return merged
+
+    def render_prometheus(self):
+        """Return all histograms in the Prometheus text exposition format."""
+        if self.directory is not None and fcntl is not None:
+            metrics = self._merged()
+        else:
+            metrics = self._snapshot()
+        lines = []
+        for name in sorted(metrics):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, (counts, total, count) in sorted(metrics[name].items()):
+                base = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+                sep = ',' if base else ''
+                cumulative = 0
+                for bound, n in zip(DEFAULT_BUCKETS, counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{{base}{sep}le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{base}{sep}le="+Inf"}} {count}')
+                lines.append(f'{name}_sum{{{base}}} {total:.6f}')
+                lines.append(f'{name}_count{{{base}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _add(into, metrics):
+    for name, series in metrics.items():
+        target = into.setdefault(name, {})
+        for labels, (counts, total, count) in series.items():
+            if labels in target:
+                c, t, n = target[labels]
+                counts = [a + b for a, b in zip(c, counts)]
+                total, count = t + total, n + count
+            target[labels] = (list(counts), total, count)
+
+
+def _to_json(metrics):
+    return {name: [[list(map(list, labels)), counts, total, count]
+                   for labels, (counts, total, count) in series.items()]
+            for name, series in metrics.items()}
+
+
+def _from_json(doc):
+    return {name: {tuple(map(tuple, labels)): (counts, total, count) for labels, counts, total, count in series}
+            for name, series in doc.items()}
+
+
+def _read_json(path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path, doc):
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    tmp.write_text(json.dumps(doc, separators=(',', ':')))
+    os.replace(tmp, path)
+
+
+@contextmanager
+def _dir_lock(directory):
+    with open(directory / '.lock', 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = Registry()
+registry.describe('http_request_duration_seconds', 'Wall time per request by endpoint.')
+registry.describe('http_request_db_seconds', 'SQLite time spent inside each request by endpoint.')
+registry.describe('http_request_span_seconds', 'Time in named spans inside each request by endpoint and span.')
+registry.describe('db_query_duration_seconds', 'Execution time per SQL statement.')
+registry.describe('span_duration_seconds', 'Time spent in named code spans.')
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry._after_fork)
+
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_ws = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    """Collapse whitespace so each statement in the code maps to one label."""
+    return _ws.sub(' ', sql).strip()[:160]
+
+
+def _record_query(sql, elapsed):
+    label = normalize_sql(sql)
+    if registry.series_count('db_query_duration_seconds') >= MAX_QUERY_LABELS:
+        label = 'other'
+    registry.observe('db_query_duration_seconds', (('query', label),), elapsed)
+    acc = getattr(_local, 'acc', None)
+    if acc is not None:
+        acc['db'] += elapsed
+
+
+# ---- SQLite wrappers ----
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records how long each statement takes to execute."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_query(sql, time.perf_counter() - start)
+
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            _record_query('<script>', time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose shortcut ``execute*`` methods go through :class:`TimedCursor`.
+
+    Use as ``sqlite3.connect(path, factory=TimedConnection)``.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+# ---- spans ----
+
+@contextmanager
+def span(name):
+    """Time a block of code as the named span."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe('span_duration_seconds', (('span', name),), elapsed)
+        acc = getattr(_local, 'acc', None)
+        if acc is not None:
+            acc['spans'][name] = acc['spans'].get(name, 0.0) + elapsed
+
+
+def timed(name):
+    """Decorator form of :func:`span`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ---- Flask integration ----
+
+class SlowProfileKeeper:
+    """Keeps cProfile dumps for the ``keep`` slowest sampled requests."""
+
+    def __init__(self, directory, keep=20):
+        self.directory = Path(directory)
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._kept = []  # (elapsed, path)
+
+    def offer(self, profiler, endpoint, elapsed):
+        with self._lock:
+            if len(self._kept) >= self.keep and elapsed <= self._kept[0][0]:
+                return None
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fname = f"{int(time.time())}_{endpoint or 'unknown'}_{int(elapsed * 1000)}ms_{os.getpid()}.prof"
+            path = self.directory / fname.replace('/', '_')
+            profiler.dump_stats(str(path))
+            self._kept.append((elapsed, path))
+            self._kept.sort()
+            while len(self._kept) > self.keep:
+                _, old = self._kept.pop(0)
+                try:
+                    old.unlink()
+                except OSError:
+                    pass
+            return path
+
+
+def init_app(app, profile_sample_rate=0.0, profile_dir=None, profile_keep=20, shared_dir=None):
+    """Record per-endpoint latency for ``app`` and optionally sample cProfile.
+
+    With ``shared_dir``, the histograms of all processes serving ``app`` are
+    merged (see :meth:`Registry.share`).
+    """
+    from flask import request
+
+    keeper = SlowProfileKeeper(profile_dir, keep=profile_keep) if profile_sample_rate > 0 and profile_dir else None
+    if shared_dir is not None:
+        registry.share(shared_dir)
+
+    @app.before_request
+    def _start_timer():
+        registry.start()
+        _local.acc = {'start': time.perf_counter(), 'db': 0.0, 'spans': {}, 'profiler': None}
+        if keeper and random.random() < profile_sample_rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already active (e.g. concurrent request on 3.12+)
+                return
+            _local.acc['profiler'] = profiler
+
+    @app.teardown_request
+    def _stop_timer(exc=None):
+        acc = getattr(_local, 'acc', None)
+        if acc is None:
+            return
+        _local.acc = None
+        elapsed = time.perf_counter() - acc['start']
+        endpoint = request.endpoint or 'unmatched'
+        labels = (('endpoint', endpoint), ('method', request.method))
+        registry.observe('http_request_duration_seconds', labels, elapsed)
+        registry.observe('http_request_db_seconds', labels, acc['db'])
+        for name, seconds in acc['spans'].items():
+            registry.observe('http_request_span_seconds', labels + (('span', name),), seconds)
+        profiler = acc['profiler']
+        if profiler is not None:
+            profiler.disable()
+            keeper.offer(profiler, endpoint, elapsed)
@@ -0,0 +1,49 @@
+"""Heavy dependencies, imported on first use.
+
+NumPy and pandas (with openpyxl behind ``read_excel``/``ExcelWriter``) take
+hundreds of milliseconds and tens of MB per process to import. Only admin
+paths use them: imports, exports, analytics, re-grading and similarity
+checks. Modules therefore import these stand-ins rather than the packages
+themselves:
+
+    from lazy import numpy as np, pandas as pd
+
+The real package is imported the first time an attribute is read. Its
+namespace is then copied onto the stand-in, so later lookups cost the same
+as on the real module. Nothing may touch the stand-ins at import time
+(module-level constants, default arguments), or the saving is lost.
+ReportLab is imported inside the PDF functions that use it and Pillow
+inside ``images.make_variants``, for the same reason.
+
+``loaded()`` reports which heavy packages the current process has
+imported (see benchmarks/import_bench.py).
+"""
+import importlib
+import sys
+import types
+
+
+HEAVY = ('numpy', 'pandas', 'openpyxl', 'reportlab', 'PIL')
+
+
+class LazyModule(types.ModuleType):
+    """Module stand-in that imports ``name`` when an attribute is first read."""
+
+    def __getattr__(self, attr):
+        # Only called for attributes not yet in __dict__, i.e. until the first load
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        state = 'loaded' if self.__name__ in sys.modules else 'not loaded'
+        return f'<lazy module {self.__name__!r} ({state})>'
+
+
+def loaded():
+    """Names in ``HEAVY`` that this process has imported."""
+    return [name for name in HEAVY if name in sys.modules]
+
+
+numpy = LazyModule('numpy')
+pandas = LazyModule('pandas')
@@ -0,0 +1,427 @@
+"""Outbound mail delivery.
+
+Messages are written to the ``mail_queue`` table and delivered by background
+worker threads. Each worker checks out a long-lived, already authenticated
+SMTP connection from a small pool, sends a batch of due messages over it and
+returns it. Failed sends are retried with exponential backoff, and a token
+bucket, kept in the database, caps the send rate of all worker processes
+together so the provider does not throttle us.
+A message that cannot be built (missing attachment, bad template output)
+fails for good without touching the connection. Messages left in
+``sending`` by a crashed worker are put back in the queue periodically.
+
+For local testing point the ``email.smtp`` config at a stand-in server, e.g.
+``python -m aiosmtpd -n -l localhost:8025`` with ``use_tls: false`` and no
+username, then inspect :meth:`Mailer.metrics`.
+"""
+import json
+import mimetypes
+import os
+import queue
+import random
+import smtplib
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from email.message import EmailMessage
+from email.utils import formataddr
+from pathlib import Path
+
+
+def is_permanent(error):
+    """True for 5xx rejections that will not go away by retrying."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return getattr(error, 'smtp_code', 0) >= 500
+
+
+class RateLimiter:
+    """Token bucket: ``rate`` messages per second with bursts up to ``burst``, shared by all processes.
+
+    The bucket lives in the ``mail_rate`` row as the time its next message
+    may go (GCRA): :meth:`acquire` reserves a slot in one short write
+    transaction and sleeps until it outside the transaction, so every
+    worker process together stays under ``rate``.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, rate))
+
+    def acquire(self, conn):
+        if self.rate <= 0:
+            return
+        interval = 1.0 / self.rate
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("UPDATE mail_rate SET next_at=MAX(next_at, ?) + ? WHERE id=1", (now, interval))
+            next_at = conn.execute("SELECT next_at FROM mail_rate WHERE id=1").fetchone()[0]
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        wait = next_at - self.capacity * interval - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SMTPPool:
+    """A fixed-size pool of authenticated SMTP connections."""
+
+    def __init__(self, smtp_cfg, size=2, idle_check_seconds=30, on_event=None):
+        self.cfg = smtp_cfg
+        self.size = max(1, int(size))
+        self.idle_check_seconds = idle_check_seconds
+        self.on_event = on_event or (lambda name: None)
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def _open(self):
+        server = smtplib.SMTP(self.cfg['host'], int(self.cfg.get('port', 587)), timeout=int(self.cfg.get('timeout', 30)))
+        if self.cfg.get('use_tls', True):
+            server.starttls()
+        if self.cfg.get('username'):
+            server.login(self.cfg['username'], self.cfg['password'])
+        self.on_event('connections_opened')
+        return server
+
+    def acquire(self):
+        """Return a live connection, reusing an idle one when possible."""
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    server, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._open()
+                if time.monotonic() - last_used < self.idle_check_seconds:
+                    self.on_event('connections_reused')
+                    return server
+                try:
+                    if server.noop()[0] == 250:
+                        self.on_event('connections_reused')
+                        return server
+                except (smtplib.SMTPException, OSError):
+                    pass
+                _close(server)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, server, broken=False):
+        if broken:
+            _close(server)
+        else:
+            self._idle.put((server, time.monotonic()))
+        self._slots.release()
+
+    def close_all(self):
+        while True:
+            try:
+                server, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            _close(server)
+
+
+class Mailer:
+    """Persistent mail queue drained by pooled SMTP workers."""
+
+    def __init__(self, db_path, smtp_cfg, sender_name='Test Platform', pool_size=2,
+                 batch_size=20, rate_per_second=5, max_attempts=6, backoff_base=5.0,
+                 backoff_max=900.0, poll_interval=2.0, stale_after=600, factory=sqlite3.Connection):
+        self.db_path = db_path
+        self.factory = factory
+        self.smtp_cfg = smtp_cfg
+        self.sender_name = sender_name
+        self.pool_size = max(1, int(pool_size))
+        self.batch_size = max(1, int(batch_size))
+        self.max_attempts = int(max_attempts)
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.poll_interval = float(poll_interval)
+        self.stale_after = float(stale_after)
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+        self.pool = SMTPPool(smtp_cfg, size=self.pool_size, on_event=self.bump)
+        self.limiter = RateLimiter(rate_per_second)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._workers_pid = None
+        self._schema_ready = False
+
+    # ---- metrics ----
+
+    def bump(self, key, n=1):
+        with self._metrics_lock:
+            self._metrics[key] = self._metrics.get(key, 0) + n
+
+    def metrics(self):
+        """Snapshot of delivery counters plus the current queue depth."""
+        with self._metrics_lock:
+            snap = dict(self._metrics)
+        conn = self.connect()
+        try:
+            for row in conn.execute("SELECT status, COUNT(*) AS c FROM mail_queue GROUP BY status"):
+                snap[f"queue_{row['status']}"] = row['c']
+        finally:
+            conn.close()
+        return snap
+
+    # ---- queue ----
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=30,
+                               factory=self.factory)
+        conn.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            ensure_schema(conn)
+            self._schema_ready = True
+        return conn
+
+    def enqueue(self, to_addr, subject, body, attachments=None, conn=None, priority=0, sensitive=False):
+        """Queue a message and wake the workers. Returns the queue row id.
+
+        ``attachments`` is a list of ``(filename, path)`` pairs; files are read
+        at send time so large PDFs are never held in the queue. Lower
+        ``priority`` values are sent first, so login codes overtake bulk runs.
+        The body of a ``sensitive`` message (e.g. one carrying a password) is
+        wiped once it has been sent. When ``conn`` is given the insert joins
+        the caller's transaction.
+        """
+        own = conn is None
+        if own:
+            conn = self.connect()
+        elif not self._schema_ready:
+            ensure_schema(conn)
+            self._schema_ready = True
+        try:
+            cur = conn.execute("""
+                INSERT INTO mail_queue (to_addr, subject, body, attachments_json, status, attempts,
+                                        next_attempt_at, created_at, priority, sensitive)
+                VALUES (?, ?, ?, ?, 'queued', 0, ?, ?, ?, ?)
+            """, (to_addr, subject, body, json.dumps(attachments or []), time.time(),
+                  datetime.now(timezone.utc).isoformat(), int(priority), 1 if sensitive else 0))
+            msg_id = cur.lastrowid
+        finally:
+            if own:
+                conn.close()
+        self.bump('enqueued')
+        self.start()
+        self._wake.set()
+        return msg_id
+
+    def _claim(self, conn):
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("""
+                SELECT id, to_addr, subject, body, attachments_json, attempts FROM mail_queue
+                WHERE status='queued' AND next_attempt_at<=? ORDER BY priority, next_attempt_at, id LIMIT ?
+            """, (now, self.batch_size)).fetchall()
+            if rows:
+                conn.executemany("UPDATE mail_queue SET status='sending', claimed_at=? WHERE id=?",
+                                 [(now, r['id']) for r in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _build(self, row):
+        msg = EmailMessage()
+        msg['Subject'] = row['subject']
+        msg['From'] = formataddr((self.sender_name, self.smtp_cfg['from']))
+        msg['To'] = row['to_addr']
+        msg.set_content(row['body'])
+        for filename, path in json.loads(row['attachments_json'] or '[]'):
+            ctype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            maintype, subtype = ctype.split('/', 1)
+            msg.add_attachment(Path(path).read_bytes(), maintype=maintype, subtype=subtype, filename=filename)
+        return msg
+
+    def _finish(self, conn, row, error=None, permanent=False):
+        if error is None:
+            conn.execute("""
+                UPDATE mail_queue SET status='sent', attempts=attempts+1, sent_at=?, last_error=NULL,
+                       body=CASE WHEN sensitive=1 THEN '' ELSE body END
+                WHERE id=?
+            """, (datetime.now(timezone.utc).isoformat(), row['id']))
+            self.bump('sent')
+            return
+        attempts = row['attempts'] + 1
+        if permanent or attempts >= self.max_attempts:
+            conn.execute("UPDATE mail_queue SET status='failed', attempts=?, last_error=? WHERE id=?",
+                         (attempts, str(error)[:500], row['id']))
+            self.bump('failed')
+            print('[EMAIL] giving up on message', row['id'], 'to', row['to_addr'], ':', error)
+            return
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempts - 1)))
+        delay *= random.uniform(0.8, 1.2)
+        conn.execute("UPDATE mail_queue SET status='queued', attempts=?, next_attempt_at=?, last_error=? WHERE id=?",
+                     (attempts, time.time() + delay, str(error)[:500], row['id']))
+        self.bump('retried')
+
+    def send_batch(self, conn, rows):
+        """Deliver ``rows`` over one pooled connection."""
+        server = self.pool.acquire()
+        broken = False
+        try:
+            for row in rows:
+                if broken:
+                    self._finish(conn, row, 'connection lost')
+                    continue
+                try:
+                    msg = self._build(row)
+                except Exception as e:
+                    # Retrying will not bring the attachment or the message back
+                    self.bump('build_errors')
+                    self._finish(conn, row, f'could not build message: {e!r}', permanent=True)
+                    continue
+                self.limiter.acquire(conn)
+                try:
+                    server.send_message(msg)
+                except (smtplib.SMTPException, OSError) as e:
+                    broken = isinstance(e, (smtplib.SMTPServerDisconnected, OSError))
+                    self._finish(conn, row, e, permanent=is_permanent(e))
+                    continue
+                except Exception as e:
+                    # e.g. an address that cannot be encoded; the session state is unknown
+                    broken = True
+                    self._finish(conn, row, repr(e), permanent=True)
+                    continue
+                self._finish(conn, row)
+        finally:
+            self.pool.release(server, broken=broken)
+        self.bump('batches')
+
+    def process_once(self):
+        """Claim and deliver one batch. Returns the number of messages handled."""
+        conn = self.connect()
+        try:
+            rows = self._claim(conn)
+            if not rows:
+                return 0
+            try:
+                self.send_batch(conn, rows)
+            except Exception as e:
+                # No connection (or the batch broke off): retry what was not handled yet.
+                self.bump('connect_errors')
+                ids = [r['id'] for r in rows]
+                sending = {r['id'] for r in conn.execute(
+                    f"SELECT id FROM mail_queue WHERE status='sending' AND id IN ({','.join('?' * len(ids))})", ids)}
+                for row in rows:
+                    if row['id'] in sending:
+                        self._finish(conn, row, e)
+            return len(rows)
+        finally:
+            conn.close()
+
+    def requeue_stale(self, older_than=None):
+        """Return messages stuck in 'sending' (e.g. after a crash) to the queue."""
+        older_than = self.stale_after if older_than is None else older_than
+        conn = self.connect()
+        try:
+            n = conn.execute("UPDATE mail_queue SET status='queued' WHERE status='sending' AND claimed_at<?",
+                             (time.time() - older_than,)).rowcount
+        finally:
+            conn.close()
+        if n:
+            self.bump('requeued_stale', n)
+        return n
+
+    def _worker(self, requeue=False):
+        next_requeue = 0.0
+        while not self._stop.is_set():
+            if requeue and time.monotonic() >= next_requeue:
+                next_requeue = time.monotonic() + self.stale_after / 4
+                try:
+                    self.requeue_stale()
+                except Exception as e:
+                    print('[EMAIL] could not requeue stale messages:', e)
+            try:
+                handled = self.process_once()
+            except Exception as e:
+                print('[EMAIL] worker error:', e)
+                handled = 0
+            if not handled:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def start(self):
+        """Start the worker threads once per process."""
+        if self._workers_pid == os.getpid():
+            return
+        self._workers_pid = os.getpid()
+        self._stop.clear()
+        for i in range(self.pool_size):
+            threading.Thread(target=self._worker, args=(i == 0,), name=f'mailer-{i}', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self.pool.close_all()
+        self._workers_pid = None
+
+    def flush(self, timeout=30.0):
+        """Block until nothing is queued or in flight (or ``timeout``). Returns True if drained."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            conn = self.connect()
+            try:
+                pending = conn.execute(
+                    "SELECT COUNT(*) AS c FROM mail_queue WHERE status IN ('queued','sending') AND next_attempt_at<=?",
+                    (time.time(),)).fetchone()['c']
+            finally:
+                conn.close()
+            if not pending:
+                return True
+            self._wake.set()
+            time.sleep(0.05)
+        return False
+
+
+def ensure_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS mail_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            to_addr TEXT,
+            subject TEXT,
+            body TEXT,
+            attachments_json TEXT,
+            status TEXT DEFAULT 'queued',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL,
+            claimed_at REAL,
+            last_error TEXT,
+            created_at TEXT,
+            sent_at TEXT,
+            priority INTEGER DEFAULT 0,
+            sensitive INTEGER DEFAULT 0
+        )
+    """)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(mail_queue)")}
+    if 'priority' not in cols:
+        conn.execute("ALTER TABLE mail_queue ADD COLUMN priority INTEGER DEFAULT 0")
+    if 'sensitive' not in cols:
+        conn.execute("ALTER TABLE mail_queue ADD COLUMN sensitive INTEGER DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mail_queue_due ON mail_queue(status, next_attempt_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS mail_rate (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            next_at REAL DEFAULT 0
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO mail_rate (id, next_at) VALUES (1, 0)")
+
+
+def _close(server):
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
@@ -0,0 +1,203 @@
+"""Quiz papers derived from a per-attempt seed.
+
+A paper (question order plus option order per question) is never stored.
+Instead each attempt gets a 63-bit seed, an HMAC of test, respondent and
+attempt number, and the paper is recomputed from it with a small fixed PRNG
+(:class:`PaperRNG`). The PRNG and the way it is consumed are versioned by
+``PRNG_VERSION``. Any change to either must bump the version and keep the old
+code path, so existing seeds keep producing the same papers.
+
+When a sitting is armed, every eligible credential gets its ``papers`` row
+(seed, version, randomization flags, the question set it applies to and a
+digest of that set's question ids) in a single transaction, so ``/start-real-test`` only has to look one row up.
+Grading, exports and re-grading rebuild the paper from that row.
+"""
+import hashlib
+import hmac
+import itertools
+from datetime import datetime, timezone
+
+
+PRNG_VERSION = 1
+OPTION_KEYS = ('a', 'b', 'c', 'd')
+OPTION_PERMUTATIONS = [list(p) for p in itertools.permutations(OPTION_KEYS)]
+_IDENTITY_PERM = 0
+
+FLAG_QUESTIONS = 1
+FLAG_OPTIONS = 2
+
+_MASK64 = (1 << 64) - 1
+
+
+class PaperRNG:
+    """SplitMix64 generator (version 1). Identical output on every platform."""
+
+    __slots__ = ('state',)
+
+    def __init__(self, seed):
+        self.state = seed & _MASK64
+
+    def next64(self):
+        self.state = (self.state + 0x9E3779B97F4A7C15) & _MASK64
+        z = self.state
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+        return z ^ (z >> 31)
+
+    def randbelow(self, n):
+        """Uniform integer in ``[0, n)`` (rejection sampling, no modulo bias)."""
+        limit = (1 << 64) - (1 << 64) % n
+        while True:
+            x = self.next64()
+            if x < limit:
+                return x % n
+
+    def shuffle(self, items):
+        """In-place Fisher-Yates shuffle."""
+        for i in range(len(items) - 1, 0, -1):
+            j = self.randbelow(i + 1)
+            items[i], items[j] = items[j], items[i]
+
+
+def attempt_seed(secret, test_id, respondent, attempt_no=1):
+    """Seed for one attempt: HMAC-SHA256 of test, respondent and attempt, cut to 63 bits."""
+    key = secret.encode('utf-8') if isinstance(secret, str) else secret
+    msg = f'{test_id}\x1f{str(respondent).strip().lower()}\x1f{attempt_no}'.encode('utf-8')
+    digest = hmac.new(key, msg, hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], 'big') >> 1
+
+
+def questions_digest(question_ids):
+    """Digest of a set's question ids (``question_id``) in ``ORDER BY id`` order.
+
+    A paper maps positions onto these ids, so any added, removed or replaced
+    question changes the digest, even when the count stays the same.
+    """
+    data = '\x1f'.join(str(qid) for qid in question_ids).encode('utf-8')
+    return hashlib.blake2s(data, digest_size=8).hexdigest()
+
+
+def make_flags(randomize_questions, randomize_options):
+    return (FLAG_QUESTIONS if randomize_questions else 0) | (FLAG_OPTIONS if randomize_options else 0)
+
+
+def build_paper(seed, question_count, flags, version=PRNG_VERSION):
+    """Return ``(positions, perm_indexes)`` for the paper of ``seed``.
+
+    ``positions`` lists question positions (in ``ORDER BY id`` order of the
+    set) in display order; ``perm_indexes[i]`` indexes the option order of
+    question position ``i`` in :data:`OPTION_PERMUTATIONS`.
+    """
+    if version != 1:
+        raise ValueError(f'unsupported paper PRNG version: {version}')
+    rng = PaperRNG(seed)
+    positions = list(range(question_count))
+    if flags & FLAG_QUESTIONS:
+        rng.shuffle(positions)
+    if flags & FLAG_OPTIONS:
+        perms = [rng.randbelow(len(OPTION_PERMUTATIONS)) for _ in range(question_count)]
+    else:
+        perms = [_IDENTITY_PERM] * question_count
+    return positions, perms
+
+
+def generate_papers(conn, test_id, set_id, question_ids, emails, secret, randomize_questions=True,
+                    randomize_options=True, attempt_no=1):
+    """Create paper rows for ``emails`` that do not have one yet. Returns the number created.
+
+    ``question_ids`` are the set's question ids in ``ORDER BY id`` order.
+    Runs as one transaction on ``conn`` (an autocommit connection).
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    flags = make_flags(randomize_questions, randomize_options)
+    digest = questions_digest(question_ids)
+    rows = [(test_id, email, attempt_no, set_id, len(question_ids), digest,
+             attempt_seed(secret, test_id, email, attempt_no), PRNG_VERSION, flags, now)
+            for email in emails]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        before = conn.total_changes
+        conn.executemany("""
+            INSERT OR IGNORE INTO papers (test_id, email, attempt_no, set_id, question_count, questions_digest,
+                                          seed, prng_version, flags, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        created = conn.total_changes - before
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return created
+
+
+def issue_paper(conn, test_id, set_id, question_ids, email, secret, randomize_questions=True,
+                randomize_options=True, attempt_no=1):
+    """(Re)issue the paper row for one attempt against ``set_id`` and return it."""
+    flags = make_flags(randomize_questions, randomize_options)
+    seed = attempt_seed(secret, test_id, email, attempt_no)
+    digest = questions_digest(question_ids)
+    conn.execute("""
+        INSERT INTO papers (test_id, email, attempt_no, set_id, question_count, questions_digest,
+                            seed, prng_version, flags, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(test_id, email, attempt_no) DO UPDATE SET
+            set_id=excluded.set_id, question_count=excluded.question_count,
+            questions_digest=excluded.questions_digest, seed=excluded.seed,
+            prng_version=excluded.prng_version, flags=excluded.flags, created_at=excluded.created_at
+    """, (test_id, email, attempt_no, set_id, len(question_ids), digest, seed, PRNG_VERSION, flags,
+          datetime.now(timezone.utc).isoformat()))
+    return {'set_id': set_id, 'question_count': len(question_ids), 'questions_digest': digest, 'seed': seed,
+            'prng_version': PRNG_VERSION, 'flags': flags}
+
+
+def fetch_paper(conn, test_id, email, attempt_no=1):
+    row = conn.execute("""
+        SELECT set_id, question_count, questions_digest, seed, prng_version, flags FROM papers
+        WHERE test_id=? AND email=? AND attempt_no=?
+    """, (test_id, email, attempt_no)).fetchone()
+    return dict(row) if row else None
+
+
+def materialize(paper, questions):
+    """Rebuild ``(q_order, options_order)`` of ``paper`` for ``questions``.
+
+    ``questions`` must be the set's questions in ``ORDER BY id`` order (as
+    returned by ``load_questions_for_set``). Returns ``None`` when the set has
+    changed since the paper was issued (its question ids no longer match the
+    stored digest) or the row predates seeded papers. Rows issued before the
+    digest was stored are only checked against the question count.
+    """
+    if paper.get('seed') is None or paper['question_count'] != len(questions):
+        return None
+    digest = paper.get('questions_digest')
+    if digest is not None and digest != questions_digest(q['id'] for q in questions):
+        return None
+    positions, perms = build_paper(paper['seed'], paper['question_count'], paper['flags'], paper['prng_version'])
+    q_order = [questions[p]['id'] for p in positions]
+    options_order = {questions[i]['id']: OPTION_PERMUTATIONS[perms[i]] for i in range(len(questions))}
+    return q_order, options_order
+
+
+def ensure_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS papers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            test_id INTEGER,
+            email TEXT,
+            attempt_no INTEGER DEFAULT 1,
+            set_id INTEGER,
+            question_count INTEGER,
+            questions_digest TEXT,
+            seed INTEGER,
+            prng_version INTEGER,
+            flags INTEGER,
+            created_at TEXT,
+            UNIQUE(test_id, email, attempt_no)
+        )
+    """)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(papers)")}
+    for name in ('seed', 'prng_version', 'flags'):
+        if name not in cols:
+            conn.execute(f"ALTER TABLE papers ADD COLUMN {name} INTEGER")
+    if 'questions_digest' not in cols:
+        conn.execute("ALTER TABLE papers ADD COLUMN questions_digest TEXT")
@@ -0,0 +1,220 @@
+"""Pre-forking WSGI server for production.
+
+The master process binds the listening socket, runs the caller's one-time
+setup (schema, cache warm-up) and then forks ``workers`` children that all
+accept on the shared socket. Everything loaded before the fork (the app,
+compiled answer keys, templates) is shared copy-on-write; ``gc.freeze()``
+keeps the garbage collector from touching, and so copying, those pages.
+
+Each worker serves requests with werkzeug's WSGI server (optionally
+threaded) and exits after ``max_requests`` (+ random jitter, so workers do
+not all recycle at once); the master replaces it. On SIGTERM/SIGINT the
+master stops the workers gracefully: they stop accepting, finish the
+requests in flight and exit, and are killed only after
+``graceful_timeout``. SIGHUP recycles all workers the same way.
+
+Background threads (mailer, session sweeper, event flusher) start lazily
+per process, so they are never forked half-running.
+
+What the app relies on is shared between the workers:
+
+* the admission queue is a SQLite file shared by all workers (admission.py);
+* the mail queue, sessions, papers and proctoring counts live in the
+  database, claimed or debounced inside write transactions;
+* the checkpointer, backups, archiving and answer-matrix rebuilds elect
+  one process with an ``flock``;
+* config.json is re-read by every worker when it changes; the admin reload
+  button bumps its mtime so that all of them re-read the per-test overrides;
+* the latency histograms of /admin/metrics are written by each worker to
+  its own file and summed on every scrape (instrumentation.py), so they
+  lag by up to a few seconds.
+
+In-process caches (compiled answer keys, rendered pages, read connections)
+are per worker and revalidate against the database or the config version.
+The ``quiz_*`` counters of /admin/metrics (page cache hits, read pool,
+compression, ...) stay per process and describe the worker that answered
+the scrape; queue sizes and WAL figures read from shared files are the
+server's.
+"""
+import gc
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+KEEPALIVE_SECONDS = 5
+
+
+class _CountingApp:
+    """WSGI wrapper that asks the worker to stop after ``limit`` requests."""
+
+    def __init__(self, app, limit, on_limit):
+        self.app = app
+        self.limit = limit
+        self.on_limit = on_limit
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        try:
+            return self.app(environ, start_response)
+        finally:
+            with self._lock:
+                self.count += 1
+                if self.limit and self.count == self.limit:
+                    self.on_limit()
+
+
+def _worker(app, sock, threads, max_requests):
+    stopping = threading.Event()
+
+    def stop(signum=None, frame=None):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # the master owns Ctrl+C
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    random.seed()
+
+    class Handler(WSGIRequestHandler):
+        # Idle keep-alive connections must not hold a thread (or a graceful shutdown) for long
+        timeout = KEEPALIVE_SECONDS
+
+    wsgi_app = _CountingApp(app, max_requests, stop)
+    server = make_server(*sock.getsockname()[:2], wsgi_app, threaded=threads > 1, request_handler=Handler,
+                         fd=sock.fileno())
+    server.timeout = 0.5
+    if threads > 1:
+        # Join request threads on close so in-flight requests (e.g. submits) finish
+        server.daemon_threads = False
+        server.block_on_close = True
+        gate = threading.BoundedSemaphore(threads)
+        process_request = server.process_request
+
+        def bounded(request, client_address):
+            gate.acquire()
+            try:
+                process_request(request, client_address)
+            except Exception:
+                gate.release()
+                raise
+
+        finish = server.process_request_thread
+
+        def release_after(request, client_address):
+            try:
+                finish(request, client_address)
+            finally:
+                gate.release()
+
+        server.process_request = bounded
+        server.process_request_thread = release_after
+
+    print(f'[SERVE] worker {os.getpid()} ready')
+    while not stopping.is_set():
+        server.handle_request()
+    server.server_close()
+    print(f'[SERVE] worker {os.getpid()} exiting after {wsgi_app.count} requests')
+
+
+def serve(app, host='0.0.0.0', port=8000, workers=2, threads=4, max_requests=1000, max_requests_jitter=100,
+          graceful_timeout=30, on_starting=None):
+    """Run ``app`` under a pre-forking master until SIGTERM/SIGINT."""
+    sock = socket.create_server((host, port), backlog=2048)
+    sock.set_inheritable(True)
+    print(f'[SERVE] listening on http://{host}:{sock.getsockname()[1]} with {workers} workers x {threads} threads')
+
+    if on_starting:
+        on_starting()
+    gc.collect()
+    gc.freeze()
+
+    if not hasattr(os, 'fork'):
+        print('[SERVE] os.fork is not available; serving from a single process')
+        make_server(host, port, app, threaded=True, fd=sock.fileno()).serve_forever()
+        return
+
+    children = {}
+    state = {'stopping': False, 'recycle': False}
+
+    def spawn():
+        limit = max_requests + random.randint(0, max_requests_jitter) if max_requests else 0
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _worker(app, sock, threads, limit)
+            except BaseException as e:
+                print(f'[SERVE] worker {os.getpid()} crashed: {e!r}')
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = time.monotonic()
+
+    def on_stop(signum, frame):
+        state['stopping'] = True
+
+    def on_hup(signum, frame):
+        state['recycle'] = True
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGHUP, on_hup)
+
+    for _ in range(workers):
+        spawn()
+
+    while not state['stopping']:
+        if state['recycle']:
+            state['recycle'] = False
+            print('[SERVE] SIGHUP: recycling workers')
+            for pid in list(children):
+                _signal(pid, signal.SIGTERM)
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid and pid in children:
+            started = children.pop(pid)
+            if not state['stopping']:
+                if os.waitstatus_to_exitcode(status) != 0 and time.monotonic() - started < 1.0:
+                    time.sleep(1.0)  # do not spin on a worker that dies at start-up
+                spawn()
+            continue
+        time.sleep(0.1)
+
+    print(f'[SERVE] shutting down {len(children)} workers')
+    for pid in list(children):
+        _signal(pid, signal.SIGTERM)
+    deadline = time.monotonic() + graceful_timeout
+    while children and time.monotonic() < deadline:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            children.pop(pid, None)
+        else:
+            time.sleep(0.1)
+    for pid in list(children):
+        print(f'[SERVE] worker {pid} did not finish in {graceful_timeout}s; killing it')
+        _signal(pid, signal.SIGKILL)
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    sock.close()
+
+
+def _signal(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
@@ -0,0 +1,325 @@
+"""Server-side anti-cheat event log.
+
+The quiz page reports focus events (tab hidden, window blur, ...) in small
+batches via ``navigator.sendBeacon`` / ``fetch(..., {keepalive: true})``.
+:class:`EventIngest` buffers them in memory and a background thread writes
+them to the append-only ``proctor_events`` table in group commits. Each
+commit is one transaction holding every event that arrived since the last
+one, so thousands of events per second cost a handful of fsyncs.
+
+Per attempt, ``proctor_attempts`` keeps the running count of tab leaves,
+updated in the same commits. A blur and a visibility change fired by the
+same tab switch within ``LEAVE_DEBOUNCE_MS`` count once, also when they
+reach different worker processes: each commit debounces its leaves again
+against the counted leaves already stored. The leave count
+and the auto-submit decision come from these server-side counts, not from
+what the browser posts with the answers. Once an attempt is marked for
+auto-submission the server stops serving its questions, and answers posted
+more than ``AUTO_SUBMIT_GRACE_SECONDS`` later are flagged as late.
+
+A submission closes its attempt (``close_attempt``). Attempts are keyed by
+``(test_id, respondent_id, attempt_no)``, so a student whose credential is
+reactivated sits again under the same key; ``reopen_attempt`` at the start
+of that sitting clears the leaves and ``auto_submit_at`` of a closed attempt.
+An attempt that was never submitted keeps its count, so logging in again
+in the middle of a sitting does not reset it.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+
+EVENT_TYPES = frozenset({'hidden', 'visible', 'blur', 'focus', 'copy', 'paste', 'contextmenu',
+                         'fullscreen_exit', 'start', 'answer'})
+LEAVE_TYPES = frozenset({'hidden', 'blur'})
+LEAVE_DEBOUNCE_MS = 1000
+AUTO_SUBMIT_GRACE_SECONDS = 15   # time for the page to post its answers after an auto-submit
+MAX_EVENTS_PER_BATCH = 50
+
+
+def parse_batch(raw):
+    """Validate a beacon body. Returns a list of ``(type, client_ms, question_index, detail)``."""
+    try:
+        payload = json.loads(raw or b'{}')
+    except ValueError:
+        return []
+    events = payload.get('events') if isinstance(payload, dict) else None
+    if not isinstance(events, list):
+        return []
+    parsed = []
+    for e in events[:MAX_EVENTS_PER_BATCH]:
+        if not isinstance(e, dict) or e.get('type') not in EVENT_TYPES:
+            continue
+        try:
+            client_ms = int(e.get('t') or 0)
+            q = int(e['q']) if e.get('q') is not None else None
+        except (TypeError, ValueError):
+            continue
+        detail = str(e.get('detail') or '')[:200] or None
+        parsed.append((e['type'], client_ms, q, detail))
+    return parsed
+
+
+class EventIngest:
+    """Buffers proctoring events and group-commits them."""
+
+    def __init__(self, db_path, factory=sqlite3.Connection, flush_interval=0.05, max_batch=5000,
+                 max_buffer=200000, memory_attempts=50000):
+        self.db_path = db_path
+        self.factory = factory
+        self.flush_interval = float(flush_interval)
+        self.max_batch = int(max_batch)
+        self.max_buffer = int(max_buffer)
+        self.memory_attempts = int(memory_attempts)
+        self._buffer = []          # event rows waiting for the next commit
+        self._pending = {}         # attempt key -> leaves not yet committed
+        self._last_leave = OrderedDict()  # attempt key -> client ms of the last counted leave
+        self._cond = threading.Condition()
+        self._flushed = threading.Condition(self._cond)
+        self._commits = 0
+        self._dropped = 0
+        self._resets = 0
+        self._thread_pid = None
+        self._schema_ready = False
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, factory=self.factory)
+        conn.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            ensure_schema(conn)
+            self._schema_ready = True
+        return conn
+
+    # ---- ingest ----
+
+    def record(self, attempt, events):
+        """Queue ``events`` for ``attempt`` (``(test_id, respondent_id, attempt_no)``).
+
+        Returns the number of tab leaves these events added.
+        """
+        self.start()
+        now = datetime.now(timezone.utc).isoformat()
+        test_id, respondent_id, attempt_no = attempt
+        key = (test_id, respondent_id, attempt_no)
+        added = 0
+        with self._cond:
+            if len(self._buffer) + len(events) > self.max_buffer:
+                self._dropped += len(events)
+                return 0
+            for etype, client_ms, q, detail in events:
+                counted = 0
+                if etype in LEAVE_TYPES:
+                    last = self._last_leave.get(key)
+                    if last is None or abs(client_ms - last) >= LEAVE_DEBOUNCE_MS:
+                        counted = 1
+                        self._last_leave[key] = client_ms
+                        self._last_leave.move_to_end(key)
+                        if len(self._last_leave) > self.memory_attempts:
+                            self._last_leave.popitem(last=False)
+                self._buffer.append((test_id, respondent_id, attempt_no, etype, client_ms, q, detail, counted, now))
+                added += counted
+            if added:
+                self._pending[key] = self._pending.get(key, 0) + added
+            self._cond.notify()
+        return added
+
+    def leave_count(self, conn, attempt):
+        """Committed plus still-buffered leaves of ``attempt``."""
+        row = conn.execute("""
+            SELECT leaves FROM proctor_attempts WHERE test_id=? AND respondent_id=? AND attempt_no=?
+        """, attempt).fetchone()
+        with self._cond:
+            pending = self._pending.get(tuple(attempt), 0)
+        return (row['leaves'] if row else 0) + pending
+
+    def mark_auto_submitted(self, conn, attempt):
+        now = datetime.now(timezone.utc).isoformat()
+        conn.execute("""
+            INSERT INTO proctor_attempts (test_id, respondent_id, attempt_no, leaves, last_event_at, auto_submit_at)
+            VALUES (?, ?, ?, 0, ?, ?)
+            ON CONFLICT(test_id, respondent_id, attempt_no) DO UPDATE SET
+                auto_submit_at=COALESCE(proctor_attempts.auto_submit_at, excluded.auto_submit_at)
+        """, tuple(attempt) + (now, now))
+
+    def auto_submitted_at(self, conn, attempt):
+        """When ``attempt`` was told to auto-submit (an aware datetime), or None."""
+        row = conn.execute("""
+            SELECT auto_submit_at FROM proctor_attempts WHERE test_id=? AND respondent_id=? AND attempt_no=?
+        """, tuple(attempt)).fetchone()
+        return datetime.fromisoformat(row['auto_submit_at']) if row and row['auto_submit_at'] else None
+
+    def close_attempt(self, conn, attempt):
+        """Mark ``attempt`` as submitted; runs inside the submission's write unit."""
+        now = datetime.now(timezone.utc).isoformat()
+        conn.execute("""
+            UPDATE proctor_attempts SET closed_at=? WHERE test_id=? AND respondent_id=? AND attempt_no=?
+        """, (now,) + tuple(attempt))
+
+    def attempt_closed(self, conn, attempt):
+        row = conn.execute("""
+            SELECT closed_at FROM proctor_attempts WHERE test_id=? AND respondent_id=? AND attempt_no=?
+        """, tuple(attempt)).fetchone()
+        return bool(row and row['closed_at'])
+
+    def reopen_attempt(self, conn, attempt):
+        """Clear a closed ``attempt`` for a new sitting; a write unit for db_writes.run.
+
+        Call :meth:`flush` first, so leaves of the old sitting still in the
+        buffer are not added to the new one. Returns True when a count was cleared.
+        """
+        key = tuple(attempt)
+        cur = conn.execute("""
+            UPDATE proctor_attempts SET leaves=0, last_event_at=NULL, auto_submit_at=NULL, closed_at=NULL
+            WHERE test_id=? AND respondent_id=? AND attempt_no=? AND closed_at IS NOT NULL
+        """, key)
+        if not cur.rowcount:
+            return False
+        with self._cond:
+            self._last_leave.pop(key, None)
+            self._resets += 1
+        return True
+
+    # ---- group commit ----
+
+    def start(self):
+        """Start the flusher thread once per process."""
+        import os
+        if self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, name='proctor-flusher', daemon=True).start()
+
+    def _run(self):
+        conn = self.connect()
+        while True:
+            with self._cond:
+                while not self._buffer:
+                    self._cond.wait()
+            # Let a burst accumulate into one commit
+            time.sleep(self.flush_interval)
+            try:
+                self._flush(conn)
+            except Exception as e:
+                print('[PROCTOR] flush failed:', e)
+                time.sleep(1.0)
+
+    def _flush(self, conn):
+        with self._cond:
+            rows = self._buffer[:self.max_batch]
+        if not rows:
+            return 0
+        pending = {}
+        for r in rows:
+            if r[7]:
+                k = (r[0], r[1], r[2])
+                pending[k] = pending.get(k, 0) + 1
+        now = rows[-1][8]
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows, counts = self._debounce(conn, rows)
+            conn.executemany("""
+                INSERT INTO proctor_events (test_id, respondent_id, attempt_no, event_type, client_ms,
+                                            question_index, detail, counted, received_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            conn.executemany("""
+                INSERT INTO proctor_attempts (test_id, respondent_id, attempt_no, leaves, last_event_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(test_id, respondent_id, attempt_no) DO UPDATE SET
+                    leaves=proctor_attempts.leaves + excluded.leaves, last_event_at=excluded.last_event_at
+            """, [k + (n, now) for k, n in counts.items()])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self._cond:
+            del self._buffer[:len(rows)]
+            for k, n in pending.items():
+                left = self._pending.get(k, 0) - n
+                if left > 0:
+                    self._pending[k] = left
+                else:
+                    self._pending.pop(k, None)
+            self._commits += 1
+            self._flushed.notify_all()
+        return len(rows)
+
+    @staticmethod
+    def _debounce(conn, rows):
+        """Debounce leaves again against the leaves already committed.
+
+        ``record`` debounces per process; with several workers, the blur and
+        the visibility change of one tab switch can reach different ones, in
+        either order. Flushes are serialized by the write lock, so checking
+        each leave against the counted ones near it counts each switch once.
+        Returns the rows with corrected ``counted`` flags and the leaves per
+        attempt.
+        """
+        out, counts, seen = [], {}, {}
+        for r in rows:
+            k = (r[0], r[1], r[2])
+            counted = 0
+            if r[3] in LEAVE_TYPES:
+                lo, hi = r[4] - LEAVE_DEBOUNCE_MS, r[4] + LEAVE_DEBOUNCE_MS
+                if not any(lo < ms < hi for ms in seen.get(k, ())) and conn.execute("""
+                    SELECT 1 FROM proctor_events
+                    WHERE test_id=? AND respondent_id=? AND attempt_no=? AND counted=1 AND client_ms > ? AND client_ms < ?
+                    LIMIT 1
+                """, k + (lo, hi)).fetchone() is None:
+                    counted = 1
+                    seen.setdefault(k, []).append(r[4])
+                    counts[k] = counts.get(k, 0) + 1
+            out.append(r[:7] + (counted,) + r[8:])
+        return out, counts
+
+    def flush(self, timeout=5.0):
+        """Wait until everything buffered so far is committed."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._buffer and time.monotonic() < deadline:
+                self._cond.notify()
+                self._flushed.wait(timeout=max(0.0, deadline - time.monotonic()))
+            return not self._buffer
+
+    def metrics(self):
+        with self._cond:
+            return {'buffered': len(self._buffer), 'commits': self._commits, 'dropped': self._dropped,
+                    'resets': self._resets}
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS proctor_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            test_id INTEGER,
+            respondent_id INTEGER,
+            attempt_no INTEGER,
+            event_type TEXT,
+            client_ms INTEGER,
+            question_index INTEGER,
+            detail TEXT,
+            counted INTEGER DEFAULT 0,
+            received_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_proctor_events_attempt ON proctor_events(test_id, respondent_id, attempt_no);
+        CREATE TRIGGER IF NOT EXISTS trg_proctor_events_append_only BEFORE UPDATE ON proctor_events
+        BEGIN
+            SELECT RAISE(ABORT, 'proctor_events is append-only');
+        END;
+        CREATE TABLE IF NOT EXISTS proctor_attempts (
+            test_id INTEGER,
+            respondent_id INTEGER,
+            attempt_no INTEGER,
+            leaves INTEGER DEFAULT 0,
+            last_event_at TEXT,
+            auto_submit_at TEXT,
+            closed_at TEXT,
+            PRIMARY KEY (test_id, respondent_id, attempt_no)
+        );
+    """)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(proctor_attempts)")}
+    if 'closed_at' not in cols:
+        conn.execute("ALTER TABLE proctor_attempts ADD COLUMN closed_at TEXT")
@@ -0,0 +1,200 @@
+"""Read-only connection pool for the admin pages and exports.
+
+Admin reads (the dashboard, submission listings, CSV/Excel exports, the
+analytics pages) used to open the same read-write connections as the
+student routes. A long export keeps a WAL snapshot open, and no checkpoint
+can copy frames past the oldest open snapshot, so the WAL grows for as
+long as the export runs. :class:`ReadPool` hands out connections that:
+
+* are opened as ``mode=ro`` URIs and then set ``PRAGMA query_only``, so a
+  read path cannot write, take the write lock or run a checkpoint;
+* stop any statement that runs longer than ``query_budget_ms``, through a
+  progress handler that interrupts the query (:class:`ReadTimeout`);
+* stop a statement once the snapshot it reads from is older than
+  ``max_snapshot_seconds``. In autocommit the snapshot lives as long as the
+  statement, so this catches cursors that are iterated slowly; inside an
+  explicit ``BEGIN`` it covers the whole read transaction.
+
+``prepare(conn)`` runs on every new connection before ``query_only`` is
+set, which is where the archive views are created. A connection whose
+``generation()`` has changed since it was prepared (a new archive file)
+is closed instead of reused. ``close()`` returns a connection to the
+pool; a connection that was interrupted or left in a transaction is
+closed for good.
+"""
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+DEFAULTS = {
+    'size': 4,                     # idle connections kept; more are opened (and closed) on demand
+    'query_budget_ms': 30000,
+    'max_snapshot_seconds': 60,
+    'progress_ops': 10000,         # VM instructions between two budget checks
+}
+
+
+class ReadTimeout(sqlite3.OperationalError):
+    """A read was interrupted by its time budget or its snapshot age."""
+
+
+class ReadPool:
+    """Pool of read-only, time-limited connections to one database."""
+
+    def __init__(self, db_path, size=4, query_budget_ms=30000, max_snapshot_seconds=60, progress_ops=10000,
+                 factory=sqlite3.Connection, cursor_factory=sqlite3.Cursor, prepare=None, generation=None):
+        self.db_path = Path(db_path)
+        self.size = int(size)
+        self.budget = query_budget_ms / 1000.0
+        self.max_snapshot = float(max_snapshot_seconds)
+        self.progress_ops = int(progress_ops)
+        self.prepare = prepare
+        self.generation = generation or (lambda: None)
+        self.connection_class = self._connection_class(factory, cursor_factory)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._in_use = set()
+        self._counts = {'opened': 0, 'reused': 0, 'discarded': 0, 'queries': 0,
+                        'interrupted_budget': 0, 'interrupted_snapshot': 0}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def _connection_class(self, base, cursor_base):
+        pool = self
+
+        class Cursor(cursor_base):
+            def execute(self, sql, parameters=()):
+                self.connection._begin_query()
+                with self.connection._guard():
+                    return super().execute(sql, parameters)
+
+            def executemany(self, sql, seq_of_parameters):
+                self.connection._begin_query()
+                with self.connection._guard():
+                    return super().executemany(sql, seq_of_parameters)
+
+            def fetchone(self):
+                with self.connection._guard():
+                    return super().fetchone()
+
+            def fetchmany(self, size=None):
+                with self.connection._guard():
+                    return super().fetchmany(self.arraysize if size is None else size)
+
+            def fetchall(self):
+                with self.connection._guard():
+                    return super().fetchall()
+
+            def __next__(self):
+                with self.connection._guard():
+                    return super().__next__()
+
+        class Connection(base):
+            def cursor(self, factory=Cursor):
+                return super().cursor(factory)
+
+            def _begin_query(self):
+                now = time.monotonic()
+                self.deadline = now + pool.budget
+                if not self.in_transaction:
+                    self.snapshot_at = now
+                self.interrupted = None
+                pool._count('queries')
+
+            def _progress(self):
+                now = time.monotonic()
+                if now > self.deadline:
+                    self.interrupted = 'budget'
+                elif now - self.snapshot_at > pool.max_snapshot:
+                    self.interrupted = 'snapshot'
+                else:
+                    return 0
+                return 1
+
+            @contextmanager
+            def _guard(self):
+                # The progress handler only runs while SQLite steps; check between fetches too
+                if self._progress():
+                    raise self._timeout()
+                try:
+                    yield
+                except sqlite3.OperationalError as e:
+                    if not self.interrupted or isinstance(e, ReadTimeout):
+                        raise
+                    raise self._timeout() from e
+
+            def _timeout(self):
+                pool._count('interrupted_' + self.interrupted)
+                if self.interrupted == 'budget':
+                    return ReadTimeout(f'query stopped after its {pool.budget:g}s budget')
+                return ReadTimeout(f'read snapshot older than {pool.max_snapshot:g}s')
+
+            def close(self):
+                pool.release(self)
+
+        Connection.__name__ = Connection.__qualname__ = f'ReadOnly{base.__name__}'
+        return Connection
+
+    def _open(self):
+        uri = self.db_path.resolve().as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None,
+                               factory=self.connection_class)
+        conn.row_factory = sqlite3.Row
+        conn.deadline = conn.snapshot_at = float('inf')
+        conn.interrupted = None
+        conn.generation = self.generation()
+        if self.prepare is not None:
+            self.prepare(conn)
+        sqlite3.Connection.execute(conn, 'PRAGMA query_only=ON')
+        conn.set_progress_handler(conn._progress, self.progress_ops)
+        self._count('opened')
+        return conn
+
+    def connect(self):
+        """A read-only connection; ``close()`` gives it back."""
+        generation = self.generation()
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open()
+                break
+            if conn.generation == generation:
+                self._count('reused')
+                break
+            self._discard(conn)
+        with self._lock:
+            self._in_use.add(conn)
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            if conn not in self._in_use:   # closed twice
+                return
+            self._in_use.remove(conn)
+        conn.deadline = conn.snapshot_at = float('inf')
+        if conn.interrupted or conn.in_transaction or self._idle.qsize() >= self.size:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+
+    def _discard(self, conn):
+        self._count('discarded')
+        sqlite3.Connection.close(conn)
+
+    def metrics(self):
+        now = time.monotonic()
+        with self._lock:
+            out = dict(self._counts)
+            ages = [now - c.snapshot_at for c in self._in_use if c.snapshot_at != float('inf')]
+            out['in_use'] = len(self._in_use)
+        out['idle'] = self._idle.qsize()
+        # Age of the oldest read still running: what holds checkpoints back
+        out['oldest_read_seconds'] = round(max(ages), 3) if ages else 0
+        return out
@@ -0,0 +1,201 @@
+"""Re-grading of stored submissions after an answer key change.
+
+All submissions of a test are loaded into a students x questions matrix of
+given option codes (uint8, ``NO_ANSWER`` where nothing matched) and scored
+against the current key with NumPy in one pass. Only submissions whose
+score or per-question verdicts actually change are rewritten, in batched
+transactions, and every run leaves a diff report in ``regrade_runs``.
+
+A submission graded against another question set than the test's current
+main set (the set was replaced since) is skipped and listed in the report,
+since its answers cannot be matched to the new questions. Submissions
+flagged ``needs_regrade`` (graded on submit without their paper, because
+the set changed during the sitting) are re-graded like the others and lose
+the flag once a run has graded them against the current key. Rows stored before
+details recorded their set are taken to belong to the current set.
+Archived sittings are out of scope: they are final, and only their number
+is reported.
+"""
+import json
+from datetime import datetime, timezone
+
+import details_codec
+from lazy import numpy as np
+
+
+OPTION_CODES = {'a': 0, 'b': 1, 'c': 2, 'd': 3}
+NO_ANSWER = 255
+NO_KEY = 254  # correct_option missing or invalid: nothing matches it
+
+
+def load_key(conn, set_id):
+    """Return ``(qids, key)``: question ids of the set and their correct option codes."""
+    rows = conn.execute("SELECT question_id, correct_option FROM questions WHERE set_id=? ORDER BY id ASC",
+                        (set_id,)).fetchall()
+    qids = [r['question_id'] for r in rows]
+    key = np.array([OPTION_CODES.get((r['correct_option'] or '').strip().lower(), NO_KEY) for r in rows],
+                   dtype=np.uint8)
+    return qids, key
+
+
+def build_matrix(details_list, qids):
+    """Vectorize parsed ``details_json`` lists against ``qids``.
+
+    Returns ``(given, present, old_correct, orphan)``: the given option codes,
+    which cells the submission's paper contained, the stored verdicts, and per
+    submission the number of correct answers to questions no longer in the set
+    (those keep their stored verdict).
+    """
+    col = {qid: j for j, qid in enumerate(qids)}
+    n, q = len(details_list), len(qids)
+    rows, cols, codes, verdicts = [], [], [], []
+    orphan = np.zeros(n, dtype=np.float64)
+    for i, details in enumerate(details_list):
+        for d in details:
+            j = col.get(d.get('qid'))
+            if j is None:
+                orphan[i] += 1.0 if d.get('correct') else 0.0
+                continue
+            rows.append(i)
+            cols.append(j)
+            codes.append(OPTION_CODES.get(d.get('given_key') or '', NO_ANSWER))
+            verdicts.append(bool(d.get('correct')))
+    given = np.full((n, q), NO_ANSWER, dtype=np.uint8)
+    present = np.zeros((n, q), dtype=bool)
+    old_correct = np.zeros((n, q), dtype=bool)
+    if rows:
+        r = np.fromiter(rows, dtype=np.intp, count=len(rows))
+        c = np.fromiter(cols, dtype=np.intp, count=len(cols))
+        given[r, c] = np.fromiter(codes, dtype=np.uint8, count=len(codes))
+        present[r, c] = True
+        old_correct[r, c] = np.fromiter(verdicts, dtype=bool, count=len(verdicts))
+    return given, present, old_correct, orphan
+
+
+def score_matrix(given, present, key):
+    """Return ``(correct, scores)`` for a given-codes matrix against ``key``."""
+    correct = (given == key[np.newaxis, :]) & present
+    return correct, correct.sum(axis=1, dtype=np.int64)
+
+
+def regrade_test(conn, test_id, batch_size=500, dry_run=False, triggered_by='', answer_key=None, archived=0):
+    """Re-grade every submission of ``test_id`` against its current main-set key.
+
+    ``conn`` is an autocommit connection with ``sqlite3.Row`` rows.
+    ``answer_key`` (the compiled main set) lets re-written old-format details
+    reference its text snapshot instead of copying the texts; rows that
+    already reference a snapshot keep theirs. ``archived`` is the number of
+    the test's archived submissions, which are left alone. Returns the
+    report dict (also stored in ``regrade_runs`` unless ``dry_run``).
+    """
+    set_row = conn.execute("SELECT id FROM question_sets WHERE test_id=? AND set_type='main'", (test_id,)).fetchone()
+    report = {'test_id': test_id, 'total': 0, 'changed': 0, 'questions': {}, 'rows': [], 'skipped': [],
+              'flagged': [], 'archived': int(archived), 'dry_run': bool(dry_run)}
+    if not set_row:
+        return report
+    qids, key = load_key(conn, set_row['id'])
+
+    subs, refs, details_list = [], [], []
+    for s in conn.execute("""
+        SELECT id, respondent_id, score, details_json, needs_regrade FROM submissions WHERE test_id=? ORDER BY id
+    """, (test_id,)).fetchall():
+        try:
+            set_id, snap, details = details_codec.unpack(s['details_json'])
+        except ValueError:
+            set_id, snap, details = None, None, []
+        if set_id is not None and set_id != set_row['id']:
+            report['skipped'].append({'submission_id': s['id'], 'respondent_id': s['respondent_id'], 'set_id': set_id})
+            continue
+        if s['needs_regrade']:
+            report['flagged'].append(s['id'])
+        subs.append(s)
+        refs.append((set_id, snap))
+        details_list.append(details)
+    report['total'] = len(subs)
+    if not subs:
+        return report
+    given, present, old_correct, orphan = build_matrix(details_list, qids)
+    new_correct, counts = score_matrix(given, present, key)
+    new_scores = counts + orphan
+    old_scores = np.array([s['score'] or 0.0 for s in subs], dtype=np.float64)
+
+    flipped = new_correct != old_correct
+    changed = np.flatnonzero(flipped.any(axis=1) | (new_scores != old_scores))
+    report['changed'] = int(changed.size)
+
+    # Per question: how many verdicts flipped, to explain the diff
+    flips_per_q = flipped.sum(axis=0)
+    inverse = {v: k for k, v in OPTION_CODES.items()}
+    for j in np.flatnonzero(flips_per_q):
+        report['questions'][qids[j]] = {'correct_key': inverse.get(int(key[j]), ''), 'flipped': int(flips_per_q[j])}
+
+    col = {qid: j for j, qid in enumerate(qids)}
+    updates = []
+    for i in changed:
+        s = subs[i]
+        report['rows'].append({'submission_id': s['id'], 'respondent_id': s['respondent_id'],
+                               'old_score': float(old_scores[i]), 'new_score': float(new_scores[i]),
+                               'delta': float(new_scores[i] - old_scores[i])})
+        if dry_run:
+            continue
+        for d in details_list[i]:
+            j = col.get(d.get('qid'))
+            if j is not None:
+                d['correct_key'] = inverse.get(int(key[j]), '')
+                d['correct'] = bool(new_correct[i, j])
+        # A row that references a snapshot keeps it; only old rows are pointed at the current texts
+        set_id, snap = refs[i]
+        ref_key = answer_key if answer_key is not None and snap is None and set_id in (None, answer_key.set_id) else None
+        updates.append((float(new_scores[i]), details_codec.encode(details_list[i], ref_key, set_id, snap), s['id']))
+
+    for start in range(0, len(updates), batch_size):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if answer_key is not None:
+                details_codec.save_snapshot(conn, answer_key)
+            conn.executemany("UPDATE submissions SET score=?, details_json=? WHERE id=?",
+                             updates[start:start + batch_size])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    if report['flagged'] and not dry_run:
+        conn.executemany("UPDATE submissions SET needs_regrade=0 WHERE id=?", [(i,) for i in report['flagged']])
+
+    if not dry_run:
+        cur = conn.execute("""
+            INSERT INTO regrade_runs (test_id, created_at, triggered_by, total, changed, report_json)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (test_id, datetime.now(timezone.utc).isoformat(), triggered_by, report['total'], report['changed'],
+              json.dumps(report)))
+        report['run_id'] = cur.lastrowid
+    return report
+
+
+def list_runs(conn, limit=20):
+    return [dict(r) for r in conn.execute("""
+        SELECT id, test_id, created_at, triggered_by, total, changed FROM regrade_runs ORDER BY id DESC LIMIT ?
+    """, (limit,))]
+
+
+def load_run(conn, run_id):
+    row = conn.execute("SELECT report_json FROM regrade_runs WHERE id=?", (run_id,)).fetchone()
+    return json.loads(row['report_json']) if row else None
+
+
+def ensure_schema(conn):
+    # Set on submissions graded without their paper (the set changed during the sitting)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(submissions)")}
+    if 'needs_regrade' not in cols:
+        conn.execute("ALTER TABLE submissions ADD COLUMN needs_regrade INTEGER DEFAULT 0")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS regrade_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            test_id INTEGER,
+            created_at TEXT,
+            triggered_by TEXT,
+            total INTEGER DEFAULT 0,
+            changed INTEGER DEFAULT 0,
+            report_json TEXT
+        )
+    """)
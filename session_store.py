@@ -0,0 +1,289 @@
+"""Server-side session storage for the quiz app.
+
+Session data is kept in two tiers:
+
+* a bounded in-memory map per worker process (the hot tier), and
+* the ``quiz_sessions`` table in SQLite (the durable tier).
+
+The browser cookie only carries an opaque random session id, which is also the
+``quiz_sessions.session_token`` of the row holding the data. A student login
+adopts that row (``quiz_id``/``student_id`` are filled in), so the quiz
+session audit trail and the web session are the same record.
+"""
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Dict-like session whose contents live on the server."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Move the data to a fresh session id (call on login)."""
+        self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+        return self.sid
+
+
+class SessionStore:
+    """Two-tier (memory + SQLite) session store with TTL expiry."""
+
+    def __init__(self, db_path, ttl_seconds=4 * 3600, memory_max=10000,
+                 hot_ttl=0.0, sweep_interval=300, factory=sqlite3.Connection, run_write=None):
+        self.db_path = db_path
+        self.factory = factory
+        # run_write(conn, unit, *args) runs a write unit in one transaction,
+        # e.g. WriteCoordinator.run, which retries it while the DB is locked.
+        self.run_write = run_write or _run_write
+        self.ttl_seconds = int(ttl_seconds)
+        self.memory_max = int(memory_max)
+        # How long a hot entry is trusted without probing its revision in the
+        # DB. Keep at 0 when several worker processes share the database.
+        self.hot_ttl = float(hot_ttl)
+        self.sweep_interval = int(sweep_interval)
+        self._memory = OrderedDict()  # sid -> [rev, expires_epoch, checked_at, data]
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        self._sweeper_pid = None
+
+    # ---- DB plumbing ----
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, factory=self.factory)
+        conn.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            ensure_schema(conn)
+            self._schema_ready = True
+        return conn
+
+    # ---- hot tier ----
+
+    def _remember(self, sid, rev, expires, data):
+        with self._lock:
+            self._memory[sid] = [rev, expires, time.monotonic(), data]
+            self._memory.move_to_end(sid)
+            while len(self._memory) > self.memory_max:
+                self._memory.popitem(last=False)
+
+    def _forget(self, sid):
+        with self._lock:
+            self._memory.pop(sid, None)
+
+    # ---- public API ----
+
+    def load(self, sid):
+        """Return the session dict for ``sid`` or ``None`` if unknown/expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(sid)
+        if entry and entry[1] > now and time.monotonic() - entry[2] < self.hot_ttl:
+            return dict(entry[3])
+
+        conn = self.connect()
+        try:
+            if entry and entry[1] > now:
+                row = conn.execute("SELECT data_rev FROM quiz_sessions WHERE session_token=?", (sid,)).fetchone()
+                if row and row['data_rev'] == entry[0]:
+                    entry[2] = time.monotonic()
+                    return dict(entry[3])
+            row = conn.execute("""
+                SELECT data_json, data_rev, expiry_time FROM quiz_sessions
+                WHERE session_token=? AND data_json IS NOT NULL
+            """, (sid,)).fetchone()
+        finally:
+            conn.close()
+
+        if not row or not row['expiry_time'] or _parse_iso(row['expiry_time']) <= now:
+            self._forget(sid)
+            return None
+        try:
+            data = json.loads(row['data_json'])
+        except ValueError:
+            return None
+        self._remember(sid, row['data_rev'], _parse_iso(row['expiry_time']), data)
+        return dict(data)
+
+    def save(self, sid, data):
+        """Write-through ``data`` for ``sid`` and extend its expiry."""
+        expires = datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)
+        payload = json.dumps(data, separators=(',', ':'))
+        conn = self.connect()
+        try:
+            rev = self.run_write(conn, _save_row, sid, expires, payload)
+        finally:
+            conn.close()
+        self._remember(sid, rev, expires.timestamp(), data)
+        return expires
+
+    def delete(self, sid):
+        """Drop the session data; quiz rows are kept for auditing."""
+        self._forget(sid)
+        conn = self.connect()
+        try:
+            self.run_write(conn, _delete_row, sid)
+        finally:
+            conn.close()
+
+    def sweep(self):
+        """Remove expired sessions from both tiers. Returns rows touched."""
+        now = time.time()
+        with self._lock:
+            for sid in [s for s, e in self._memory.items() if e[1] <= now]:
+                del self._memory[sid]
+        conn = self.connect()
+        try:
+            return self.run_write(conn, _sweep_rows, datetime.now(timezone.utc).isoformat())
+        finally:
+            conn.close()
+
+    def start_sweeper(self):
+        """Start the periodic sweeper thread once per process."""
+        if self.sweep_interval <= 0 or self._sweeper_pid == os.getpid():
+            return
+        self._sweeper_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(self.sweep_interval)
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print('[SESSION] sweep failed:', e)
+
+        threading.Thread(target=run, name='session-sweeper', daemon=True).start()
+
+
+def _run_write(conn, unit, *args):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = unit(conn, *args)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return result
+
+
+def _sweep_rows(conn, now_iso):
+    removed = conn.execute(
+        "DELETE FROM quiz_sessions WHERE student_id IS NULL AND expiry_time IS NOT NULL AND expiry_time < ?",
+        (now_iso,)).rowcount
+    expired = conn.execute("""
+        UPDATE quiz_sessions SET status='expired', data_json=NULL
+        WHERE student_id IS NOT NULL AND expiry_time IS NOT NULL AND expiry_time < ?
+          AND (status='active' OR data_json IS NOT NULL)
+    """, (now_iso,)).rowcount
+    return removed + expired
+
+
+def _save_row(conn, sid, expires, payload):
+    conn.execute("""
+        INSERT INTO quiz_sessions (session_token, start_time, expiry_time, status, data_json, data_rev)
+        VALUES (?, ?, ?, 'active', ?, 1)
+        ON CONFLICT(session_token) DO UPDATE SET
+            data_json=excluded.data_json,
+            expiry_time=excluded.expiry_time,
+            data_rev=COALESCE(quiz_sessions.data_rev, 0) + 1
+    """, (sid, datetime.now(timezone.utc).isoformat(), expires.isoformat(), payload))
+    return conn.execute("SELECT data_rev FROM quiz_sessions WHERE session_token=?", (sid,)).fetchone()['data_rev']
+
+
+def _delete_row(conn, sid):
+    conn.execute("DELETE FROM quiz_sessions WHERE session_token=? AND student_id IS NULL", (sid,))
+    conn.execute("""
+        UPDATE quiz_sessions SET data_json=NULL, data_rev=COALESCE(data_rev, 0) + 1,
+               status=CASE WHEN status='active' THEN 'closed' ELSE status END
+        WHERE session_token=?
+    """, (sid,))
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface backed by :class:`SessionStore`."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        self.store.start_sweeper()
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.load(sid)
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid:
+            self.store.delete(session.previous_sid)
+            session.previous_sid = None
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not session.modified:
+            return
+
+        self.store.save(session.sid, dict(session))
+        response.set_cookie(
+            name, session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain, path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+        response.vary.add('Cookie')
+
+
+def ensure_schema(conn):
+    """Add the session columns to ``quiz_sessions`` if they are missing."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS quiz_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            quiz_id INTEGER,
+            student_id INTEGER,
+            session_token TEXT UNIQUE,
+            start_time TEXT,
+            expiry_time TEXT,
+            status TEXT DEFAULT 'active',
+            quiz_start_confirmed INTEGER DEFAULT 0
+        )
+    """)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(quiz_sessions)")}
+    if 'data_json' not in cols:
+        conn.execute("ALTER TABLE quiz_sessions ADD COLUMN data_json TEXT")
+    if 'data_rev' not in cols:
+        conn.execute("ALTER TABLE quiz_sessions ADD COLUMN data_rev INTEGER DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quiz_sessions_expiry ON quiz_sessions(expiry_time)")
+
+
+def _parse_iso(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
@@ -0,0 +1,224 @@
+"""Compiled, hot-reloadable configuration.
+
+config.json is parsed once into an immutable :class:`Settings`. Nested
+sections become read-only mappings (``settings['test']['name']`` keeps
+working), and the values read on hot paths are precomputed attributes: the
+per-question timer in seconds, the grade table sorted for bisection, the
+asset files used by the PDFs and the submit URL. ``version`` is a hash of
+the content, so caches keyed on it (rendered pages) never serve output built
+from an older config.
+
+:class:`ConfigStore` holds the current Settings. It re-checks the file's
+mtime at most every ``check_seconds`` and swaps in the recompiled config
+with a single assignment, so a request sees either the old or the new
+config, never a mix. A file that fails to parse or compile is reported and
+the previous config stays in use. Each worker process reloads on its own;
+``reload()`` forces it (the admin "Reload config" button).
+
+``tests.config_json`` holds per-test overrides (e.g. another timer for one
+level), deep-merged over the file; :meth:`ConfigStore.for_test` compiles and
+caches the result per config version. Overrides edited in the database are
+picked up by the next reload.
+
+Values consumed at start-up (mail transport, admission limits,
+compression, the submit route's URL rule) still need a restart to change.
+"""
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+from collections.abc import Mapping
+from pathlib import Path
+from types import MappingProxyType
+from typing import NamedTuple
+
+
+FALLBACK_GRADE = ('F', 'Needs Improvement')
+
+
+class Grade(NamedTuple):
+    min_percent: float
+    grade: str
+    desc: str
+
+
+def mmss_to_seconds(mmss: str) -> int:
+    mm, ss = mmss.split(':')
+    return int(mm) * 60 + int(ss)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _merge(base, overrides):
+    merged = dict(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class Settings(Mapping):
+    """One compiled config. Immutable; also a read-only mapping of the raw sections."""
+
+    def __init__(self, raw: dict, assets_dir):
+        test = raw['test']
+        anti_cheat = test.get('anti_cheat', {})
+        branding = raw.get('branding', {})
+        certificate = branding.get('certificate', {})
+        grades = sorted((Grade(float(r['min_percent']), r['grade'], r['desc'])
+                         for r in certificate.get('grade_thresholds', [])), key=lambda g: g.min_percent)
+        source = json.dumps(raw, sort_keys=True, ensure_ascii=False)
+
+        def asset(path, default=None):
+            # PDFs read branding images from assets/, whatever directory the config names
+            name = Path(path).name if path else default
+            return Path(assets_dir) / name if name else None
+
+        values = {
+            '_data': _freeze(raw),
+            'source': source,
+            'version': hashlib.sha256(source.encode('utf-8')).hexdigest()[:12],
+            'test_name': test['name'],
+            'slug': test['slug'],
+            'submit_path': f"/{test['slug']}/submit",
+            'attempts_limit': int(test.get('attempts_limit', 1)),
+            'per_question_seconds': mmss_to_seconds(test['per_question_time_mmss']),
+            'randomize_questions': bool(test.get('randomize_questions', True)),
+            'randomize_options': bool(test.get('randomize_options', True)),
+            'max_tab_leaves': int(anti_cheat.get('max_tab_leaves', 3)),
+            'violation_action': anti_cheat.get('action', 'auto_submit'),
+            'instructions_html': test.get('instructions_html', ''),
+            'end_message_html': test.get('end_message_html', ''),
+            'logo_path': branding.get('logo_path', ''),
+            'logo_file': asset(branding.get('logo_path'), 'logo.png'),
+            'signature_left_file': asset(certificate.get('signature_left_path')),
+            'signature_right_file': asset(certificate.get('signature_right_path')),
+            'grades': tuple(reversed(grades)),   # highest threshold first
+            '_grade_floors': [g.min_percent for g in grades],
+            '_grades_ascending': grades,
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Settings are immutable; edit config.json and reload')
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f'<Settings {self.slug!r} version {self.version}>'
+
+    def grade_for(self, pct: float):
+        """``(grade, desc)`` of the highest threshold ``pct`` reaches."""
+        i = bisect.bisect_right(self._grade_floors, pct) - 1
+        if i < 0:
+            return FALLBACK_GRADE
+        g = self._grades_ascending[i]
+        return g.grade, g.desc
+
+    def to_dict(self):
+        """A mutable deep copy of the raw config."""
+        return json.loads(self.source)
+
+
+class ConfigStore:
+    """The current :class:`Settings` of ``path``, reloaded when the file changes."""
+
+    def __init__(self, path, assets_dir, check_seconds=2.0):
+        self.path = Path(path)
+        self.assets_dir = Path(assets_dir)
+        self.check_seconds = check_seconds
+        self.reloads = 0
+        self._lock = threading.Lock()
+        self._per_test = {}
+        self._checked = time.monotonic()
+        self._stamp = self._file_stamp()
+        self.current = self._compile_file()   # a broken file at start-up is fatal
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _compile_file(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return Settings(json.load(f), self.assets_dir)
+
+    def get(self) -> Settings:
+        """The current settings, picking up a changed file at most every ``check_seconds``."""
+        now = time.monotonic()
+        if now - self._checked >= self.check_seconds:
+            self._checked = now
+            if self._file_stamp() != self._stamp:
+                self.reload()
+        return self.current
+
+    def reload(self) -> Settings:
+        """Recompile the file now. Keeps the previous settings if it is invalid."""
+        with self._lock:
+            stamp = self._file_stamp()
+            try:
+                compiled = self._compile_file()
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f'[CONFIG] {self.path.name} not reloaded, keeping version {self.current.version}: {e!r}')
+                self._stamp = stamp   # do not retry until the file changes again
+                return self.current
+            self._stamp = stamp
+            self._per_test = {}   # also re-reads per-test overrides edited in the database
+            if compiled.version != self.current.version:
+                print(f'[CONFIG] reloaded {self.path.name}: version {self.current.version} -> {compiled.version}')
+                self.current = compiled
+                self.reloads += 1
+            return self.current
+
+    def reload_all(self) -> Settings:
+        """:meth:`reload` here and in every other worker process.
+
+        Bumps the file's mtime (the content is left alone); the other
+        processes notice it in :meth:`get` within ``check_seconds``.
+        """
+        try:
+            os.utime(self.path)
+        except OSError as e:
+            print(f'[CONFIG] cannot touch {self.path.name}, other workers keep their settings: {e!r}')
+        return self.reload()
+
+    def for_test(self, test_id, load_overrides) -> Settings:
+        """The current settings with test ``test_id``'s overrides applied.
+
+        ``load_overrides()`` returns the test's ``config_json``; it is called
+        once per test and config version (and again after ``reload()``).
+        """
+        base = self.get()
+        key = (base.version, test_id)
+        hit = self._per_test.get(key)
+        if hit is not None:
+            return hit
+        resolved = base
+        try:
+            overrides = json.loads(load_overrides() or '{}')
+            if overrides:
+                resolved = Settings(_merge(base.to_dict(), overrides), self.assets_dir)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f'[CONFIG] ignoring invalid overrides of test {test_id}: {e!r}')
+        self._per_test[key] = resolved
+        return resolved
@@ -0,0 +1,237 @@
+"""Write coordination for the SQLite database.
+
+Every connection the app opens goes through :meth:`WriteCoordinator.connection_class`,
+which sets ``busy_timeout`` (unless the caller passed its own ``timeout``),
+so a writer waits for the lock instead of failing at once.
+
+Waiting alone is not enough when a whole cohort submits within the same
+second: SQLite's busy handler polls, unfairly, and a writer can still run
+out of time. :meth:`WriteCoordinator.run` executes a *write unit*, a
+function of the connection that only touches the database, inside one
+``BEGIN IMMEDIATE`` transaction. If the database is locked, the unit is
+rolled back (so it had no effect) and run again after a jittered
+exponential backoff (full jitter, which spreads the retries of a burst
+out instead of letting them collide again). Only units that are safe to
+run twice belong here, i.e. no mail, files or other side effects inside.
+
+Within a process, units take turns on a mutex before asking SQLite for the
+lock. Hundreds of request threads polling the busy handler at once keep
+the GIL so busy that the thread holding the write lock barely gets to
+``COMMIT``; queued on the mutex they sleep instead, and SQLite only
+arbitrates between processes.
+
+Checkpoints are taken off the writers' path. With the checkpointer on,
+connections raise ``wal_autocheckpoint`` to a safety-net value, and a
+background thread watches the WAL file:
+
+* while it keeps changing (a burst of writes), nothing happens unless the
+  WAL has grown past ``max_wal_mb``;
+* at the first quiet tick after a burst, a ``PASSIVE`` checkpoint copies
+  what it can without waiting for anybody;
+* after ``idle_seconds`` without writes, a ``TRUNCATE`` checkpoint resets
+  the WAL to zero bytes (it waits at most ``checkpoint_busy_ms`` for
+  readers, so an idle server is the only place it can block anyone).
+
+One process per database runs the checkpointer; the others wait on an
+``flock`` and take over if it exits.
+"""
+import os
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process checkpoints (harmless, just redundant)
+    fcntl = None
+
+
+DEFAULTS = {
+    'busy_timeout_ms': 5000,
+    'retries': 8,
+    'backoff_ms': 5,
+    'backoff_max_ms': 500,
+    'checkpointer': True,
+    'checkpoint_interval_ms': 250,
+    'idle_seconds': 5,
+    'max_wal_mb': 64,
+    'checkpoint_busy_ms': 100,
+    'wal_autocheckpoint': 20000,   # pages; only reached if the checkpointer is not keeping up
+}
+BUSY_MESSAGES = ('database is locked', 'database table is locked', 'database is busy')
+
+
+def is_busy(exc):
+    return isinstance(exc, sqlite3.OperationalError) and any(m in str(exc) for m in BUSY_MESSAGES)
+
+
+class WriteCoordinator:
+    """Busy timeouts, retried write units and the background checkpointer of one database."""
+
+    def __init__(self, db_path, busy_timeout_ms=5000, retries=8, backoff_ms=5, backoff_max_ms=500,
+                 checkpointer=True, checkpoint_interval_ms=250, idle_seconds=5, max_wal_mb=64,
+                 checkpoint_busy_ms=100, wal_autocheckpoint=20000):
+        self.db_path = Path(db_path)
+        self.busy_timeout_ms = int(busy_timeout_ms)
+        self.retries = int(retries)
+        self.backoff = backoff_ms / 1000.0
+        self.backoff_max = backoff_max_ms / 1000.0
+        self.checkpointer = bool(checkpointer)
+        self.interval = checkpoint_interval_ms / 1000.0
+        self.idle_seconds = float(idle_seconds)
+        self.max_wal_bytes = int(max_wal_mb * 1024 * 1024)
+        self.checkpoint_busy_ms = int(checkpoint_busy_ms)
+        self.wal_autocheckpoint = int(wal_autocheckpoint)
+        self._lock = threading.Lock()
+        self._write_mutex = threading.Lock()
+        self._counts = {'units': 0, 'retries': 0, 'gave_up': 0, 'checkpoints_passive': 0,
+                        'checkpoints_truncate': 0, 'checkpoints_busy': 0, 'checkpoint_errors': 0}
+        self.last_checkpoint = None   # (mode, seconds, wal frames, frames checkpointed)
+        self._caught_up = None        # (monotonic time, WAL stamp) of the last complete checkpoint
+        self._thread_pid = None
+
+    # ---- connections ----
+
+    def connection_class(self, base=sqlite3.Connection):
+        """A subclass of ``base`` that applies the busy timeout and checkpoint settings on connect."""
+        coordinator = self
+
+        class Connection(base):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                if 'timeout' not in kwargs and len(args) < 2:
+                    sqlite3.Connection.execute(self, f'PRAGMA busy_timeout={coordinator.busy_timeout_ms}')
+                if coordinator.checkpointer:
+                    sqlite3.Connection.execute(self, f'PRAGMA wal_autocheckpoint={coordinator.wal_autocheckpoint}')
+
+        Connection.__name__ = Connection.__qualname__ = f'Coordinated{base.__name__}'
+        return Connection
+
+    # ---- write units ----
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def run(self, conn, unit, *args, **kwargs):
+        """Run ``unit(conn, *args, **kwargs)`` in one transaction; retry it while the database is locked.
+
+        ``conn`` is an autocommit connection. Returns what ``unit`` returns.
+        """
+        attempt = 0
+        self._count('units')
+        while True:
+            try:
+                with self._write_mutex:
+                    conn.execute('BEGIN IMMEDIATE')
+                    try:
+                        result = unit(conn, *args, **kwargs)
+                        conn.execute('COMMIT')
+                    except BaseException:
+                        if conn.in_transaction:
+                            conn.execute('ROLLBACK')
+                        raise
+                return result
+            except sqlite3.OperationalError as e:
+                if not is_busy(e):
+                    raise
+                if attempt >= self.retries:
+                    self._count('gave_up')
+                    raise
+                attempt += 1
+                self._count('retries')
+                time.sleep(random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt)))
+
+    # ---- checkpoints ----
+
+    def wal_bytes(self):
+        try:
+            return os.stat(f'{self.db_path}-wal').st_size
+        except OSError:
+            return 0
+
+    def _wal_stamp(self):
+        try:
+            st = os.stat(f'{self.db_path}-wal')
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def checkpoint(self, mode='PASSIVE', conn=None):
+        """Run one checkpoint. Returns ``(busy, wal_frames, checkpointed_frames)``."""
+        own = conn is None
+        if own:
+            conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=self.checkpoint_busy_ms / 1000.0)
+        try:
+            started = time.perf_counter()
+            busy, frames, done = conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+            self.last_checkpoint = (mode, round(time.perf_counter() - started, 4), frames, done)
+        finally:
+            if own:
+                conn.close()
+        self._count('checkpoints_' + mode.lower())
+        if busy:
+            self._count('checkpoints_busy')
+        elif done == frames:
+            self._caught_up = (time.monotonic(), self._wal_stamp())
+        return busy, frames, done
+
+    def checkpoint_lag(self):
+        """Seconds since the last complete checkpoint, 0 if nothing was written since,
+        -1 if this process has not completed one (another process checkpoints)."""
+        caught_up = self._caught_up
+        if caught_up is None:
+            return -1
+        if self._wal_stamp() == caught_up[1]:
+            return 0
+        return round(time.monotonic() - caught_up[0], 3)
+
+    def start(self):
+        """Start the checkpointer thread once per process (no-op when disabled)."""
+        if not self.checkpointer or self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, name='checkpointer', daemon=True).start()
+
+    def _run(self):
+        lock = open(f'{self.db_path}.checkpoint.lock', 'w')
+        if fcntl:
+            # One checkpointer per database; the others block here until it exits
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=self.checkpoint_busy_ms / 1000.0)
+        stamp, changed_at = self._wal_stamp(), time.monotonic()
+        passive_due = truncate_due = True
+        while True:
+            time.sleep(self.interval)
+            try:
+                now, current = time.monotonic(), self._wal_stamp()
+                if current != stamp:
+                    # Writes since the last tick: stay out of the way unless the WAL is getting big
+                    stamp, changed_at = current, now
+                    passive_due = truncate_due = True
+                    if current and current[1] > self.max_wal_bytes:
+                        self.checkpoint('PASSIVE', conn)
+                    continue
+                if truncate_due and now - changed_at >= self.idle_seconds:
+                    busy = self.checkpoint('TRUNCATE', conn)[0]
+                    truncate_due = bool(busy)
+                    passive_due = False
+                elif passive_due:
+                    self.checkpoint('PASSIVE', conn)
+                    passive_due = False
+                stamp = self._wal_stamp()   # our own checkpoint is not write activity
+            except sqlite3.Error as e:
+                self._count('checkpoint_errors')
+                print('[WRITES] checkpoint failed:', e)
+
+    def metrics(self):
+        with self._lock:
+            out = dict(self._counts)
+        last = self.last_checkpoint
+        out['last_checkpoint_seconds'] = last[1] if last else 0
+        out['last_checkpoint_frames_left'] = (last[2] - last[3]) if last and last[2] >= 0 else 0
+        out['wal_bytes'] = self.wal_bytes()
+        out['checkpoint_lag_seconds'] = self.checkpoint_lag()
+        return out
@@ -0,0 +1,11 @@
+"""WSGI entry point for external servers (e.g. ``gunicorn --preload wsgi:app``).
+
+Creates the schema and warms the caches at import, which with ``--preload``
+happens once in the master before workers fork. ``flask --app app serve``
+does the same with the built-in pre-forking server.
+"""
+from app import app, init_db, instrumentation, warm_caches
+
+init_db()
+warm_caches()
+instrumentation.registry.clear_shared()